@@ -15,7 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
-from _fasthist import histnd #@UnresolvedImport
+from _fasthist import histnd, histnd_timeseries, flat_bin_indices #@UnresolvedImport
 
 import numpy
 
@@ -47,3 +47,49 @@ def normhistnd(hist, binbounds):
 
     hist /= normfac
     return normfac
+
+def histnd_sparse(values, binbounds, weights=1.0, binbound_check=True, ignore_out_of_range=False, nthreads=1):
+    '''Generate a sparse N-dimensional PDF (or contribution to a PDF) from the given values, which
+    may be indexed as [point][dimension] (as for ``histnd``) or [segment][timepoint][dimension] (as
+    for ``histnd_timeseries``), with ``weights`` a scalar or one weight per point (or segment). Returns
+    ``(indices, hist)``, where ``indices`` are the sorted indices of the occupied bins in the flattened
+    (C-ordered) array of bins and ``hist`` their values. Bins are located on ``nthreads`` threads.
+    Other arguments are as for ``histnd``.'''
+
+    indices = flat_bin_indices(values, binbounds, binbound_check, ignore_out_of_range, nthreads)
+
+    weights = numpy.require(weights, numpy.float64)
+    if weights.ndim > 1:
+        raise TypeError('weight must be scalar or one dimensional')
+    elif weights.ndim == 1:
+        if weights.shape[0] != indices.shape[0]:
+            raise TypeError('weights and values must be equal in length')
+        weights = weights.reshape(weights.shape + (1,)*(indices.ndim-1))
+    weights = numpy.broadcast_arrays(weights, indices)[0]
+
+    in_range = indices >= 0
+    occupied, inverse = numpy.unique(indices[in_range], return_inverse=True)
+    hist = numpy.bincount(inverse, weights=weights[in_range], minlength=len(occupied))
+    return occupied, hist
+
+def normhistnd_sparse(indices, hist, binbounds):
+    '''Normalize the sparse N-dimensional histogram ``hist`` (as returned by ``histnd_sparse``, with
+    flat bin indices ``indices``) with corresponding bin boundaries ``binbounds``, exactly as
+    ``normhistnd`` normalizes the equivalent dense histogram. Modifies ``hist`` in place and returns
+    the normalization factor used.'''
+
+    diffs = [numpy.diff(bb) for bb in binbounds]
+
+    if len(diffs) == 1:
+        normfac = (hist * diffs[0][indices]).sum()
+    else:
+        coords = numpy.unravel_index(indices, [len(delta) for delta in diffs])
+        volumes = diffs[0][coords[0]] * diffs[1][coords[1]]
+        for delta, coord in zip(diffs[2:], coords[2:]):
+            volumes *= delta[coord]
+        # Divide by bin volumes
+        hist /= volumes
+        normfac = hist.sum()
+
+    hist /= normfac
+    return normfac
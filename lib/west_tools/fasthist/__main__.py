@@ -5,7 +5,7 @@ Created on Jun 25, 2013
 '''
 
 import numpy
-from fasthist import histnd
+from fasthist import histnd, histnd_timeseries
 
 def _test_double(npts=1024*1024,loops=3):
     from time import time
@@ -101,4 +101,54 @@ def _test_uint(npts=1024*1024,ndim=3,loops=3):
     print 'theirs, best of {}: {}'.format(loops, min(theirs_times))
 
 
-_test_float(npts=1024*1024,ndim=1)
\ No newline at end of file
+def _bench_timeseries(nsegs=1000,ntimepoints=101,ndim=2,nbins=100,loops=3):
+    '''Compare histogramming all timepoints of one iteration's worth of data at once with
+    histnd_timeseries against looping over timepoints with histnd (as w_pdist once did).'''
+    from time import time
+    loop_times = [None]*loops
+    series_times = [None]*loops
+
+    binbounds = [numpy.linspace(0,1.0001,nbins+1) for x in xrange(ndim)]
+    weights = numpy.random.rand(nsegs)
+    for n in xrange(loops):
+        testdat = numpy.random.rand(nsegs,ntimepoints,ndim)
+        lstart = time()
+        looped = numpy.zeros((nbins,)*ndim, numpy.float64)
+        for ipt in xrange(ntimepoints):
+            histnd(testdat[:,ipt,:], binbounds, weights, out=looped, binbound_check=False)
+        lstop = time()
+        sstart = time()
+        series = histnd_timeseries(testdat, binbounds, weights, binbound_check=False)
+        sstop = time()
+        loop_times[n] = lstop-lstart
+        series_times[n] = sstop-sstart
+        print 'maximum absolute difference: {}'.format(numpy.abs(looped-series).max())
+
+    print 'per-timepoint histnd, best of {}: {}'.format(loops, min(loop_times))
+    print 'histnd_timeseries, best of {}:    {}'.format(loops, min(series_times))
+
+def _bench_threads(npts=4*1024*1024,ndim=3,nbins=50,loops=3,nthreads_list=(1,2,4,8)):
+    '''Compare histnd on one thread against histnd on several threads, with per-thread
+    accumulators and with deterministic (serial-order) accumulation.'''
+    from time import time
+
+    binbounds = [numpy.linspace(0,1.0001,nbins+1) for x in xrange(ndim)]
+    weights = numpy.random.rand(npts)
+    testdat = numpy.random.rand(npts,ndim)
+    serial = histnd(testdat, binbounds, weights, binbound_check=False)
+    for nthreads in nthreads_list:
+        for deterministic in (False, True):
+            times = [None]*loops
+            for n in xrange(loops):
+                start = time()
+                result = histnd(testdat, binbounds, weights, binbound_check=False,
+                                nthreads=nthreads, deterministic=deterministic)
+                times[n] = time()-start
+            print 'nthreads={}, deterministic={}: best of {}: {} (maximum absolute difference from serial: {})'\
+                  .format(nthreads, deterministic, loops, min(times), numpy.abs(result-serial).max())
+
+
+_test_float(npts=1024*1024,ndim=1)
+_bench_timeseries()
+_bench_timeseries(nsegs=100,ntimepoints=1001,ndim=1,nbins=10)
+_bench_threads()
\ No newline at end of file
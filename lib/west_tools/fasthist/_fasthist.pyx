@@ -18,6 +18,7 @@
 from __future__ import division
 import numpy, sys
 cimport numpy, cython
+from cython.parallel cimport prange, threadid
 from cpython.buffer cimport *
 from cpython.mem cimport *
 from numpy cimport * #PyArray_DATA, PyArray_TYPE
@@ -36,7 +37,8 @@ ctypedef fused real_numeric:
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cpdef histnd(values, binbounds, weights=1.0, out=None, binbound_check = True, ignore_out_of_range=False):
+cpdef histnd(values, binbounds, weights=1.0, out=None, binbound_check = True, ignore_out_of_range=False,
+             nthreads=1, deterministic=False):
     '''Generate an N-dimensional PDF (or contribution to a PDF) from the given values.
     ``binbounds`` is a list of arrays of boundary values, with one entry for each
     dimension (``values`` must have as many columns as there are entries in ``binbounds``)
@@ -45,6 +47,13 @@ cpdef histnd(values, binbounds, weights=1.0, out=None, binbound_check = True, ig
     the same length as ``values`` (for unequal weights). If ``binbound_check`` is True, then
     the boundaries are checked for strict positive monotonicity; set to False to shave a few
     microseconds if you know your bin boundaries to be monotonically increasing. 
+    
+    If ``nthreads`` is greater than one, points are binned in parallel on that many threads
+    (if compiled with OpenMP), each accumulating into a private histogram; these are then
+    added together in thread order, so that results are reproducible for a given number of
+    threads, but may differ from serial results by rounding. If ``deterministic`` is true, bins
+    are located in parallel but weights are accumulated serially, in order of points, so that
+    results are identical to serial results regardless of the number of threads.
     '''
     
     if values.ndim != 2:
@@ -96,6 +105,12 @@ cpdef histnd(values, binbounds, weights=1.0, out=None, binbound_check = True, ig
     elif  _weights.shape[0] != values.shape[0]:
         raise TypeError('weights and values must be equal in length')
     
+    if nthreads > 1:
+        return _histnd_threaded(values[:,numpy.newaxis,:], _binbounds_vectors, _nbounds, _weights,
+                                ignore_out_of_range, _out, nthreads, deterministic, True)
+    elif nthreads < 1:
+        raise ValueError('at least one thread is required')
+    
     # ugh
     if typecode == NPY_FLOAT32:      
         return _histnd[numpy.float32_t](values,
@@ -236,3 +251,382 @@ cdef _histnd(real_numeric[:,:] values, object[:] binbounds, numpy.uint32_t* nbou
         PyBuffer_Release(&outputview)
 
 
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef histnd_timeseries(values, binbounds, weights=1.0, out=None, binbound_check = True, ignore_out_of_range=False,
+                        nthreads=1, deterministic=False):
+    '''Generate an N-dimensional PDF (or contribution to a PDF) from every timepoint of the given
+    per-segment data, in a single pass. ``values`` must be indexable as [segment][timepoint][dimension],
+    and ``weights`` specifies the weight of each segment (contributed by each of its timepoints); this
+    may be a scalar or a vector with one entry per segment. The result is that of calling ``histnd``
+    on each timepoint of ``values`` in turn with the same ``weights``, and the remaining arguments
+    (including ``nthreads`` and ``deterministic``) are as for ``histnd``.
+    '''
+
+    values = numpy.asanyarray(values)
+    if values.ndim != 3:
+        raise TypeError('values must be 3-D')
+
+    cdef:
+        Py_ssize_t nsegs = values.shape[0]
+        Py_ssize_t ndim = values.shape[2]
+
+    if len(binbounds) != ndim:
+        raise ValueError('number of sets of bin boundaries ({}) does not match dimensionality of data ({})'
+                         .format(len(binbounds), ndim))
+
+    if binbound_check:
+        for idim in xrange(ndim):
+            dq = numpy.diff(binbounds[idim])
+            if (dq <= 0).any():
+                raise ValueError('binbounds in dimension {} are not strictly monotonically increasing'.format(idim))
+
+    # Prepare bin boundaries arrays
+    _binbounds_vectors = numpy.empty((ndim,), numpy.object_)
+    _nbounds   = numpy.empty((ndim,), numpy.uint32)
+    for idim in range(ndim):
+        _binbounds = numpy.require(binbounds[idim], values.dtype, 'C')
+        _binbounds_vectors[idim] = _binbounds
+        _nbounds[idim] = _binbounds.shape[0]
+
+    # Prepare output array, if necessary
+    if out is None:
+        _out = numpy.zeros([len(boundset)-1 for boundset in binbounds], numpy.float64)
+    else:
+        _out = out
+        if _out.dtype != numpy.float64:
+            raise TypeError('type of output array must be float64')
+        if not _out.flags.writeable:
+            raise TypeError('output is not writeable')
+
+    # Prepare weight array
+    _weights = numpy.require(weights, numpy.float64, 'C')
+    if _weights.shape == ():
+        # scalar
+        _weights = numpy.empty((nsegs,), numpy.float64)
+        _weights[:] = weights
+    elif _weights.ndim > 1:
+        raise TypeError('weight must be scalar or one dimensional')
+    elif _weights.shape[0] != nsegs:
+        raise TypeError('weights and values must be equal in length')
+
+    if PyArray_TYPE(values) not in (NPY_FLOAT32, NPY_FLOAT64, NPY_INT8, NPY_INT16, NPY_INT32, NPY_INT64,
+                                    NPY_UINT8, NPY_UINT16, NPY_UINT32, NPY_UINT64):
+        raise TypeError('real floating-point or integer input required')
+
+    if nthreads > 1:
+        return _histnd_threaded(values, _binbounds_vectors, _nbounds, _weights, ignore_out_of_range, _out,
+                                nthreads, deterministic, False)
+    elif nthreads < 1:
+        raise ValueError('at least one thread is required')
+
+    # dispatches on the type of values
+    _histnd_timeseries(values, _binbounds_vectors, _nbounds, _weights, ignore_out_of_range, _out)
+    return _out
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _histnd_timeseries(real_numeric[:,:,:] values, object[:] binbounds, numpy.uint32_t[:] nbounds, double[:] weights,
+                       bint ignore_out_of_range, object output):
+    '''Bin the values stored in the 3-D array ``values`` (indexed as [segment][timepoint][dimension])
+    into the array of bins ``output``, with each timepoint of segment ``i`` contributing ``weights[i]``.
+    Bins are located by bisection, so that the cost per value grows only logarithmically with the
+    number of bins.
+
+    Pre-conditions are as for ``_histnd``, with ``nbounds`` and ``weights`` as memoryviews.
+    '''
+
+    cdef:
+        Py_buffer outputview, bbview
+        Py_ssize_t nsegs = values.shape[0], ntimepoints = values.shape[1], ndim = values.shape[2]
+        Py_ssize_t iseg, ipt, idim, lo, hi, mid
+        char* outptr_bytes
+        double weight
+        real_numeric val
+        real_numeric* bounds
+        real_numeric** _binbounds
+        bint store_value
+
+    # Get pointers to the (contiguous) lists of bin boundaries in each dimension
+    _binbounds = <real_numeric**> PyMem_Malloc(ndim*sizeof(real_numeric*))
+    if not _binbounds:
+        raise MemoryError()
+    for idim in range(ndim):
+        PyObject_GetBuffer(binbounds[idim], &bbview, PyBUF_SIMPLE)
+        _binbounds[idim] = <real_numeric*> bbview.buf
+        PyBuffer_Release(&bbview)
+
+    # Get a view of our output array, so we can write directly into it
+    PyObject_GetBuffer(output, &outputview, PyBUF_STRIDED)
+
+    try:
+        with nogil:
+            for iseg in range(nsegs):
+                weight = weights[iseg]
+                for ipt in range(ntimepoints):
+                    outptr_bytes = <char*> outputview.buf
+                    store_value = True
+                    for idim in range(ndim):
+                        val = values[iseg,ipt,idim]
+                        bounds = _binbounds[idim]
+                        hi = nbounds[idim] - 1
+                        if not (val >= bounds[0] and val < bounds[hi]):
+                            if not ignore_out_of_range:
+                                with gil:
+                                    raise ValueError('value {} at segment {}, timepoint {} out of bin boundaries in dimension {}'
+                                                     .format(val,iseg,ipt,idim))
+                            store_value = False
+                            break
+
+                        # find lo such that bounds[lo] <= val < bounds[lo+1]
+                        lo = 0
+                        while hi - lo > 1:
+                            mid = lo + ((hi - lo) >> 1)
+                            if val >= bounds[mid]:
+                                lo = mid
+                            else:
+                                hi = mid
+                        outptr_bytes += outputview.strides[idim] * lo
+                    if store_value:
+                        (<double*> outptr_bytes)[0] += weight
+        return output
+    finally:
+        PyMem_Free(_binbounds)
+        PyBuffer_Release(&outputview)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef flat_bin_indices(values, binbounds, binbound_check = True, ignore_out_of_range=False, nthreads=1):
+    '''Return the index of the bin containing each point in ``values``, which may be indexed as
+    [point][dimension] (as for ``histnd``) or [segment][timepoint][dimension] (as for
+    ``histnd_timeseries``). Indices are into the flattened (C-ordered) array of bins, and the
+    result has the shape of ``values`` without its last axis. Points out of range are assigned
+    index -1 if ``ignore_out_of_range`` is true, and raise ValueError otherwise. Points are
+    located in parallel on ``nthreads`` threads (if compiled with OpenMP).
+    '''
+
+    values = numpy.asanyarray(values)
+    if values.ndim == 2:
+        values3d = values[numpy.newaxis,:,:]
+    elif values.ndim == 3:
+        values3d = values
+    else:
+        raise TypeError('values must be 2-D or 3-D')
+
+    cdef Py_ssize_t ndim = values3d.shape[2]
+
+    if len(binbounds) != ndim:
+        raise ValueError('number of sets of bin boundaries ({}) does not match dimensionality of data ({})'
+                         .format(len(binbounds), ndim))
+
+    if binbound_check:
+        for idim in xrange(ndim):
+            dq = numpy.diff(binbounds[idim])
+            if (dq <= 0).any():
+                raise ValueError('binbounds in dimension {} are not strictly monotonically increasing'.format(idim))
+
+    if nthreads < 1:
+        raise ValueError('at least one thread is required')
+
+    _binbounds_vectors = numpy.empty((ndim,), numpy.object_)
+    _nbounds   = numpy.empty((ndim,), numpy.uint32)
+    for idim in range(ndim):
+        _binbounds = numpy.require(binbounds[idim], values.dtype, 'C')
+        _binbounds_vectors[idim] = _binbounds
+        _nbounds[idim] = _binbounds.shape[0]
+
+    if PyArray_TYPE(values) not in (NPY_FLOAT32, NPY_FLOAT64, NPY_INT8, NPY_INT16, NPY_INT32, NPY_INT64,
+                                    NPY_UINT8, NPY_UINT16, NPY_UINT32, NPY_UINT64):
+        raise TypeError('real floating-point or integer input required')
+
+    indices = numpy.empty(numpy.shape(values3d)[:2], numpy.int64)
+    _flat_bin_indices(values3d, _binbounds_vectors, _nbounds, _flat_strides(_nbounds), indices, nthreads)
+    if not ignore_out_of_range:
+        _check_in_range(values3d, _binbounds_vectors, indices, False)
+    return indices.reshape(numpy.shape(values)[:values.ndim-1])
+
+def _flat_strides(nbounds):
+    '''Return the strides (in bins) of the flattened (C-ordered) array of bins with ``nbounds``
+    boundaries in each dimension.'''
+    strides = numpy.empty((len(nbounds),), numpy.int64)
+    if len(nbounds):
+        strides[len(nbounds)-1] = 1
+        for idim in range(len(nbounds)-2, -1, -1):
+            strides[idim] = strides[idim+1] * (nbounds[idim+1] - 1)
+    return strides
+
+def _check_in_range(values3d, binbounds, indices, pointwise):
+    '''Raise ValueError for the first point of ``values3d`` found out of range (with flat bin
+    index -1), if any, reporting it by index if ``pointwise`` is true (as for ``histnd``) or by
+    segment and timepoint otherwise.'''
+    out_of_range = (indices < 0).ravel()
+    if not out_of_range.any():
+        return
+    iseg, ipt = numpy.unravel_index(numpy.argmax(out_of_range), indices.shape)
+    for idim in xrange(len(binbounds)):
+        val = values3d[iseg,ipt,idim]
+        if not (val >= binbounds[idim][0] and val < binbounds[idim][len(binbounds[idim])-1]):
+            break
+    if pointwise:
+        raise ValueError('value {} at index {} out of bin boundaries in dimension {}'.format(val,iseg,idim))
+    else:
+        raise ValueError('value {} at segment {}, timepoint {} out of bin boundaries in dimension {}'
+                         .format(val,iseg,ipt,idim))
+
+def _histnd_threaded(values3d, binbounds, nbounds, weights, ignore_out_of_range, output, nthreads, deterministic,
+                     pointwise):
+    '''Bin the values stored in the 3-D array ``values3d`` (indexed as [segment][timepoint][dimension])
+    into ``output`` on ``nthreads`` threads, with each timepoint of segment ``i`` contributing
+    ``weights[i]``. See ``histnd`` for the meaning of ``deterministic``, and ``_check_in_range`` for
+    that of ``pointwise``. Arguments are as prepared by ``histnd`` and ``histnd_timeseries``.'''
+
+    shape = tuple(int(nbound) - 1 for nbound in nbounds)
+    nbins = numpy.multiply.reduce(shape, dtype=numpy.int64)
+    if output.shape != shape:
+        raise ValueError('output array has shape {}, but bin boundaries require {}'.format(output.shape, shape))
+    strides = _flat_strides(nbounds)
+
+    if deterministic:
+        indices = numpy.empty(values3d.shape[:2], numpy.int64)
+        _flat_bin_indices(values3d, binbounds, nbounds, strides, indices, nthreads)
+        if not ignore_out_of_range:
+            _check_in_range(values3d, binbounds, indices, pointwise)
+    else:
+        partials = numpy.zeros((nthreads, nbins), numpy.float64)
+        n_out_of_range = _histnd_partials(values3d, binbounds, nbounds, strides, weights, partials, nthreads)
+        if n_out_of_range and not ignore_out_of_range:
+            indices = numpy.empty(values3d.shape[:2], numpy.int64)
+            _flat_bin_indices(values3d, binbounds, nbounds, strides, indices, nthreads)
+            _check_in_range(values3d, binbounds, indices, pointwise)
+
+    # Accumulate into a contiguous (flat) view of the output, or a copy if necessary
+    copy_output = not output.flags.c_contiguous
+    flat_output = numpy.ascontiguousarray(output).reshape((nbins,))
+
+    if deterministic:
+        _accumulate_indices(indices, weights, flat_output)
+    else:
+        for ithread in xrange(nthreads):
+            flat_output += partials[ithread]
+
+    if copy_output:
+        output[...] = flat_output.reshape(shape)
+    return output
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline numpy.int64_t _locate_bin(char* point, Py_ssize_t stride, Py_ssize_t ndim, real_numeric** binbounds,
+                                      numpy.uint32_t* nbounds, numpy.int64_t* strides) nogil:
+    # Return the flat index of the bin containing the point with coordinates stored every ``stride``
+    # bytes from ``point``, or -1 if it lies out of range, locating bins by bisection
+    cdef:
+        Py_ssize_t idim, lo, hi, mid
+        numpy.int64_t index = 0
+        real_numeric val
+        real_numeric* bounds
+
+    for idim in range(ndim):
+        val = (<real_numeric*> (point + idim*stride))[0]
+        bounds = binbounds[idim]
+        hi = nbounds[idim] - 1
+        if not (val >= bounds[0] and val < bounds[hi]):
+            return -1
+
+        # find lo such that bounds[lo] <= val < bounds[lo+1]
+        lo = 0
+        while hi - lo > 1:
+            mid = lo + ((hi - lo) >> 1)
+            if val >= bounds[mid]:
+                lo = mid
+            else:
+                hi = mid
+        index += strides[idim] * lo
+    return index
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def _flat_bin_indices(real_numeric[:,:,:] values, object[:] binbounds, numpy.uint32_t[::1] nbounds,
+                      numpy.int64_t[::1] strides, numpy.int64_t[:,:] indices, int nthreads):
+    '''Store in ``indices`` the flat index of the bin containing each point of the 3-D array ``values``,
+    or -1 for points out of range, on ``nthreads`` threads.'''
+
+    cdef:
+        Py_buffer bbview
+        Py_ssize_t nsegs = values.shape[0], ntimepoints = values.shape[1], ndim = values.shape[2]
+        Py_ssize_t ipoint, iseg, ipt, idim
+        real_numeric** _binbounds
+
+    _binbounds = <real_numeric**> PyMem_Malloc(ndim*sizeof(real_numeric*))
+    if not _binbounds:
+        raise MemoryError()
+    for idim in range(ndim):
+        PyObject_GetBuffer(binbounds[idim], &bbview, PyBUF_SIMPLE)
+        _binbounds[idim] = <real_numeric*> bbview.buf
+        PyBuffer_Release(&bbview)
+
+    try:
+        with nogil:
+            for ipoint in prange(nsegs*ntimepoints, num_threads=nthreads, schedule='static'):
+                iseg = ipoint // ntimepoints
+                ipt = ipoint - iseg*ntimepoints
+                indices[iseg,ipt] = _locate_bin(<char*> &values[iseg,ipt,0], values.strides[2], ndim, _binbounds,
+                                                &nbounds[0], &strides[0])
+    finally:
+        PyMem_Free(_binbounds)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def _histnd_partials(real_numeric[:,:,:] values, object[:] binbounds, numpy.uint32_t[::1] nbounds,
+                     numpy.int64_t[::1] strides, double[::1] weights, double[:,::1] partials, int nthreads):
+    '''Bin the points of the 3-D array ``values`` on ``nthreads`` threads, with each thread adding
+    the weights of the points it bins into its own row of ``partials`` (indexed by flat bin index).
+    Each thread bins a contiguous run of points. Returns the number of points out of range.'''
+
+    cdef:
+        Py_buffer bbview
+        Py_ssize_t nsegs = values.shape[0], ntimepoints = values.shape[1], ndim = values.shape[2]
+        Py_ssize_t ipoint, iseg, ipt, idim, n_out_of_range = 0
+        numpy.int64_t index
+        real_numeric** _binbounds
+
+    _binbounds = <real_numeric**> PyMem_Malloc(ndim*sizeof(real_numeric*))
+    if not _binbounds:
+        raise MemoryError()
+    for idim in range(ndim):
+        PyObject_GetBuffer(binbounds[idim], &bbview, PyBUF_SIMPLE)
+        _binbounds[idim] = <real_numeric*> bbview.buf
+        PyBuffer_Release(&bbview)
+
+    try:
+        with nogil:
+            for ipoint in prange(nsegs*ntimepoints, num_threads=nthreads, schedule='static'):
+                iseg = ipoint // ntimepoints
+                ipt = ipoint - iseg*ntimepoints
+                index = _locate_bin(<char*> &values[iseg,ipt,0], values.strides[2], ndim, _binbounds,
+                                    &nbounds[0], &strides[0])
+                if index >= 0:
+                    partials[threadid(),index] += weights[iseg]
+                else:
+                    n_out_of_range += 1
+        return n_out_of_range
+    finally:
+        PyMem_Free(_binbounds)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _accumulate_indices(numpy.int64_t[:,:] indices, double[::1] weights, double[::1] output):
+    '''Add ``weights[i]`` to ``output[indices[i,j]]`` for every non-negative entry of ``indices``, in order.'''
+    cdef:
+        Py_ssize_t iseg, ipt
+        numpy.int64_t index
+
+    with nogil:
+        for iseg in range(indices.shape[0]):
+            for ipt in range(indices.shape[1]):
+                index = indices[iseg,ipt]
+                if index >= 0:
+                    output[index] += weights[iseg]
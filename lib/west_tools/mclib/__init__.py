@@ -21,7 +21,8 @@ statistics.'''
 from __future__ import print_function, division
 import math, numpy
 
-from _mclib import autocorrel_elem, mcbs_correltime, get_bssize, mcbs_ci #@UnresolvedImport
+from _mclib import (autocorrel_elem, autocorrel_fft, mcbs_correltime, mcbs_correltime_multi, #@UnresolvedImport
+                    get_bssize, mcbs_ci)
 
 def mcbs_ci_correl(dataset, estimator, alpha, n_sets=None, args=None, kwargs=None,
                    autocorrel_alpha = None, autocorrel_n_sets=None, subsample=None):
@@ -93,3 +94,121 @@ def mcbs_ci_correl(dataset, estimator, alpha, n_sets=None, args=None, kwargs=Non
             decim_set[iout] = subsample(sl)
         
         return mcbs_ci(decim_set, estimator, alpha, n_sets, args, kwargs, numpy.msort) + (correl_len,)
+
+def mcbs_ci_correl_multi(datasets, alpha, n_sets=None, autocorrel_alpha=None, autocorrel_n_sets=None,
+                         subsample=None, estimator=numpy.mean):
+    '''Perform a correlated-data Monte Carlo bootstrap, as does `mcbs_ci_correl`_, on each column
+    of the two-dimensional array ``datasets`` at once. Correlation times of all columns are estimated
+    from the same resampling indices. Each column is then decimated according to its own correlation
+    time, and all columns sharing a correlation time are bootstrapped together, with the same synthetic
+    data set indices. Estimates are those of ``estimator`` applied to the full (undecimated) columns.
+    
+    ``estimator`` must reduce along an ``axis`` keyword argument, as ``numpy.mean`` and
+    ``numpy.median`` do. ``subsample``, if given, is called as ``subsample(block, axis=1)`` on an
+    array of shape ``(n_blocks, stride, n_columns)``; otherwise a random entry from each correlated
+    block is used, as for `mcbs_ci_correl`_.
+    
+    Returns ``(estimates, ci_lbs, ci_ubs, correl_times)``, each an array with one entry per column.'''
+    
+    if alpha > 0.5:
+        raise ValueError('alpha ({}) > 0.5'.format(alpha))
+    
+    autocorrel_alpha = alpha if not autocorrel_alpha else autocorrel_alpha
+    
+    datasets = numpy.asanyarray(datasets)
+    if datasets.ndim != 2:
+        raise ValueError('datasets must be two-dimensional')
+    dlen, ncols = datasets.shape
+    n_sets = n_sets or get_bssize(alpha)
+    autocorrel_n_sets = autocorrel_n_sets or get_bssize(autocorrel_alpha)
+    
+    estimates = estimator(datasets, axis=0)
+    # too correlated for meaningful calculations
+    ci_lbs = datasets.min(axis=0)
+    ci_ubs = datasets.max(axis=0)
+    
+    correl_times = mcbs_correltime_multi(datasets, autocorrel_alpha, autocorrel_n_sets)
+    uncorrelated = correl_times < dlen
+    if not uncorrelated.any():
+        return estimates, ci_lbs, ci_ubs, correl_times
+    
+    for correl_time in numpy.unique(correl_times[uncorrelated]):
+        cols = correl_times == correl_time
+        ci_lbs[cols], ci_ubs[cols] = _mcbs_ci_decimated(datasets[:,cols], correl_time+1, alpha, n_sets,
+                                                        subsample, estimator)
+    
+    return estimates, ci_lbs, ci_ubs, correl_times
+
+def _mcbs_ci_decimated(datasets, stride, alpha, n_sets, subsample, estimator):
+    # Decimate each column of datasets with the given stride, then bootstrap all columns with the
+    # same synthetic data set indices; returns (ci_lbs, ci_ubs)
+    dlen = len(datasets)
+    if stride == 1:
+        decim_sets = datasets
+    else:
+        n_slices = dlen // stride
+        blocks = datasets[:n_slices*stride].reshape(n_slices, stride, -1)
+        if subsample is not None:
+            decim_sets = subsample(blocks, axis=1)
+        else:
+            decim_sets = blocks[numpy.arange(n_slices),numpy.random.randint(stride, size=(n_slices,))]
+    
+    n_slices = len(decim_sets)
+    synth_estimates = numpy.empty((n_sets,decim_sets.shape[1]), dtype=numpy.result_type(decim_sets, numpy.float64))
+    block_sets = max(1, 4*1024*1024 // max(1,decim_sets.size))
+    for i in xrange(0, n_sets, block_sets):
+        iub = min(n_sets, i+block_sets)
+        indices = numpy.random.randint(n_slices, size=(iub-i,n_slices))
+        synth_estimates[i:iub] = estimator(decim_sets[indices], axis=1)
+        del indices
+    synth_estimates.sort(axis=0)
+    lbi = int(math.floor(n_sets*alpha/2.0))
+    ubi = int(math.ceil(n_sets*(1-alpha/2.0)))
+    return synth_estimates[lbi], synth_estimates[ubi]
+
+def mcbs_ci_correl_windows(dataset, windows, alpha, n_sets=None, autocorrel_alpha=None, autocorrel_n_sets=None,
+                           subsample=None, estimator=numpy.mean):
+    '''Perform a correlated-data Monte Carlo bootstrap, as does `mcbs_ci_correl_multi`_, on each column
+    of the two-dimensional array ``dataset`` within each of the given ``windows``, a sequence of
+    ``(start, stop)`` row ranges. The work is batched: the columns of all windows of the same length
+    are passed to `mcbs_ci_correl_multi`_ together, so that their correlation times are estimated at
+    once, and those sharing a correlation time are bootstrapped together. Estimates are those of
+    ``estimator`` applied to the full (undecimated) window, as for `mcbs_ci_correl_multi`_.
+    
+    ``estimator`` and ``subsample`` are as for `mcbs_ci_correl_multi`_.
+    
+    Returns ``(estimates, ci_lbs, ci_ubs, correl_times)``, each an array of shape
+    ``(len(windows), n_columns)``.'''
+    
+    if alpha > 0.5:
+        raise ValueError('alpha ({}) > 0.5'.format(alpha))
+    
+    dataset = numpy.asanyarray(dataset)
+    if dataset.ndim != 2:
+        raise ValueError('dataset must be two-dimensional')
+    ncols = dataset.shape[1]
+    windows = [(int(start), int(stop)) for (start, stop) in windows]
+    
+    estimates = numpy.empty((len(windows), ncols), dtype=dataset.dtype)
+    ci_lbs = numpy.empty_like(estimates)
+    ci_ubs = numpy.empty_like(estimates)
+    correl_times = numpy.empty((len(windows), ncols), dtype=numpy.int64)
+    
+    by_length = {}
+    for iwindow, (start, stop) in enumerate(windows):
+        if not 0 <= start < stop <= len(dataset):
+            raise ValueError('invalid window ({}, {})'.format(start, stop))
+        by_length.setdefault(stop-start, []).append(iwindow)
+    
+    for _dlen, iwindows in sorted(by_length.iteritems()):
+        # columns of datasets are those of each window in turn
+        datasets = numpy.hstack([dataset[windows[iwindow][0]:windows[iwindow][1]] for iwindow in iwindows])
+        w_estimates, w_ci_lbs, w_ci_ubs, w_correl_times = mcbs_ci_correl_multi(datasets, alpha, n_sets, autocorrel_alpha,
+                                                                               autocorrel_n_sets, subsample, estimator)
+        
+        estimates[iwindows] = w_estimates.reshape(len(iwindows), ncols)
+        ci_lbs[iwindows] = w_ci_lbs.reshape(len(iwindows), ncols)
+        ci_ubs[iwindows] = w_ci_ubs.reshape(len(iwindows), ncols)
+        correl_times[iwindows] = w_correl_times.reshape(len(iwindows), ncols)
+    
+    return estimates, ci_lbs, ci_ubs, correl_times
@@ -38,6 +38,17 @@ ctypedef fused _fptype:
 # which will almost certainly become the rate-limiting step of the
 # calculation.
 cdef Py_ssize_t CORRELTIME_CROSSOVER = 512*1024*1024
+
+# Maximum number of elements in the block of synthetic data sets generated at once
+# when bootstrapping with an estimator that can be applied to many data sets in a
+# single call (see ``_vectorized_estimators``).  This limits the RAM used by the
+# resampled data and their indices to roughly 16 bytes times this value.
+cdef Py_ssize_t MCBS_BLOCK_ELEMS = 4*1024*1024
+
+# Estimators which can be applied to a stack of synthetic data sets (one per row)
+# at once; maps estimator to a function of (synth_sets) returning one estimate per row
+_vectorized_estimators = {numpy.mean: lambda synth_sets: synth_sets.mean(axis=1),
+                          numpy.median: lambda synth_sets: numpy.median(synth_sets, axis=1)}
     
 
 @cython.cdivision(True)
@@ -83,6 +94,31 @@ cpdef autocorrel_elem(xs, k):
     else:
         raise TypeError('unsupported type')
     
+cpdef autocorrel_fft(xs, maxlag=None):
+    '''Calculate the sample autocorrelation of ``xs`` at lags 0 through ``maxlag`` (by default, all
+    lags), as would ``autocorrel_elem``, but for all lags at once using FFTs. If ``xs`` is
+    two-dimensional, the autocorrelation of each row is calculated. Returns an array of shape
+    ``xs.shape[:-1] + (maxlag+1,)``.'''
+    
+    xs = numpy.asarray(xs, dtype=numpy.float64)
+    N = xs.shape[-1]
+    maxlag = N-1 if maxlag is None else min(maxlag, N-1)
+    
+    # zero-pad to at least twice the length of the data to avoid circular correlation
+    nfft = 1
+    while nfft < 2*N:
+        nfft *= 2
+        
+    deviations = xs - xs.mean(axis=-1)[...,numpy.newaxis]
+    spectrum = numpy.fft.rfft(deviations, n=nfft, axis=-1)
+    power = spectrum.real**2 + spectrum.imag**2
+    del spectrum
+    autocov = numpy.fft.irfft(power, n=nfft, axis=-1)[...,:maxlag+1]
+    
+    lags = numpy.arange(maxlag+1)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return autocov * (N / ((N - lags) * autocov[...,:1]))
+    
 cpdef Py_ssize_t get_bssize(double alpha) nogil:
     '''Return a bootstrap data set size appropriate for the given confidence level.'''
     
@@ -115,6 +151,9 @@ cpdef mcbs_ci(dataset, estimator, alpha, n_sets=None, args=None, kwargs=None, so
     ``sort`` can be used
     to override the sorting routine used to calculate the confidence interval, which should
     only be necessary for estimators returning vectors rather than scalars.    
+    
+    For ``numpy.mean`` and ``numpy.median`` (without additional arguments) on one-dimensional
+    data, synthetic data sets are generated and evaluated many at a time, rather than one by one.
     '''
     
     if alpha > 0.5:
@@ -141,10 +180,26 @@ cpdef mcbs_ci(dataset, estimator, alpha, n_sets=None, args=None, kwargs=None, so
 
     f_synth = numpy.empty((n_sets,) + estimator_shape, dtype=estimator_dtype)
     
-    for i in xrange(n_sets):
-        indices = numpy.random.randint(dlen, size=(dlen,))
-        f_synth[i] = estimator(numpy.take(dataset,indices), *args, **kwargs)
-        del indices
+    try:
+        vectorized_estimator = _vectorized_estimators.get(estimator) if not (args or kwargs) else None
+    except TypeError:
+        # unhashable estimator
+        vectorized_estimator = None
+    
+    if vectorized_estimator is not None and dataset.ndim == 1:
+        # Generate and evaluate synthetic data sets in blocks; this draws the same
+        # random numbers in the same order as the loop below
+        block_sets = max(1, MCBS_BLOCK_ELEMS // max(1,dlen))
+        for i in xrange(0, n_sets, block_sets):
+            iub = min(n_sets, i+block_sets)
+            indices = numpy.random.randint(dlen, size=(iub-i,dlen))
+            f_synth[i:iub] = vectorized_estimator(numpy.take(dataset,indices))
+            del indices
+    else:
+        for i in xrange(n_sets):
+            indices = numpy.random.randint(dlen, size=(dlen,))
+            f_synth[i] = estimator(numpy.take(dataset,indices), *args, **kwargs)
+            del indices
         
     f_synth_sorted = sort(f_synth)
     lbi = int(math.floor(n_sets*alpha/2.0))
@@ -170,7 +225,7 @@ cpdef mcbs_correltime(dataset, alpha, n_sets = None):
     if dataset.nbytes * n_sets > CORRELTIME_CROSSOVER:
         return mcbs_correltime_fullauto(dataset, alpha, n_sets)
     else:
-        return mcbs_correltime_small(dataset, alpha, n_sets)
+        return mcbs_correltime_fft(dataset, alpha, n_sets)
 
 cpdef mcbs_correltime_fullauto(dataset, alpha, n_sets):
     '''Specialization of `mcbs_correltime`_ for large datasets, where rather than generating
@@ -186,6 +241,92 @@ cpdef mcbs_correltime_fullauto(dataset, alpha, n_sets):
         return len(dataset)
         #raise ValueError('correlation length exceeds half the data set length')
 
+cpdef mcbs_correltime_fft(dataset, alpha, n_sets, direct_lags=64):
+    '''Specialization of `mcbs_correltime`_ for small-to-medium datasets, in which ``n_sets``
+    synthetic datasets are generated and stored (as for `mcbs_correltime_small`_, and with the
+    same results). The first ``direct_lags`` autocorrelation elements are evaluated one at a 
+    time; if the data remain correlated beyond that, the autocorrelation functions of all
+    synthetic data sets are calculated for all remaining lags at once by FFT, in O(N log N) rather
+    than O(N) time per lag.'''
+    
+    if alpha > 0.5:
+        raise ValueError('alpha ({}) > 0.5'.format(alpha))    
+    
+    dlen = len(dataset)
+    synth_sets = numpy.empty((n_sets,)+dataset.shape, dtype=dataset.dtype)
+    for i in xrange(n_sets):
+        synth_sets[i] = numpy.take(dataset,numpy.random.randint(dlen,size=(dlen,)))
+    
+    return _correltime_synth(dataset, synth_sets, alpha, direct_lags)
+
+cpdef mcbs_correltime_multi(datasets, alpha, n_sets = None):
+    '''Calculate the correlation time of each column of the two-dimensional array ``datasets``,
+    as would `mcbs_correltime`_ for each column separately, but drawing one set of random
+    resampling indices for all columns. Returns an integer array of correlation times.'''
+    
+    if alpha > 0.5:
+        raise ValueError('alpha ({}) > 0.5'.format(alpha))    
+    
+    datasets = numpy.asanyarray(datasets)
+    dlen, ncols = datasets.shape
+    n_sets = n_sets or get_bssize(alpha)
+    correl_times = numpy.empty((ncols,), numpy.int_)
+    
+    if 8 * dlen * n_sets > CORRELTIME_CROSSOVER:
+        for icol in xrange(ncols):
+            correl_times[icol] = mcbs_correltime_fullauto(datasets[:,icol], alpha, n_sets)
+        return correl_times
+    
+    # the same random numbers as one call to mcbs_correltime_fft
+    indices = numpy.random.randint(dlen, size=(n_sets, dlen))
+    for icol in xrange(ncols):
+        dataset = numpy.ascontiguousarray(datasets[:,icol])
+        correl_times[icol] = _correltime_synth(dataset, numpy.take(dataset, indices), alpha)
+    return correl_times
+
+def _correltime_synth(dataset, synth_sets, alpha, direct_lags=64):
+    n_sets, dlen = synth_sets.shape
+    lbi = int(math.floor(n_sets*alpha/2.0))
+    ubi = int(math.ceil(n_sets*(1-alpha/2.0)))
+    synth_acf_elems = numpy.empty((n_sets,), numpy.float64)
+    
+    # Correlation times are usually short, and for only a few lags, direct evaluation
+    # is faster than FFT
+    for k in xrange(1,min(dlen//2, direct_lags+1)):
+        data_rho = autocorrel_elem(dataset, k)
+        
+        for i in xrange(n_sets):
+            synth_acf_elems[i] = autocorrel_elem(synth_sets[i],k)
+            
+        synth_acf_elems.sort()
+        
+        if data_rho > synth_acf_elems[lbi] and data_rho < synth_acf_elems[ubi]:
+            return k-1
+    
+    maxlag = dlen//2 - 1
+    if maxlag <= direct_lags:
+        return len(dataset)
+        
+    data_rho = autocorrel_fft(dataset, maxlag)
+    synth_rho = numpy.empty((n_sets, maxlag+1), numpy.float64)
+    block_sets = max(1, MCBS_BLOCK_ELEMS // dlen)
+    for i in xrange(0, n_sets, block_sets):
+        iub = min(n_sets, i+block_sets)
+        synth_rho[i:iub] = autocorrel_fft(synth_sets[i:iub], maxlag)
+    del synth_sets
+    
+    # Examine the remaining lags in blocks, stopping at the first at which the autocorrelation
+    # of the data is within the confidence interval of the synthetic autocorrelations
+    for klb in xrange(direct_lags+1, maxlag+1, 64):
+        kub = min(maxlag+1, klb+64)
+        synth_block = numpy.partition(synth_rho[:,klb:kub], (lbi,ubi), axis=0)
+        uncorrelated = numpy.flatnonzero((data_rho[klb:kub] > synth_block[lbi]) 
+                                         & (data_rho[klb:kub] < synth_block[ubi]))
+        if len(uncorrelated):
+            return klb + uncorrelated[0] - 1
+    else:
+        return len(dataset)
+
 cpdef mcbs_correltime_small(dataset, alpha, n_sets):
     '''Specialization of `mcbs_correltime`_ for small-to-mediam datasets, where ``n_sets``
     synthetic datasets are generated and stored, and then autocorrelation elements
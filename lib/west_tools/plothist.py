@@ -32,6 +32,9 @@ log = logging.getLogger('westtools.plothist')
 # Suppress divide-by-zero in log
 numpy.seterr(divide='ignore', invalid='ignore')
 
+# Maximum number of sparse histogram entries to read at once
+sparse_block_length = 4*1024*1024
+
 def sum_except_along(array, axes):
     '''Reduce the given array by addition over all axes except those listed in the scalar or 
     iterable ``axes``'''
@@ -54,6 +57,23 @@ def sum_except_along(array, axes):
         
     return array
 
+def sum_except_along_sparse(indices, values, shape, axes):
+    '''Reduce the sparse histogram of the given ``values`` at flat (C-ordered) bin ``indices``
+    of a histogram of shape ``shape`` by addition over all axes except those listed in the scalar
+    or iterable ``axes``, as for ``sum_except_along``. Returns a dense array; the full histogram
+    is never constructed.'''
+
+    try:
+        iter(axes)
+    except TypeError:
+        axes = [axes]
+
+    coords = numpy.unravel_index(numpy.asarray(indices, dtype=numpy.int64), shape)
+    kept_shape = [shape[axis] for axis in axes]
+    kept_indices = numpy.ravel_multi_index([coords[axis] for axis in axes], kept_shape)
+    kept_size = numpy.multiply.reduce(kept_shape)
+    return numpy.bincount(kept_indices, weights=values, minlength=kept_size).reshape(kept_shape)
+
 class PlotHistBase(WESTSubcommand):
     def __init__(self, parent):
         super(PlotHistBase,self).__init__(parent)
@@ -167,6 +187,14 @@ class PlotHistBase(WESTSubcommand):
         else:
             self.enerzero = 'min'
 
+        # Histograms may be stored densely (as a dataset) or sparsely (as a group); see w_pdist --help
+        histograms = self.input_h5['histograms']
+        self.sparse = isinstance(histograms, h5py.Group)
+        if self.sparse:
+            self.hist_shape = tuple(histograms.attrs['shape'])
+        else:
+            self.hist_shape = histograms.shape[1:]
+
         self.avail_iter_start, self.avail_iter_stop = h5io.get_iter_range(self.input_h5['histograms'])
         try:
             self.avail_iter_step = h5io.get_iter_step(self.input_h5['histograms']) 
@@ -180,6 +208,38 @@ class PlotHistBase(WESTSubcommand):
             self.postprocess_function = get_object(args.postprocess_function,path=['.'])
 
 
+    def marginal_hist(self, iiter_start, iiter_stop, axes):
+        '''Return the sum of the stored histograms [iiter_start, iiter_stop), each reduced by addition
+        over all dimensions except those in ``axes`` (as for ``sum_except_along``). Sparse histograms
+        are reduced without constructing the full histogram.'''
+
+        histograms = self.input_h5['histograms']
+        hist = None
+        if self.sparse:
+            offsets = histograms['offsets']
+            entry_start, entry_stop = offsets[iiter_start], offsets[iiter_stop]
+            for block_start in xrange(entry_start, entry_stop, sparse_block_length):
+                block_stop = min(entry_stop, block_start+sparse_block_length)
+                block_hist = sum_except_along_sparse(histograms['index'][block_start:block_stop],
+                                                     histograms['value'][block_start:block_stop],
+                                                     self.hist_shape, axes)
+                if hist is None:
+                    hist = block_hist
+                else:
+                    hist += block_hist
+                del block_hist
+            if hist is None:
+                hist = sum_except_along_sparse([], [], self.hist_shape, axes)
+        else:
+            for iiter in xrange(iiter_start, iiter_stop):
+                iter_hist = sum_except_along(histograms[iiter], axes)
+                if hist is None:
+                    hist = iter_hist
+                else:
+                    hist += iter_hist
+                del iter_hist
+        return hist
+
     def parse_dimspec(self, dimspec):
         dimdata = {}
         match = re.match(r'([0-9]+)(?::(?:([^,]+),([^:,]+))?(?::(.*))?)?', dimspec)
@@ -373,10 +433,9 @@ least, must be compatible with the output format of ``w_pdist``; see
         iiter = numpy.searchsorted(n_iters, self.n_iter)
         binbounds = self.input_h5['binbounds_{}'.format(idim)][...]
         midpoints = self.input_h5['midpoints_{}'.format(idim)][...]
-        hist = self.input_h5['histograms'][iiter]
         
         # Average over other dimensions
-        hist = sum_except_along(hist, idim)
+        hist = self.marginal_hist(iiter, iiter+1, idim)
         normhistnd(hist, [binbounds])
         self._do_1d_output(hist, idim, midpoints)
 
@@ -393,10 +452,8 @@ least, must be compatible with the output format of ``w_pdist``; see
         binbounds_1 = self.input_h5['binbounds_{}'.format(idim1)][...]
         midpoints_1 = self.input_h5['midpoints_{}'.format(idim1)][...]
         
-        hist = self.input_h5['histograms'][iiter]
-        
         # Average over other dimensions
-        hist = sum_except_along(hist, [idim0,idim1])
+        hist = self.marginal_hist(iiter, iiter+1, [idim0,idim1])
         normhistnd(hist, [binbounds_0,binbounds_1])
         self._do_2d_output(hist, [idim0,idim1], [midpoints_0,midpoints_1], [binbounds_0,binbounds_1])
 
@@ -445,16 +502,8 @@ probability distribution must have been previously extracted with ``w_pdist``
         iiter_stop  = numpy.searchsorted(n_iters, self.iter_stop)
         binbounds = self.input_h5['binbounds_{}'.format(idim)][...]
         midpoints = self.input_h5['midpoints_{}'.format(idim)][...]
-        #hist = self.input_h5['histograms'][iiter_start:iiter_stop]
         
-        for iiter in xrange(iiter_start, iiter_stop):
-            iter_hist = sum_except_along(self.input_h5['histograms'][iiter], idim)
-            if iiter == iiter_start:
-                hist = iter_hist
-            else:
-                hist += iter_hist
-            del iter_hist
-
+        hist = self.marginal_hist(iiter_start, iiter_stop, idim)
         normhistnd(hist, [binbounds])
         self._do_1d_output(hist, idim, midpoints)
 
@@ -474,12 +523,7 @@ probability distribution must have been previously extracted with ``w_pdist``
         binbounds_1 = self.input_h5['binbounds_{}'.format(idim1)][...]
         midpoints_1 = self.input_h5['midpoints_{}'.format(idim1)][...]
         
-        for iiter in xrange(iiter_start,iiter_stop): 
-            iter_hist = sum_except_along(self.input_h5['histograms'][iiter], [idim0,idim1])
-            if iiter == iiter_start:
-                hist = iter_hist
-            else:
-                hist += iter_hist
+        hist = self.marginal_hist(iiter_start, iiter_stop, [idim0,idim1])
 
         normhistnd(hist, [binbounds_0,binbounds_1])
         self._do_2d_output(hist, [idim0,idim1], [midpoints_0, midpoints_1], [binbounds_0,binbounds_1])
@@ -535,7 +579,6 @@ probability distribution must have been previously extracted with ``w_pdist``
         iiter_stop  = numpy.searchsorted(n_iters, self.iter_stop)
         binbounds = self.input_h5['binbounds_{}'.format(idim)][...]
         midpoints = self.input_h5['midpoints_{}'.format(idim)][...]
-        hists_ds = self.input_h5['histograms']
         
         itercount = self.iter_stop - self.iter_start
         
@@ -543,18 +586,13 @@ probability distribution must have been previously extracted with ``w_pdist``
         nblocks = itercount // self.iter_step
             
         block_iters = numpy.empty((nblocks,2), dtype=n_iters.dtype)
-        blocked_hists = numpy.zeros((nblocks,hists_ds.shape[1+idim]), dtype=hists_ds.dtype) 
+        blocked_hists = numpy.zeros((nblocks,self.hist_shape[idim]), dtype=numpy.float64) 
         
         for iblock, istart in enumerate(xrange(iiter_start, iiter_start+nblocks*self.iter_step, self.iter_step)):
             istop = min(istart+self.iter_step, iiter_stop)
-            histslice = hists_ds[istart:istop]
-            
-            
-            # Sum over time
-            histslice = numpy.add.reduce(histslice, axis=0)
             
-            # Sum over other dimensions
-            blocked_hists[iblock] = sum_except_along(histslice, idim)
+            # Sum over time and over other dimensions
+            blocked_hists[iblock] = self.marginal_hist(istart, istop, idim)
             
             # Normalize
             normhistnd(blocked_hists[iblock], [binbounds])
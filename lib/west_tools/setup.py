@@ -18,9 +18,14 @@
 from distutils.core import setup
 from distutils.extension import Extension
 
+import sys
 import numpy
 numpy_include = numpy.get_include()
 
+# OpenMP is used for parallel loops where available; Apple's compilers do not support it
+# out of the box, in which case those loops run serially
+openmp_args = [] if sys.platform == 'darwin' else ['-fopenmp']
+
 try:
     from Cython.Distutils import build_ext
     use_cython = True
@@ -39,7 +44,8 @@ setup(cmdclass = cmdclass,
                                include_dirs=['.', numpy_include],
                                
                                # hack-ish; included since my dev box has trouble
-                               extra_compile_args=['-O3']),
+                               extra_compile_args=['-O3'] + openmp_args,
+                               extra_link_args=openmp_args),
                      Extension("trajtree._trajtree",
                                ["trajtree/_trajtree.{}".format(suffix)],
                                include_dirs=['.', numpy_include],
@@ -56,7 +62,8 @@ setup(cmdclass = cmdclass,
                      Extension("westpa.kinetics._kinetics",
                                 ["westpa/kinetics/_kinetics.{}".format(suffix)],
                                 include_dirs=['.', numpy_include],
-                                extra_compile_args=['-O3']),
+                                extra_compile_args=['-O3'] + openmp_args,
+                                extra_link_args=openmp_args),
                      Extension("postanalysis._stats",
                                 ["postanalysis/_stats.{}".format(suffix)],
                                 include_dirs=['.', numpy_include],
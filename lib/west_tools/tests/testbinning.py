@@ -19,7 +19,8 @@ from __future__ import division, print_function
 from westpa.binning.assign import (RectilinearBinMapper, PiecewiseBinMapper, FuncBinMapper, VectorizingFuncBinMapper, 
                                  VoronoiBinMapper, RecursiveBinMapper)
 from westpa.binning.assign import index_dtype, coord_dtype
-from westpa.binning._assign import testfunc #@UnresolvedImport
+from westpa.binning._assign import testfunc, assignments_list_to_groups #@UnresolvedImport
+from westpa.binning._assign import accumulate_state_populations_from_labeled, state_populations_from_labeled #@UnresolvedImport
 
 import numpy
 from scipy.spatial.distance import cdist
@@ -62,6 +63,17 @@ class TestRectilinearBinMapper:
         
         assert (assigner.assign(coords) == [0, 5, 10, 10, 15, 7, 8]).all()
 
+    def test_update_from_samples(self):
+        assigner = RectilinearBinMapper([[0.0, 1.0, 2.0, float('inf')]])
+        coords = numpy.array([0.5, 0.5, 2.5, 3.5, 4.5, 5.5])[:,None]
+        assert assigner.update_from_samples(coords)
+        assert assigner.nbins == 3
+        assert (assigner.boundaries[0] == [0.0, 2.5, 4.5, float('inf')]).all()
+
+        # weighted, and only halfway toward quantiles
+        assert assigner.update_from_samples(coords, weights=[0.5,0.5,0,0,0,0], rate=0.5)
+        assert (assigner.boundaries[0] == [0.0, 1.5, 2.5, float('inf')]).all()
+
 class TestPiecewiseBinMapper:
     def test_bin_mapping(self):
         coords = numpy.array([[-0.5], [0.0], [0.5]], dtype=numpy.float32)
@@ -118,6 +130,20 @@ class TestVoronoiBinMapper:
         mapper = VoronoiBinMapper(self.distfunc, centers)
         output = mapper.assign(coords)
         assert list(output) == [0,1,0,1]
+
+    def test_update_from_samples(self):
+        centers = numpy.array([[0,0], [2,2]], dtype=coord_dtype)
+        mapper = VoronoiBinMapper(self.distfunc, centers)
+        # mappers which never adapt keep the state (and so the pickle and hash) they always had
+        assert not hasattr(mapper, 'center_weights')
+
+        assert mapper.update_from_samples(numpy.array([[0.5,0.5], [3,3]], dtype=coord_dtype))
+        assert numpy.allclose(mapper.centers, [[0.5,0.5], [3,3]])
+
+        # running mean over all samples seen so far
+        assert mapper.update_from_samples(numpy.array([[0,0], [1,1]], dtype=coord_dtype))
+        assert numpy.allclose(mapper.centers, [[0.5,0.5], [3,3]])
+        assert not mapper.update_from_samples(numpy.empty((0,2), dtype=coord_dtype))
         
  
 class TestNestingBinMapper:
@@ -342,3 +368,27 @@ class TestNestingBinMapper:
         assert (rmapper.assign(pairs) == [0,4,5,2,3,1]).all()
 
 
+class TestAssignmentsListToGroups:
+    def testGroups(self):
+        assignments = numpy.array([2, 0, 2, 3, 0, 2], dtype=index_dtype)
+        seg_ids, offsets = assignments_list_to_groups(5, assignments)
+        assert (offsets == [0, 2, 2, 5, 6, 6]).all()
+        assert (seg_ids == [1, 4, 0, 2, 5, 3]).all()
+
+    def testInvalidAssignment(self):
+        nose.tools.assert_raises(ValueError, assignments_list_to_groups, 3, numpy.array([0, 3], dtype=index_dtype))
+
+class TestStatePopulationsFromLabeled:
+    def testMatchesPerIteration(self):
+        labeled_pops = numpy.random.random(size=(5,3,4))
+        state_map = numpy.array([2, 0, 1, 0], dtype=index_dtype)
+        state_pops = state_populations_from_labeled(labeled_pops, state_map)
+        assert state_pops.shape == (5,3)
+        for iiter in xrange(5):
+            iter_state_pops = numpy.zeros((3,), numpy.float64)
+            accumulate_state_populations_from_labeled(labeled_pops[iiter], state_map, iter_state_pops)
+            assert (state_pops[iiter] == iter_state_pops).all()
+
+    def testInvalidStateMap(self):
+        nose.tools.assert_raises(ValueError, state_populations_from_labeled, numpy.zeros((2,3,2)),
+                                 numpy.array([0, 3], dtype=index_dtype))
@@ -0,0 +1,81 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division, print_function
+from fasthist import histnd, histnd_timeseries, histnd_sparse, normhistnd, normhistnd_sparse
+
+import numpy
+import nose
+import nose.tools
+
+class TestHistndTimeseries:
+    def test_matches_histnd(self):
+        binbounds = [[0, 0.25, 0.3, 0.9, 1.0], numpy.linspace(0, 1, 11)]
+        weights = numpy.random.rand(50)
+        for dtype in (numpy.float32, numpy.float64):
+            values = numpy.require(numpy.random.rand(50,21,2), dtype)
+            expected = numpy.zeros((4,10), numpy.float64)
+            for ipt in xrange(1,21):
+                histnd(values[:,ipt,:], binbounds, weights, out=expected)
+            result = histnd_timeseries(values[:,1:,:], binbounds, weights)
+            assert numpy.allclose(result, expected)
+
+    def test_out_of_range(self):
+        values = numpy.array([[[0.5], [1.5]], [[2.5], [0.0]]])
+        nose.tools.assert_raises(ValueError, histnd_timeseries, values, [[0, 1, 2]])
+        result = histnd_timeseries(values, [[0, 1, 2]], [1.0, 2.0], ignore_out_of_range=True)
+        assert (result == [3.0, 1.0]).all()
+
+class TestHistndSparse:
+    def test_matches_histnd(self):
+        binbounds = [[0, 0.25, 0.3, 0.9, 1.0], numpy.linspace(0, 1, 11), [0, 0.5, 1.0]]
+        values = numpy.random.rand(40,3)
+        weights = numpy.random.rand(40)
+        expected = histnd(values, binbounds, weights)
+        indices, hist = histnd_sparse(values, binbounds, weights)
+        assert (numpy.diff(indices) > 0).all()
+        assert numpy.allclose(hist, expected.ravel()[indices])
+        assert not numpy.delete(expected.ravel(), indices).any()
+
+        normhistnd(expected, binbounds)
+        normhistnd_sparse(indices, hist, binbounds)
+        assert numpy.allclose(hist, expected.ravel()[indices])
+
+class TestHistndThreads:
+    def test_matches_serial(self):
+        binbounds = [[0, 0.25, 0.3, 0.9, 1.0], numpy.linspace(0, 1, 11)]
+        values = numpy.random.rand(1000,2)
+        weights = numpy.random.rand(1000)
+        expected = histnd(values, binbounds, weights)
+        for nthreads in (2, 3):
+            assert numpy.allclose(histnd(values, binbounds, weights, nthreads=nthreads), expected)
+            assert (histnd(values, binbounds, weights, nthreads=nthreads, deterministic=True) == expected).all()
+
+        values = numpy.random.rand(50,21,2)
+        weights = numpy.random.rand(50)
+        expected = histnd_timeseries(values, binbounds, weights)
+        result = histnd_timeseries(values, binbounds, weights, nthreads=3, deterministic=True)
+        assert (result == expected).all()
+
+    def test_out_of_range(self):
+        values = numpy.array([[[0.5], [1.5]], [[2.5], [0.0]]])
+        for deterministic in (False, True):
+            nose.tools.assert_raises(ValueError, histnd_timeseries, values, [[0, 1, 2]], nthreads=2,
+                                     deterministic=deterministic)
+            result = histnd_timeseries(values, [[0, 1, 2]], [1.0, 2.0], ignore_out_of_range=True, nthreads=2,
+                                       deterministic=deterministic)
+            assert (result == [3.0, 1.0]).all()
@@ -0,0 +1,77 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division, print_function
+import os, shutil, tempfile
+
+import numpy, h5py
+
+from west.data_manager import WESTDataManager, tstate_index_dtype, tstate_dtype, nw_index_dtype
+from west.we_driver import NewWeightEntry
+from w_fluxanl import extract_fluxes, _merge_fluxdata, _trim_fluxdata
+
+class TestFluxExtraction:
+    n_iters = 40
+
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.data_manager = WESTDataManager()
+        self.data_manager.we_h5filename = os.path.join(self.tempdir, 'west.h5')
+
+        # Target A is defined throughout; target B is added at iteration 20
+        tstate_sets = [(0, ['A']), (20, ['A', 'B'])]
+        numpy.random.seed(11)
+        with h5py.File(self.data_manager.we_h5filename, 'w') as we_h5file:
+            we_h5file.attrs['west_file_format_version'] = 7
+            we_h5file.attrs['west_iter_prec'] = 8
+            tstate_index = we_h5file.create_dataset('tstates/index', shape=(len(tstate_sets),), dtype=tstate_index_dtype)
+            for set_id, (iter_valid, labels) in enumerate(tstate_sets):
+                state_group = we_h5file.create_group('tstates/{}'.format(set_id))
+                state_group['index'] = numpy.array([(label,) for label in labels], dtype=tstate_dtype)
+                state_group['pcoord'] = numpy.zeros((len(labels), 1), dtype=numpy.float32)
+                tstate_index[set_id] = (iter_valid, len(labels), state_group.ref)
+
+            # Recycling from iteration n_iter is recorded in iteration n_iter+1
+            for n_iter in xrange(2, self.n_iters+2):
+                n_states = len(tstate_sets[int(n_iter-1 >= 20)][1])
+                new_weights = numpy.zeros((5,), dtype=nw_index_dtype)
+                new_weights['source_type'] = NewWeightEntry.NW_SOURCE_RECYCLED
+                new_weights['weight'] = numpy.random.random(size=(5,))
+                new_weights['target_state_id'] = numpy.random.randint(n_states, size=(5,))
+                we_h5file.create_dataset('iterations/iter_{:08d}/new_weights/index'.format(n_iter), data=new_weights)
+        self.data_manager.open_backing('r')
+
+    def teardown(self):
+        self.data_manager.close_backing()
+        shutil.rmtree(self.tempdir)
+
+    def test_late_target_trimmed(self):
+        fluxdata = extract_fluxes(1, self.n_iters+1, self.data_manager)
+        assert fluxdata['A']['n_iter'][0] == 1 and len(fluxdata['A']) == self.n_iters
+        assert fluxdata['B']['n_iter'][0] == 20 and len(fluxdata['B']) == self.n_iters-19
+        assert (fluxdata['B']['count'] >= 0).all() and fluxdata['B']['count'].sum() > 0
+
+    def test_append_matches_fresh(self):
+        fresh = extract_fluxes(1, self.n_iters+1, self.data_manager)
+        # Fluxes stored by a run ending before target B was defined, then by one ending after
+        for first_new_iter in (15, 25):
+            stored = extract_fluxes(1, first_new_iter, self.data_manager)
+            new = extract_fluxes(first_new_iter, self.n_iters+1, self.data_manager)
+            appended = _trim_fluxdata(_merge_fluxdata(1, self.n_iters+1, stored, new))
+            assert sorted(appended) == sorted(fresh)
+            for target_label in fresh:
+                assert numpy.array_equal(appended[target_label], fresh[target_label])
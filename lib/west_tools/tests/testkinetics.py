@@ -17,10 +17,17 @@
 
 from __future__ import division, print_function
 from westpa.kinetics._kinetics import calc_rates, StreamingStats2D, StreamingStats1D
-from westpa.kinetics.rate_averaging import tuple2stats
+from westpa.kinetics.rate_averaging import tuple2stats, CachedRateAverager
+from westpa.kinetics.matrates import (estimate_rates, estimate_sparse_rates, WindowedRateEstimator, get_steady_state,
+                                      ConsistencyWarning)
+from westpa.kinetics import nested_to_flat_matrix, find_macrostate_transitions, MacrostateTransitionTracer
+from westpa.kinetics._kinetics import _fast_transition_state_copy
+from westpa.kinetics.steadystate import SteadyStateSolver
+from westpa.binning import index_dtype, RectilinearBinMapper
 from collections import namedtuple
+import warnings
 
-import numpy
+import numpy, scipy.sparse, h5py
 import nose
 import nose.tools
 
@@ -68,6 +75,40 @@ class TestRateAverating:
         assert numpy.allclose(rate_stats.mean, rate_stats2.mean)
         assert numpy.allclose(rate_stats.var, rate_stats2.var)
 
+    def test_cached_averager(self):
+        class SyntheticAverager(CachedRateAverager):
+            # per-iteration observations generated from the iteration number, in place of the WEST file
+            def read_iterations(self, iter_indices, n_blocks=1, queue_size=1):
+                self.n_read += len(iter_indices)
+                iter_indices = numpy.array(iter_indices, numpy.int64)
+                fluxes = numpy.array([numpy.random.RandomState(n).random_sample((3,3)) for n in iter_indices])
+                pops = numpy.array([numpy.random.RandomState(n).randint(0,2,size=(3,)) for n in iter_indices], numpy.float64)
+                self._store(iter_indices, fluxes.reshape(-1,3,3), pops.reshape(-1,3))
+
+        mapper = RectilinearBinMapper([[0,1,2,3]])
+        def averager():
+            averager = SyntheticAverager(mapper, system=object(), data_manager=object(), work_manager=object())
+            averager.n_read = 0
+            return averager
+
+        h5file = h5py.File('cached_averager.h5', driver='core', backing_store=False)
+        cached = averager()
+        for (iter_start, iter_stop) in [(1,3), (1,6), (3,8), (5,15), (20,22)]:
+            cached.calculate(iter_start, iter_stop)
+            fresh = averager()
+            fresh.calculate(iter_start, iter_stop)
+            assert (cached.average_rate == fresh.average_rate).all()
+            assert (cached.stderr_rate == fresh.stderr_rate).all()
+            assert (cached.average_populations == fresh.average_populations).all()
+            cached.save_state(h5file)
+        assert cached.n_read == 2+3+2+7+2
+
+        restored = averager()
+        restored.load_state(h5file, 21)
+        restored.calculate(20,22)
+        assert restored.n_read == 1
+        assert (restored.average_flux == cached.average_flux).all()
+
 class TestKinetics:
     def test_calc_rates(self):
         nbins = 100
@@ -91,11 +132,161 @@ class TestKinetics:
         assert numpy.all(mask == expected_mask)
         assert numpy.allclose(rate_matrix, expected_rate)
 
+    def test_estimate_sparse_rates(self):
+        nstates, nbins, nsegs, npts, niters = 2, 5, 20, 4, 3
+        state_labels = ['A', 'B']
+        state_map = numpy.array([0,1,1,1,2,2], index_dtype)
+        weights = [numpy.random.random(size=(nsegs,)) for _i in xrange(niters)]
+        parent_ids = [numpy.random.randint(0, nsegs, size=(nsegs,)) for _i in xrange(niters)]
+        bin_assignments = [numpy.random.randint(0, nbins, size=(nsegs,npts)).astype(index_dtype)
+                           for _i in xrange(niters)]
+        label_assignments = [numpy.random.randint(0, nstates, size=(nsegs,npts)).astype(index_dtype)
+                             for _i in xrange(niters)]
+        labeled_pops = numpy.random.random(size=(nstates+1,nbins+1))
+        labeled_pops[0,1] = 0.0
+
+        for all_lags in (False, True):
+            fluxes = numpy.empty((nstates,nstates,nbins,nbins))
+            rates = numpy.empty_like(fluxes)
+            unlabeled_rates = numpy.empty((nbins,nbins))
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                estimate_rates(nbins, state_labels, weights, parent_ids, bin_assignments, label_assignments, state_map,
+                               labeled_pops, all_lags, fluxes, rates, unlabeled_rates)
+                sfluxes, srates, sunlabeled_rates = estimate_sparse_rates(nbins, state_labels, weights, parent_ids,
+                                                                          bin_assignments, label_assignments,
+                                                                          state_map, labeled_pops, all_lags)
+
+            assert numpy.allclose(sfluxes.toarray(), nested_to_flat_matrix(fluxes))
+            assert numpy.allclose(srates.toarray(), nested_to_flat_matrix(rates))
+            assert numpy.allclose(sunlabeled_rates.toarray(), unlabeled_rates)
+            assert (srates.indices == sfluxes.indices).all() and (srates.indptr == sfluxes.indptr).all()
+
         #row_sum = rate_matrix.sum(axis=1)
         #for k in xrange(nbins):
             #print(row_sum[k])
             #assert numpy.allclose(row_sum[k], 0.0) or numpy.allclose(row_sum[k], 1.0)
 
+    def test_windowed_rate_estimator(self):
+        nstates, nbins, nsegs, npts, niters, window_size = 2, 5, 20, 4, 8, 3
+        state_labels = ['A', 'B']
+        state_map = numpy.array([0,1,1,1,2,2], index_dtype)
+        weights = [numpy.random.random(size=(nsegs,)) for _i in xrange(niters)]
+        parent_ids = [numpy.random.randint(-1, nsegs, size=(nsegs,)) for _i in xrange(niters)]
+        bin_assignments = [numpy.random.randint(0, nbins, size=(nsegs,npts)).astype(index_dtype)
+                           for _i in xrange(niters)]
+        label_assignments = [numpy.random.randint(0, nstates, size=(nsegs,npts)).astype(index_dtype)
+                             for _i in xrange(niters)]
+        labeled_pops = numpy.random.random(size=(nstates+1,nbins+1))
+
+        for all_lags in (False, True):
+            estimator = WindowedRateEstimator(nstates, nbins, window_size, all_lags)
+            for iiter in xrange(niters):
+                window = slice(max(0,iiter-window_size+1), iiter+1)
+                expected = estimate_sparse_rates(nbins, state_labels, weights[window], parent_ids[window],
+                                                 bin_assignments[window], label_assignments[window], state_map,
+                                                 labeled_pops, all_lags)
+                estimator.add_iteration(weights[iiter], parent_ids[iiter], bin_assignments[iiter],
+                                        label_assignments[iiter])
+                result = estimator.estimate_rates(labeled_pops)
+                for matrix, expected_matrix in zip(result, expected):
+                    assert (matrix.indptr == expected_matrix.indptr).all()
+                    assert (matrix.indices == expected_matrix.indices).all()
+                    assert numpy.allclose(matrix.data, expected_matrix.data)
+
+    def test_transition_tracer(self):
+        nstates, nsegs, npts, niters = 3, 50, 11, 4
+        iter_data = []
+        for iiter in xrange(niters):
+            weights = numpy.random.random(size=(nsegs,))
+            parent_ids = numpy.random.randint(0, nsegs, size=(nsegs,)) if iiter else -numpy.ones((nsegs,), numpy.int64)
+            state_assignments = numpy.random.randint(0, nstates+1, size=(nsegs,npts)).astype(index_dtype)
+            label_assignments = state_assignments.copy()
+            for ipt in xrange(1, npts):
+                outside = label_assignments[:,ipt] == nstates
+                label_assignments[outside,ipt] = label_assignments[outside,ipt-1]
+            iter_data.append((weights, parent_ids.astype(numpy.int64), label_assignments, state_assignments))
+            
+        def new_accumulators():
+            return (numpy.zeros((nstates,nstates)), numpy.zeros((nstates,nstates), numpy.uint),
+                    numpy.zeros((nstates,)), numpy.zeros((nstates,), numpy.uint))
+        
+        expected = []
+        state = None
+        for iiter, (weights, parent_ids, label_assignments, state_assignments) in enumerate(iter_data):
+            accumulators = new_accumulators()
+            durations = []
+            state = _fast_transition_state_copy(iiter, nstates, parent_ids, state)
+            find_macrostate_transitions(nstates, weights, label_assignments, state_assignments, 0.1, state,
+                                        *(accumulators + (durations,)))
+            expected.append((accumulators, [(iiter+1,) + duration for duration in durations]))
+            
+        for nthreads in (1, 3):
+            tracer = MacrostateTransitionTracer(nstates, nthreads)
+            for iiter, (weights, parent_ids, label_assignments, state_assignments) in enumerate(iter_data):
+                accumulators = new_accumulators()
+                nevents = tracer.trace(iiter+1, weights, parent_ids, label_assignments, state_assignments, 0.1,
+                                       *accumulators)
+                expected_accumulators, expected_events = expected[iiter]
+                for array, expected_array in zip(accumulators, expected_accumulators):
+                    assert numpy.allclose(array, expected_array)
+                events = tracer.pop_events()
+                assert len(events) == nevents == len(expected_events)
+                for event, expected_event in zip(events, expected_events):
+                    assert numpy.allclose(tuple(event), expected_event)
+
+class TestSteadyStateSolver:
+    def test_methods(self):
+        n = 50
+        rates = numpy.random.random(size=(n,n))
+        rates[rates < 0.8] = 0.0
+        rates[numpy.arange(n), (numpy.arange(n)+1) % n] = 1.0 # ensure irreducibility
+        tmatrix = rates / rates.sum(axis=1)[:,numpy.newaxis]
+
+        for method in SteadyStateSolver.methods:
+            solver = SteadyStateSolver(method)
+            ss = solver.solve(scipy.sparse.csr_matrix(rates))
+            assert numpy.allclose(ss.sum(), 1.0)
+            assert numpy.allclose(ss.dot(tmatrix), ss)
+            # warm start from the previous solution
+            ss2 = solver.solve(rates)
+            assert numpy.allclose(ss, ss2)
+
+    def test_largest_component(self):
+        # states 0-2 form a cycle; state 3 is a source and state 4 a sink
+        rates = numpy.zeros((5,5))
+        rates[0,1] = rates[1,2] = rates[2,0] = 1.0
+        rates[3,0] = rates[2,4] = 1.0
+        solver = SteadyStateSolver()
+        assert (solver.largest_component(scipy.sparse.csr_matrix(rates)) == [0,1,2]).all()
+        ss = solver.solve(rates)
+        assert numpy.allclose(ss, [1/3, 1/3, 1/3, 0, 0])
+        assert list(solver.excluded_states) == [3, 4]
+
+        # states without any transitions are not reported as excluded
+        rates = numpy.pad(rates, ((0,1),(0,1)), 'constant')
+        rates[3,0] = rates[2,4] = 0.0
+        solver.solve(rates)
+        assert len(solver.excluded_states) == 0
+
+        assert solver.solve(numpy.zeros((3,3))) is None
+
+    def test_excluded_states_warning(self):
+        rates = numpy.zeros((4,4))
+        rates[0,1] = rates[1,2] = rates[2,0] = rates[3,0] = 1.0
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            ss = get_steady_state(rates)
+        assert numpy.allclose(ss, [1/3, 1/3, 1/3, 0])
+        assert any(issubclass(w.category, ConsistencyWarning) and '[3]' in str(w.message) for w in caught)
+
+    def test_non_stationary_rejected(self):
+        # a solution which is not an eigenvector with eigenvalue 1 is not accepted
+        tmatrix = scipy.sparse.csr_matrix(numpy.array([[0.5, 0.5], [0.1, 0.9]]))
+        solver = SteadyStateSolver()
+        assert solver.is_stationary(tmatrix, numpy.array([1/6, 5/6]))
+        assert not solver.is_stationary(tmatrix, numpy.array([0.5, 0.5]))
+
 class TestStreamingStats2D:
     def test_nomask(self):
         nbins = 100
@@ -0,0 +1,121 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division, print_function
+from mclib import (mcbs_ci, mcbs_correltime, mcbs_ci_correl, mcbs_ci_correl_multi,
+                   mcbs_ci_correl_windows, autocorrel_elem, autocorrel_fft)
+from mclib import _mclib
+
+import numpy
+import nose
+import nose.tools
+
+class TestMCBS:
+    def test_vectorized_ci(self):
+        dataset = numpy.random.exponential(size=(500,))
+        for estimator in (numpy.mean, numpy.median):
+            # a wrapper prevents the estimator from being recognized as vectorizable
+            wrapped = lambda x: estimator(x)
+            numpy.random.seed(1)
+            expected = mcbs_ci(dataset, wrapped, 0.05, n_sets=200)
+            numpy.random.seed(1)
+            result = mcbs_ci(dataset, estimator, 0.05, n_sets=200)
+            assert numpy.allclose(result, expected)
+
+class TestAutocorrel:
+    @staticmethod
+    def correlated_data(correl_len, nblocks):
+        # blocks of correlated random data, as generated for functional_tests/t_mclib.py
+        blocks = numpy.random.randint(0,2,size=(nblocks,)) + 0.1*numpy.random.random(size=(nblocks,))
+        return numpy.repeat(blocks, correl_len)
+
+    def test_autocorrel_fft(self):
+        dataset = self.correlated_data(4, 100)
+        rho = autocorrel_fft(dataset)
+        assert len(rho) == len(dataset)
+        for k in xrange(len(dataset)):
+            assert abs(rho[k] - autocorrel_elem(dataset, k)) < 1e-10
+        rhos = autocorrel_fft(numpy.vstack([dataset, dataset[::-1]]), 20)
+        assert rhos.shape == (2,21)
+        assert numpy.allclose(rhos[0], rho[:21])
+
+    def test_correltime_fft(self):
+        numpy.random.seed(3)
+        for correl_len in (1, 16, 150):
+            dataset = self.correlated_data(correl_len, 2000//correl_len)
+            numpy.random.seed(5)
+            expected = _mclib.mcbs_correltime_small(dataset, 0.05, 200)
+            numpy.random.seed(5)
+            result = _mclib.mcbs_correltime_fft(dataset, 0.05, 200)
+            assert result == expected
+
+    def test_ci_correl_multi(self):
+        numpy.random.seed(4)
+        datasets = numpy.column_stack([self.correlated_data(correl_len, 600//correl_len) for correl_len in (1, 3, 10)])
+        numpy.random.seed(6)
+        estimates, ci_lbs, ci_ubs, correl_times = mcbs_ci_correl_multi(datasets, 0.05, 200, autocorrel_n_sets=200,
+                                                                       subsample=numpy.mean)
+        for icol in xrange(datasets.shape[1]):
+            numpy.random.seed(6)
+            assert correl_times[icol] == mcbs_correltime(datasets[:,icol], 0.05, 200)
+        assert numpy.allclose(estimates, datasets.mean(axis=0))
+        assert (ci_lbs < estimates).all() and (estimates < ci_ubs).all()
+
+    def test_ci_correl_multi_matches_single(self):
+        numpy.random.seed(8)
+        # 604 rows, so that decimation with strides 4 and 11 would drop trailing rows
+        datasets = numpy.column_stack([self.correlated_data(correl_len, 2000//correl_len)[:604]
+                                       for correl_len in (1, 3, 10)])
+        numpy.random.seed(9)
+        estimates, ci_lbs, ci_ubs, correl_times = mcbs_ci_correl_multi(datasets, 0.05, 1000, autocorrel_n_sets=200,
+                                                                       subsample=numpy.mean)
+        for icol in xrange(datasets.shape[1]):
+            numpy.random.seed(9)
+            s_estimate, s_ci_lb, s_ci_ub, s_correl_time = mcbs_ci_correl(datasets[:,icol], numpy.mean, 0.05, 1000,
+                                                                         autocorrel_n_sets=200, subsample=numpy.mean)
+            assert correl_times[icol] == s_correl_time
+            assert numpy.allclose(estimates[icol], datasets[:,icol].mean())
+            # each column is decimated with its own stride, so CIs are as wide as those of separate bootstraps
+            width, s_width = ci_ubs[icol] - ci_lbs[icol], s_ci_ub - s_ci_lb
+            assert 0.8 < width/s_width < 1.25
+
+    def test_ci_correl_windows(self):
+        numpy.random.seed(7)
+        dataset = numpy.column_stack([self.correlated_data(correl_len, 600//correl_len) for correl_len in (1, 10)])
+        windows = [(0, 200), (200, 400), (0, 600), (400, 600)]
+        estimates, ci_lbs, ci_ubs, correl_times = mcbs_ci_correl_windows(dataset, windows, 0.05, 200,
+                                                                         subsample=numpy.mean)
+        assert estimates.shape == ci_lbs.shape == ci_ubs.shape == correl_times.shape == (4,2)
+        for iwindow, (start, stop) in enumerate(windows):
+            for icol in xrange(2):
+                assert numpy.allclose(estimates[iwindow,icol], dataset[start:stop,icol].mean())
+                assert ci_lbs[iwindow,icol] < estimates[iwindow,icol] < ci_ubs[iwindow,icol]
+        # each column is decimated according to its own correlation time
+        assert (correl_times[:,0] < correl_times[:,1]).all()
+
+    def test_ci_correl_windows_matches_multi(self):
+        numpy.random.seed(10)
+        # one column correlated over blocks of 16 rows, with a length not a multiple of its stride
+        dataset = numpy.column_stack([self.correlated_data(correl_len, 640//correl_len)[:604]
+                                   for correl_len in (1, 16)])
+        numpy.random.seed(12)
+        w_results = mcbs_ci_correl_windows(dataset, [(0, len(dataset))], 0.05, 200, subsample=numpy.mean)
+        numpy.random.seed(12)
+        m_results = mcbs_ci_correl_multi(dataset, 0.05, 200, subsample=numpy.mean)
+        for w_result, m_result in zip(w_results, m_results):
+            assert numpy.allclose(w_result[0], m_result)
+        assert numpy.allclose(w_results[0][0], dataset.mean(axis=0))
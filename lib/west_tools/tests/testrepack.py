@@ -0,0 +1,75 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division, print_function
+import os, shutil, tempfile, argparse
+
+import numpy, h5py
+
+from westpa import h5io
+from w_repack import WRepack
+
+class TestCalcIterChunksize:
+    def test_1d(self):
+        chunks = h5io.calc_iter_chunksize((1000,), numpy.float64)
+        assert chunks == (1,)
+
+    def test_2d(self):
+        # more segments than fit in one chunk
+        chunks = h5io.calc_iter_chunksize((10, 100000), numpy.float64, max_chunksize=4096)
+        assert chunks == (1, 512)
+        assert all(isinstance(dim, (int, long)) for dim in chunks)
+
+    def test_3d(self):
+        chunks = h5io.calc_iter_chunksize((10, 100000, 5), numpy.float64, max_chunksize=4000)
+        assert chunks == (1, 100, 5)
+        assert all(isinstance(dim, (int, long)) for dim in chunks)
+
+class TestRepack:
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.input_filename = os.path.join(self.tempdir, 'input.h5')
+        self.output_filename = os.path.join(self.tempdir, 'output.h5')
+        self.data = {'state_map': numpy.arange(50, dtype=numpy.uint16),
+                     'nsegs': numpy.random.randint(0, 100, size=(20, 70000)),
+                     'assignments': numpy.random.randint(0, 10, size=(20, 30, 5)).astype(numpy.uint16)}
+        with h5py.File(self.input_filename, 'w') as input_file:
+            for dsname, data in self.data.iteritems():
+                input_file[dsname] = data
+
+    def teardown(self):
+        shutil.rmtree(self.tempdir)
+
+    def repack(self, *args):
+        tool = WRepack()
+        parser = argparse.ArgumentParser()
+        tool.add_args(parser)
+        tool.process_args(parser.parse_args([self.input_filename, '-o', self.output_filename] + list(args)))
+        tool.go()
+
+    def check_output(self, dsnames):
+        with h5py.File(self.output_filename, 'r') as output_file:
+            for dsname in dsnames:
+                assert (output_file[dsname][...] == self.data[dsname]).all()
+
+    def test_repack_1d_2d(self):
+        self.repack('-d', 'state_map', '-d', 'nsegs')
+        self.check_output(self.data.keys())
+
+    def test_repack_default(self):
+        self.repack()
+        self.check_output(self.data.keys())
@@ -16,13 +16,14 @@
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import print_function, division; __metaclass__ = type
-import sys
+import sys, os
 import logging
 import math
+import threading, Queue
 from numpy import index_exp
 
 from west.data_manager import seg_id_dtype, weight_dtype
-from westpa.binning import index_dtype, assign_and_label, accumulate_labeled_populations 
+from westpa.binning import index_dtype, label_assignments, accumulate_labeled_populations, get_mapper_hash
 from westtools import (WESTParallelTool, WESTDataReader, WESTDSSynthesizer, BinMappingComponent, 
                        ProgressIndicatorComponent)
 import numpy
@@ -46,18 +47,82 @@ def parse_pcoord_value(pc_str):
         raise ValueError('too many dimensions')
     return arr
 
-def _assign_label_pop(n_iter, lb, ub, mapper, nstates, state_map, last_labels, parent_id_dsspec, weight_dsspec, pcoord_dsspec):    
-
-    nbins = len(state_map)-1
+def _assign_slice(n_iter, lb, ub, mapper, parent_id_dsspec, weight_dsspec, pcoord_dsspec):
+    '''Assign segments ``lb:ub`` of iteration ``n_iter`` to bins. This does not depend on any other
+    iteration, so slices may be processed in any order.'''
     parent_ids = parent_id_dsspec.get_iter_data(n_iter,index_exp[lb:ub])
     weights = weight_dsspec.get_iter_data(n_iter,index_exp[lb:ub])
     pcoords = pcoord_dsspec.get_iter_data(n_iter,index_exp[lb:ub])
-    
-    assignments, trajlabels, statelabels = assign_and_label(lb, ub, parent_ids,
-                                               mapper.assign, nstates, state_map, last_labels, pcoords)
-    pops = numpy.zeros((nstates+1,nbins+1), weight_dtype)
-    accumulate_labeled_populations(weights, assignments, trajlabels, pops)
-    return (assignments, trajlabels, pops, lb, ub, statelabels)
+
+    assignments = numpy.empty(pcoords.shape[:2], index_dtype)
+    mask = numpy.ones((pcoords.shape[1],), numpy.bool_)
+    for iseg in xrange(ub-lb):
+        mapper.assign(pcoords[iseg,:], mask, assignments[iseg,:])
+    return (n_iter, lb, ub, assignments, parent_ids, weights)
+
+class _IterAssignment:
+    '''Bin assignments, parent IDs, and weights for one iteration, collected from slices as
+    they are completed.'''
+    def __init__(self, nsegs, npts, n_slices):
+        self.assignments = numpy.empty((nsegs,npts), index_dtype)
+        self.parent_ids = numpy.empty((nsegs,), seg_id_dtype)
+        self.weights = numpy.empty((nsegs,), weight_dtype)
+        self.n_pending = n_slices
+
+    def add_slice(self, lb, ub, assignments, parent_ids, weights):
+        self.assignments[lb:ub] = assignments
+        self.parent_ids[lb:ub] = parent_ids
+        self.weights[lb:ub] = weights
+        self.n_pending -= 1
+
+class _AssignmentWriter:
+    '''Write labeled assignments to the output datasets from a background thread, so that
+    compression and I/O overlap with assignment of subsequent iterations. At most ``maxsize``
+    iterations are held awaiting output. Errors encountered while writing are re-raised by
+    ``put()`` or ``close()``.'''
+    def __init__(self, assignments_ds, pops_ds, trajlabels_ds=None, statelabels_ds=None, maxsize=0):
+        self.assignments_ds = assignments_ds
+        self.pops_ds = pops_ds
+        self.trajlabels_ds = trajlabels_ds
+        self.statelabels_ds = statelabels_ds
+        self.queue = Queue.Queue(maxsize)
+        self.exc_info = None
+        self.thread = threading.Thread(target=self._write_loop, name='w_assign writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            elif self.exc_info is not None:
+                # discard remaining output once an error has occurred
+                continue
+            try:
+                iiter, assignments, trajlabels, statelabels, pops = item
+                nsegs, npts = assignments.shape
+                self.assignments_ds[iiter, 0:nsegs, 0:npts] = assignments
+                self.pops_ds[iiter] = pops
+                if self.trajlabels_ds is not None:
+                    self.trajlabels_ds[iiter, 0:nsegs, 0:npts] = trajlabels
+                    self.statelabels_ds[iiter, 0:nsegs, 0:npts] = statelabels
+            except Exception:
+                self.exc_info = sys.exc_info()
+
+    def _check(self):
+        if self.exc_info is not None:
+            exc_type, exc_value, exc_tb = self.exc_info
+            raise exc_type, exc_value, exc_tb
+
+    def put(self, iiter, assignments, trajlabels, statelabels, pops):
+        self._check()
+        self.queue.put((iiter, assignments, trajlabels, statelabels, pops))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
 
 class WAssign(WESTParallelTool):
     prog='w_assign'
@@ -206,15 +271,40 @@ initiated in a region not corresponding to a defined macrostate.
 Thus, ``labeled_populations[:,:,:].sum(axis=1)[:,:-1]`` gives overall per-bin
 populations, for all defined bins and 
 ``labeled_populations[:,:,:].sum(axis=2)[:,:-1]`` gives overall
-per-trajectory-ensemble populations for all defined states. 
+per-trajectory-ensemble populations for all defined states.
+
+The [iteration][segment][timepoint] datasets are stored in chunks spanning one
+iteration and all timepoints, as subsequent analysis tools read them one
+iteration at a time. Files produced by earlier versions of this tool may be
+converted to this layout with w_repack.
 
     
+-----------------------------------------------------------------------------
+Incremental assignment
+-----------------------------------------------------------------------------
+
+With --append, an existing output file is extended with only those iterations
+completed since it was last written, rather than reassigning the entire
+simulation. Trajectory labels are carried forward from the last iteration
+already stored. The existing file must have been created (by this version of
+w_assign) with the same bin mapper, macrostates, and input dataset, and may
+not extend past the last completed iteration of the simulation; otherwise,
+an error is raised and the file is left untouched. If the output file does
+not exist, the entire simulation is assigned as usual.
+
+
 -----------------------------------------------------------------------------
 Parallelization
 -----------------------------------------------------------------------------
 
 This tool supports parallelized binning, including reading/calculating input
-data.
+data. Each iteration is divided into slices of segments, which are assigned
+to bins independently of one another and of other iterations. Labeling
+trajectories with the macrostate they last visited is the only step which
+must proceed in iteration order; it is performed by the master as soon as
+each iteration's assignments are complete, while assignment of up to
+--lookahead subsequent iterations continues in the background. Output is
+written by a separate thread.
 
 
 -----------------------------------------------------------------------------
@@ -235,7 +325,12 @@ Command-line options
         self.progress = ProgressIndicatorComponent()
         self.output_file = None
         self.output_filename = None
+        self.append = False
         self.states = []
+        self.binhash = None
+        self.dsspec_id = None
+        self.lookahead = None
+        self.compression = None
     
     def add_args(self, parser):
         self.data_reader.add_args(parser)
@@ -260,6 +355,20 @@ Command-line options
         agroup = parser.add_argument_group('other options')
         agroup.add_argument('-o', '--output', dest='output', default='assign.h5',
                             help='''Store results in OUTPUT (default: %(default)s).''')
+        agroup.add_argument('--append', action='store_true',
+                            help='''If OUTPUT exists, assign only those iterations not already present in it,
+                            rather than reassigning the entire simulation. OUTPUT must have been produced
+                            with the same binning, macrostates, and input dataset.''')
+        agroup.add_argument('--lookahead', type=int, default=4,
+                            help='''Assign up to LOOKAHEAD iterations ahead of the one currently being labeled
+                            and written. Larger values keep more workers busy, at the cost of memory
+                            (default: %(default)d).''')
+        agroup.add_argument('--compression', choices=h5io.compression_codecs, default='gzip',
+                            help='''Compress bin assignments and trajectory labels with the given codec.
+                            "gzip" gives the smallest files; "fast" uses LZ4 or Blosc if available (and
+                            otherwise light gzip compression), which is considerably faster to write and
+                            to read in subsequent analysis. When appending, the existing file's
+                            compression is retained. (Default: %(default)s.)''')
 
 
     def process_args(self, args):
@@ -281,8 +390,19 @@ Command-line options
         if self.states and len(self.states) < 2:
             raise ValueError('zero, two, or more macrostates are required')
 
+        if args.construct_dataset:
+            self.dsspec_id = 'function:{}'.format(args.construct_dataset)
+        else:
+            self.dsspec_id = 'dsspecs:{}'.format(' '.join(args.dsspecs or [self.dssynth.default_dsname]))
+        self.binhash = get_mapper_hash(self.binning.mapper)
+
         #self.output_file = WESTPAH5File(args.output, 'w', creating_program=True)
         self.output_filename = args.output
+        self.append = args.append
+        if args.lookahead < 1:
+            raise ValueError('--lookahead must be at least 1')
+        self.lookahead = args.lookahead
+        self.compression = args.compression
         log.debug('state list: {!r}'.format(self.states))
 
     def parse_cmdline_states(self, state_strings):
@@ -334,59 +454,79 @@ Command-line options
         log.debug('loaded states: {!r}'.format(self.states))
 
 
-    def assign_iteration(self, n_iter, nstates, nbins, state_map, last_labels):
-        ''' Method to encapsulate the segment slicing (into n_worker slices) and parallel job submission
-            Submits job(s), waits on completion, splices them back together
-            Returns: assignments, trajlabels, pops for this iteration'''
-
-        futures = []
+    def submit_iteration(self, n_iter, nsegs, npts):
+        '''Divide the segments of iteration ``n_iter`` into slices (one per worker) and submit them
+        for assignment. Returns an ``_IterAssignment`` to collect the results, and the futures
+        corresponding to each slice.'''
 
-        iter_group = self.data_reader.get_iter_group(n_iter)
-        nsegs, npts = iter_group['pcoord'].shape[:2]
         n_workers = self.work_manager.n_workers or 1
-        assignments = numpy.empty((nsegs, npts), dtype=index_dtype)
-        trajlabels = numpy.empty((nsegs, npts), dtype=index_dtype)
-        statelabels = numpy.empty((nsegs, npts), dtype=index_dtype)
-        pops = numpy.zeros((nstates+1,nbins+1), dtype=weight_dtype)
-
-        #Submit jobs to work manager
         blocksize = nsegs // n_workers
         if nsegs % n_workers > 0:
             blocksize += 1
 
-        def task_gen():
-            if __debug__:
-                checkset = set()
-            for lb in xrange(0, nsegs, blocksize):
-                ub = min(nsegs, lb+blocksize)
-                if __debug__:
-                    checkset.update(set(xrange(lb,ub)))
-                args = ()
-                kwargs = dict(n_iter=n_iter,
-                              lb=lb, ub=ub, mapper=self.binning.mapper, nstates=nstates, state_map=state_map,
-                              last_labels=last_labels, 
-                              parent_id_dsspec=self.data_reader.parent_id_dsspec, 
-                              weight_dsspec=self.data_reader.weight_dsspec,
-                              pcoord_dsspec=self.dssynth.dsspec)
-                yield (_assign_label_pop, args, kwargs)
-
-                #futures.append(self.work_manager.submit(_assign_label_pop, 
-                #kwargs=)
-            if __debug__:
-                assert checkset == set(xrange(nsegs)), 'segments missing: {}'.format(set(xrange(nsegs)) - checkset)
-
-        #for future in self.work_manager.as_completed(futures):
-        for future in self.work_manager.submit_as_completed(task_gen(), queue_size=self.max_queue_len):
-            assign_slice, traj_slice, slice_pops, lb, ub, state_slice = future.get_result(discard=True)
-            assignments[lb:ub, :] = assign_slice
-            trajlabels[lb:ub, :] = traj_slice
-            statelabels[lb:ub, :] = state_slice
-            pops += slice_pops
-            del assign_slice, traj_slice, slice_pops, state_slice
-
-        del futures
+        futures = []
+        for lb in xrange(0, nsegs, blocksize):
+            ub = min(nsegs, lb+blocksize)
+            kwargs = dict(n_iter=n_iter, lb=lb, ub=ub, mapper=self.binning.mapper,
+                          parent_id_dsspec=self.data_reader.parent_id_dsspec, 
+                          weight_dsspec=self.data_reader.weight_dsspec,
+                          pcoord_dsspec=self.dssynth.dsspec)
+            futures.append(self.work_manager.submit(_assign_slice, kwargs=kwargs))
+        return _IterAssignment(nsegs, npts, len(futures)), futures
+
+    def label_iteration(self, iter_assignment, nstates, nbins, state_map, last_labels):
+        '''Label the (complete) bin assignments of one iteration with the macrostate each trajectory
+        last visited, and accumulate labeled populations. Iterations must be labeled in order, as
+        ``last_labels`` are the trajectory labels at the end of the previous iteration.
+        Returns: assignments, trajlabels, pops, statelabels for this iteration'''
+
+        assignments = iter_assignment.assignments
+        trajlabels, statelabels = label_assignments(iter_assignment.parent_ids, nstates, state_map, last_labels,
+                                                    assignments)
+        pops = numpy.zeros((nstates+1,nbins+1), dtype=weight_dtype)
+        accumulate_labeled_populations(iter_assignment.weights, assignments, trajlabels, pops)
         return (assignments, trajlabels, pops, statelabels)
 
+    def check_append(self, nstates, state_map, state_labels, iter_stop):
+        '''Verify that the existing output file was produced with the same bin mapper, macrostates,
+        and input data as requested now, that its datasets can be extended, and that it extends no
+        further than ``iter_stop``. Raises ValueError if not. Returns the iteration range
+        ``(iter_start, iter_stop)`` already assigned.'''
+
+        output_file = self.output_file
+        if self.binhash is None:
+            raise ValueError('cannot append to {}: bin mapper cannot be hashed, so consistency with stored '
+                             'assignments cannot be verified'.format(self.output_filename))
+        if output_file.attrs.get('binhash') != self.binhash:
+            raise ValueError('cannot append to {}: bin mapper differs from that used to create it'
+                             .format(self.output_filename))
+        if output_file.attrs.get('dsspec') != self.dsspec_id:
+            raise ValueError('cannot append to {}: input dataset {!r} differs from that used to create it ({!r})'
+                             .format(self.output_filename, self.dsspec_id, output_file.attrs.get('dsspec')))
+        if int(output_file.attrs['nstates']) != nstates:
+            raise ValueError('cannot append to {}: macrostate definitions differ from those used to create it'
+                             .format(self.output_filename))
+        if nstates:
+            if (list(output_file['state_labels'][...]) != list(state_labels)
+                or (output_file['state_map'][...] != state_map).any()):
+                raise ValueError('cannot append to {}: macrostate definitions differ from those used to create it'
+                                 .format(self.output_filename))
+
+        for dsname in ('nsegs', 'npts', 'assignments', 'labeled_populations', 'trajlabels', 'statelabels'):
+            if dsname in output_file and output_file[dsname].maxshape[0] is not None:
+                raise ValueError('cannot append to {}: dataset {!r} is not extensible'
+                                 .format(self.output_filename, dsname))
+
+        try:
+            stored_iter_start, stored_iter_stop = h5io.get_iter_range(output_file)
+        except KeyError:
+            raise ValueError('cannot append to {}: file is incomplete (was a previous assignment interrupted?)'
+                             .format(self.output_filename))
+        if stored_iter_stop > iter_stop:
+            raise ValueError('cannot append to {}: it already extends to iteration {:d}'
+                             .format(self.output_filename, stored_iter_stop-1))
+        return stored_iter_start, stored_iter_stop
+
     def go(self):
         assert self.data_reader.parent_id_dsspec._h5file is None
         assert self.data_reader.weight_dsspec._h5file is None
@@ -394,28 +534,23 @@ Command-line options
             assert self.dssynth.dsspec._h5file is None
         pi = self.progress.indicator
         pi.operation = 'Initializing'
-        with pi, self.data_reader, WESTPAH5File(self.output_filename, 'w', creating_program=True) as self.output_file:
+
+        appending = self.append and os.path.exists(self.output_filename)
+        output_mode = 'r+' if appending else 'w'
+        with pi, self.data_reader, WESTPAH5File(self.output_filename, output_mode, creating_program=True) as self.output_file:
             assign = self.binning.mapper.assign
 
             # We always assign the entire simulation, so that no trajectory appears to start
-            # in a transition region that doesn't get initialized in one.
+            # in a transition region that doesn't get initialized in one. When appending, the
+            # trajectory labels stored for the last assigned iteration carry this forward.
             iter_start = 1 
             iter_stop =  self.data_reader.current_iteration
 
-            h5io.stamp_iter_range(self.output_file, iter_start, iter_stop)
-
             nbins = self.binning.mapper.nbins
-            self.output_file.attrs['nbins'] = nbins 
 
             state_map = numpy.empty((self.binning.mapper.nbins+1,), index_dtype)
             state_map[:] = 0 # state_id == nstates => unknown state
 
-            # Recursive mappers produce a generator rather than a list of labels
-            # so consume the entire generator into a list
-            labels = [label for label in self.binning.mapper.labels]
-
-            self.output_file.create_dataset('bin_labels', data=labels, compression=9)
-
             if self.states:
                 nstates = len(self.states)
                 state_map[:] = nstates # state_id == nstates => unknown state
@@ -426,19 +561,43 @@ Command-line options
                     state_assignments = assign(sdict['coords'])
                     for assignment in state_assignments:
                         state_map[assignment] = istate
-                self.output_file.create_dataset('state_map', data=state_map, compression=9, shuffle=True)
-                self.output_file['state_labels'] = state_labels #+ ['(unknown)']
             else:
                 nstates = 0
-            self.output_file.attrs['nstates'] = nstates
+                state_labels = []
+
+            if appending:
+                iter_start, first_new_iter = self.check_append(nstates, state_map, state_labels, iter_stop)
+            else:
+                first_new_iter = iter_start
+
+                self.output_file.attrs['nbins'] = nbins 
+                if self.binhash is not None:
+                    self.output_file.attrs['binhash'] = self.binhash
+                self.output_file.attrs['dsspec'] = self.dsspec_id
+
+                # Recursive mappers produce a generator rather than a list of labels
+                # so consume the entire generator into a list
+                labels = [label for label in self.binning.mapper.labels]
+
+                self.output_file.create_dataset('bin_labels', data=labels, compression=9)
+
+                if self.states:
+                    self.output_file.create_dataset('state_map', data=state_map, compression=9, shuffle=True)
+                    self.output_file['state_labels'] = state_labels #+ ['(unknown)']
+                self.output_file.attrs['nstates'] = nstates
 
             iter_count = iter_stop - iter_start
+            n_stored = first_new_iter - iter_start
             nsegs = numpy.empty((iter_count,), seg_id_dtype)
             npts = numpy.empty((iter_count,), seg_id_dtype)
 
+            if n_stored:
+                nsegs[:n_stored] = self.output_file['nsegs'][:n_stored]
+                npts[:n_stored] = self.output_file['npts'][:n_stored]
+
             # scan for largest number of segments and largest number of points
-            pi.new_operation ('Scanning for segment and point counts', iter_stop-iter_start)
-            for iiter, n_iter in enumerate(xrange(iter_start,iter_stop)):
+            pi.new_operation ('Scanning for segment and point counts', iter_stop-first_new_iter)
+            for iiter, n_iter in enumerate(xrange(first_new_iter,iter_stop), n_stored):
                 iter_group = self.data_reader.get_iter_group(n_iter)
                 nsegs[iiter], npts[iiter] = iter_group['pcoord'].shape[0:2]
                 pi.progress += 1
@@ -446,62 +605,121 @@ Command-line options
 
             pi.new_operation('Preparing output')
 
-            # create datasets
-            self.output_file.create_dataset('nsegs', data=nsegs, shuffle=True, compression=9)
-            self.output_file.create_dataset('npts', data=npts, shuffle=True, compression=9)
-
-            max_nsegs = nsegs.max()
-            max_npts = npts.max()
-
+            max_nsegs = nsegs.max() if iter_count else 0
+            max_npts = npts.max() if iter_count else 0
             assignments_shape = (iter_count,max_nsegs,max_npts)
-            assignments_dtype = numpy.min_scalar_type(nbins)
-            assignments_ds = self.output_file.create_dataset('assignments', dtype=assignments_dtype, shape=assignments_shape,
-                                                             compression=4, shuffle=True,
-                                                             chunks=h5io.calc_chunksize(assignments_shape, assignments_dtype),
-                                                             fillvalue=nbins)
-            if self.states:
-                trajlabel_dtype = numpy.min_scalar_type(nstates)
-                trajlabels_ds = self.output_file.create_dataset('trajlabels', dtype=trajlabel_dtype, shape=assignments_shape,
-                                                                compression=4, shuffle=True,
-                                                                chunks=h5io.calc_chunksize(assignments_shape, trajlabel_dtype),
-                                                                fillvalue=nstates)
-                statelabels_ds = self.output_file.create_dataset('statelabels', dtype=trajlabel_dtype, shape=assignments_shape,
-                                                                compression=4, shuffle=True,
-                                                                chunks=h5io.calc_chunksize(assignments_shape, trajlabel_dtype),
-                                                                fillvalue=nstates)
-
             pops_shape = (iter_count,nstates+1,nbins+1)
-            pops_ds = self.output_file.create_dataset('labeled_populations', dtype=weight_dtype, shape=pops_shape,
-                                                      compression=4, shuffle=True,
-                                                      chunks=h5io.calc_chunksize(pops_shape, weight_dtype))
-            h5io.label_axes(pops_ds, ['iteration', 'state', 'bin'])
 
-            pi.new_operation('Assigning to bins', iter_stop-iter_start)
+            if appending:
+                nsegs_ds = self.output_file['nsegs']
+                npts_ds = self.output_file['npts']
+                nsegs_ds.resize((iter_count,))
+                npts_ds.resize((iter_count,))
+                nsegs_ds[n_stored:] = nsegs[n_stored:]
+                npts_ds[n_stored:] = npts[n_stored:]
+
+                assignments_ds = self.output_file['assignments']
+                assignments_shape = (iter_count,
+                                     max(max_nsegs, assignments_ds.shape[1]),
+                                     max(max_npts, assignments_ds.shape[2]))
+                assignments_ds.resize(assignments_shape)
+                if self.states:
+                    trajlabels_ds = self.output_file['trajlabels']
+                    statelabels_ds = self.output_file['statelabels']
+                    trajlabels_ds.resize(assignments_shape)
+                    statelabels_ds.resize(assignments_shape)
+                pops_ds = self.output_file['labeled_populations']
+                pops_ds.resize(pops_shape)
+            else:
+                # create datasets, extensible along every axis that may grow as the simulation proceeds
+                self.output_file.create_dataset('nsegs', data=nsegs, shuffle=True, compression=9, maxshape=(None,))
+                self.output_file.create_dataset('npts', data=npts, shuffle=True, compression=9, maxshape=(None,))
+
+                # chunk per-segment, per-timepoint data by iteration, as it is read by subsequent analysis
+                compression_opts = h5io.get_compression_opts(self.compression)
+                assignments_dtype = numpy.min_scalar_type(nbins)
+                assignments_ds = self.output_file.create_dataset('assignments', dtype=assignments_dtype, shape=assignments_shape,
+                                                                 chunks=h5io.calc_iter_chunksize(assignments_shape, assignments_dtype),
+                                                                 maxshape=(None,None,None),
+                                                                 fillvalue=nbins,
+                                                                 **compression_opts)
+                if self.states:
+                    trajlabel_dtype = numpy.min_scalar_type(nstates)
+                    trajlabels_ds = self.output_file.create_dataset('trajlabels', dtype=trajlabel_dtype, shape=assignments_shape,
+                                                                    chunks=h5io.calc_iter_chunksize(assignments_shape, trajlabel_dtype),
+                                                                    maxshape=(None,None,None),
+                                                                    fillvalue=nstates,
+                                                                    **compression_opts)
+                    statelabels_ds = self.output_file.create_dataset('statelabels', dtype=trajlabel_dtype, shape=assignments_shape,
+                                                                    chunks=h5io.calc_iter_chunksize(assignments_shape, trajlabel_dtype),
+                                                                    maxshape=(None,None,None),
+                                                                    fillvalue=nstates,
+                                                                    **compression_opts)
+
+                pops_ds = self.output_file.create_dataset('labeled_populations', dtype=weight_dtype, shape=pops_shape,
+                                                          compression=4, shuffle=True,
+                                                          chunks=h5io.calc_chunksize(pops_shape, weight_dtype),
+                                                          maxshape=(None,nstates+1,nbins+1))
+                h5io.label_axes(pops_ds, ['iteration', 'state', 'bin'])
+
+            pi.new_operation('Assigning to bins', iter_stop-first_new_iter)
             last_labels = None # mapping of seg_id to last macrostate inhabited      
-            for iiter, n_iter in enumerate(xrange(iter_start,iter_stop)):
-                #get iteration info in this block
-
-                if iiter == 0:
-                    last_labels = numpy.empty((nsegs[iiter],), index_dtype)
-                    last_labels[:] = nstates #unknown state
-
-                #Slices this iteration into n_workers groups of segments, submits them to wm, splices results back together
-                assignments, trajlabels, pops, statelabels = self.assign_iteration(n_iter, nstates, nbins, state_map, last_labels)
-
-                ##Do stuff with this iteration's results
-
-                last_labels = trajlabels[:,-1].copy()
-                assignments_ds[iiter, 0:nsegs[iiter], 0:npts[iiter]] = assignments
-                pops_ds[iiter] = pops
+            if n_stored:
+                # restore trajectory labels as of the end of the last iteration already assigned
                 if self.states:
-                    trajlabels_ds[iiter, 0:nsegs[iiter], 0:npts[iiter]]  = trajlabels
-                    statelabels_ds[iiter, 0:nsegs[iiter], 0:npts[iiter]]  = statelabels
-
-                pi.progress += 1
-                del assignments, trajlabels, pops, statelabels
-
-            for dsname in 'assignments', 'npts', 'nsegs', 'labeled_populations', 'statelabels':
-                h5io.stamp_iter_range(self.output_file[dsname], iter_start, iter_stop)
+                    last_labels = trajlabels_ds[n_stored-1, 0:nsegs[n_stored-1], npts[n_stored-1]-1].astype(index_dtype)
+                else:
+                    last_labels = numpy.empty((nsegs[n_stored-1],), index_dtype)
+                    last_labels[:] = nstates
+
+            if iter_count and n_stored == 0:
+                last_labels = numpy.empty((nsegs[0],), index_dtype)
+                last_labels[:] = nstates #unknown state
+
+            # Bin assignment of each iteration is independent of all others, so it proceeds for up to
+            # self.lookahead iterations ahead of labeling, which must be done in order. Labeled results
+            # are handed off to a separate thread for output.
+            writer = _AssignmentWriter(assignments_ds, pops_ds, 
+                                       trajlabels_ds if self.states else None,
+                                       statelabels_ds if self.states else None,
+                                       maxsize=self.lookahead)
+            try:
+                iter_assignments = {}
+                pending = set()
+                n_submitted = first_new_iter
+                for iiter, n_iter in enumerate(xrange(first_new_iter,iter_stop), n_stored):
+                    while n_submitted < iter_stop and n_submitted - n_iter < self.lookahead:
+                        iisub = n_submitted - iter_start
+                        iter_assignments[n_submitted], futures = self.submit_iteration(n_submitted, nsegs[iisub], npts[iisub])
+                        pending.update(futures)
+                        n_submitted += 1
+                        del futures
+
+                    # collect completed slices (of any iteration) until this iteration is complete
+                    while iter_assignments[n_iter].n_pending:
+                        future = self.work_manager.wait_any(pending)
+                        pending.remove(future)
+                        n_done, lb, ub, assign_slice, parent_id_slice, weight_slice = future.get_result(discard=True)
+                        iter_assignments[n_done].add_slice(lb, ub, assign_slice, parent_id_slice, weight_slice)
+                        del future, assign_slice, parent_id_slice, weight_slice
+
+                    iter_assignment = iter_assignments.pop(n_iter)
+
+                    assignments, trajlabels, pops, statelabels = self.label_iteration(iter_assignment, nstates, nbins, 
+                                                                                      state_map, last_labels)
+                    last_labels = trajlabels[:,-1].copy()
+                    writer.put(iiter, assignments, trajlabels, statelabels, pops)
+                    pi.progress += 1
+                    del iter_assignment, assignments, trajlabels, pops, statelabels
+            finally:
+                writer.close()
+
+            # Stamp iteration ranges only once all iterations are assigned, so that an interrupted
+            # append resumes from the last complete assignment
+            h5io.stamp_iter_range(self.output_file, iter_start, iter_stop)
+            for dsname in 'assignments', 'npts', 'nsegs', 'labeled_populations', 'trajlabels', 'statelabels':
+                if dsname in self.output_file:
+                    h5io.stamp_iter_range(self.output_file[dsname], iter_start, iter_stop)
 
 if __name__ == '__main__':
     WAssign().main()
@@ -16,6 +16,8 @@
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import print_function, division; __metaclass__ = type
+import os, threading, time, atexit
+import multiprocessing, multiprocessing.util
 import logging
 from westtools import (WESTParallelTool, WESTDataReader, IterRangeSelection, 
                        ProgressIndicatorComponent)
@@ -40,10 +42,46 @@ class WESTPACrawler:
         '''Process the result of a per-iteration task.'''
         pass
 
-def _remote_task(n_iter, taskfn):
-    data_manager = westpa.rc.get_data_manager() # gaahhh...globals
-    data_manager.open_backing(mode='r')
-    return n_iter, taskfn(n_iter, data_manager.get_iter_group(n_iter))
+# Read-only data managers held open by each worker for the life of the worker,
+# keyed by (process ID, WEST HDF5 file name)
+_worker_data_managers = {}
+_worker_data_managers_lock = threading.Lock()
+
+def _get_worker_data_manager(we_h5filename):
+    pid = os.getpid()
+    key = (pid, we_h5filename)
+    with _worker_data_managers_lock:
+        try:
+            return _worker_data_managers[key]
+        except KeyError:
+            if not any(dm_pid == pid for (dm_pid, _filename) in _worker_data_managers):
+                # Close this process's data managers when it exits; worker processes started by
+                # multiprocessing do not run atexit handlers, but do run its finalizers
+                atexit.register(_close_worker_data_managers)
+                multiprocessing.util.Finalize(None, _close_worker_data_managers, exitpriority=0)
+            data_manager = westpa.rc.new_data_manager()
+            data_manager.we_h5filename = we_h5filename
+            data_manager.open_backing(mode='r')
+            _worker_data_managers[key] = data_manager
+            return data_manager
+
+def _close_worker_data_managers():
+    '''Close the data managers opened by this process.'''
+    pid = os.getpid()
+    with _worker_data_managers_lock:
+        for key in [key for key in _worker_data_managers if key[0] == pid]:
+            data_manager = _worker_data_managers.pop(key)
+            try:
+                data_manager.close_backing()
+            except Exception as e:
+                log.warning('could not close {}: {}'.format(data_manager.we_h5filename, e))
+
+def _remote_task(n_iter, taskfn, we_h5filename):
+    t0 = time.time()
+    iter_group = _get_worker_data_manager(we_h5filename).get_iter_group(n_iter)
+    t1 = time.time()
+    result = taskfn(n_iter, iter_group)
+    return n_iter, result, t1-t0, time.time()-t1
 
 class WCrawl(WESTParallelTool):
     prog='w_crawl'
@@ -51,8 +89,20 @@ class WCrawl(WESTParallelTool):
 Crawl a weighted ensemble dataset, executing a function for each iteration.
 This can be used for postprocessing of trajectories, cleanup of datasets,
 or anything else that can be expressed as "do X for iteration N, then do
-something with the result". Tasks are parallelized by iteration, and 
-no guarantees are made about evaluation order.
+something with the result". Tasks are parallelized by iteration, and
+no guarantees are made about evaluation order. Results are, however, passed
+to the crawler (see -c/--crawler-instance) in iteration order; results which
+arrive early are held until those of all preceding iterations have been
+processed. Tasks are dispatched no more than --reorder-buffer iterations
+ahead of the first unprocessed result, so that a slow iteration delays
+dispatch rather than letting results for the rest of the run accumulate
+in memory.
+
+Each worker opens the WEST HDF5 file once, read-only, and keeps it open for
+all the tasks it runs, closing it when crawling finishes or the worker exits.
+On completion, the total time workers spent opening the file and locating
+iteration data is reported alongside the time spent in the task function
+and in processing results.
 
 
 -----------------------------------------------------------------------------
@@ -71,6 +121,7 @@ Command-line options
 
         self.crawler = None
         self.task_callable = None
+        self.reorder_buffer = None
 
     def add_args(self, parser):
         self.data_reader.add_args(parser)
@@ -84,6 +135,10 @@ Command-line options
         tgroup.add_argument('task_callable',
                             help='''Run TASK_CALLABLE (specified as module.function) on each iteration.
                             Required.''')
+        tgroup.add_argument('--reorder-buffer', type=int, metavar='NRESULTS',
+                            help='''Dispatch tasks no more than NRESULTS iterations ahead of the earliest
+                            iteration whose result has not yet been processed. (Default: four per worker,
+                            or the maximum queue length if that is greater.)''')
         self.progress.add_args(parser)
 
     def process_args(self, args):
@@ -98,6 +153,16 @@ Command-line options
         else:
             self.crawler = WESTPACrawler()
 
+        if args.reorder_buffer is not None and args.reorder_buffer < 1:
+            raise ValueError('reorder buffer must hold at least one result')
+        self.reorder_buffer = args.reorder_buffer
+
+    def get_reorder_buffer_size(self):
+        if self.reorder_buffer is not None:
+            return self.reorder_buffer
+        n_workers = self.work_manager.n_workers or 1
+        return max(4*n_workers, self.max_queue_len or 0)
+
     def go(self):
         iter_start = self.iter_range.iter_start
         iter_stop = self.iter_range.iter_stop
@@ -110,16 +175,53 @@ Command-line options
 
             try:
                 pi.new_operation('Dispatching tasks & processing results', iter_count)
-                task_gen = ((_remote_task, (n_iter, self.task_callable), {}) for n_iter in xrange(iter_start,iter_stop))
-                for future in self.work_manager.submit_as_completed(task_gen, self.max_queue_len):
-                    n_iter, result = future.get_result(discard=True)
-                    if self.crawler is not None:
-                        self.crawler.process_iter_result(n_iter,result)
-                    pi.progress += 1
+                self.crawl(iter_start, iter_stop)
             finally:
+                # With serial or threaded work managers, tasks ran in this process; close the data
+                # managers they opened before the crawler finalizes
+                _close_worker_data_managers()
                 pi.new_operation('Finalizing')
                 self.crawler.finalize()
 
+    def crawl(self, iter_start, iter_stop):
+        '''Run the task function on iterations ``iter_start`` through ``iter_stop-1``, passing results
+        to the crawler in iteration order.'''
+        pi = self.progress.indicator
+        we_h5filename = os.path.abspath(self.data_reader.we_h5filename)
+        buffer_size = self.get_reorder_buffer_size()
+        queue_len = self.max_queue_len or buffer_size
+
+        pending = set()
+        results = {}
+        n_iter_next_submit = n_iter_next_result = iter_start
+        open_time = task_time = process_time = 0.0
+        while n_iter_next_result < iter_stop:
+            # A result occupies the reorder buffer from the time its task is dispatched until it is
+            # processed, so dispatch only while both the buffer and the work queue have room
+            while (n_iter_next_submit < iter_stop and len(pending) < queue_len
+                   and n_iter_next_submit - n_iter_next_result < buffer_size):
+                pending.add(self.work_manager.submit(_remote_task,
+                                                     args=(n_iter_next_submit, self.task_callable, we_h5filename)))
+                n_iter_next_submit += 1
+
+            future = self.work_manager.wait_any(pending)
+            pending.remove(future)
+            n_iter, result, task_open_time, task_run_time = future.get_result(discard=True)
+            results[n_iter] = result
+            open_time += task_open_time
+            task_time += task_run_time
+            del future, result
+
+            t0 = time.time()
+            while n_iter_next_result in results:
+                self.crawler.process_iter_result(n_iter_next_result, results.pop(n_iter_next_result))
+                n_iter_next_result += 1
+                pi.progress += 1
+            process_time += time.time() - t0
+
+        westpa.rc.pstatus('Worker time opening data: {:.3f} s; in task function: {:.3f} s. '
+                          'Master time processing results: {:.3f} s.'.format(open_time, task_time, process_time))
+
 
 if __name__ == '__main__':
     WCrawl().main()
@@ -7,25 +7,26 @@ import numpy, h5py
 from fasthist import histnd, normhistnd
 from westpa import h5io
 from westpa.h5io import SingleIterDSSpec
+from west.data_manager import n_iter_dtype
 
 log = logging.getLogger('westtools.w_pdist')
 
 
 class DurationDataset:
-    '''A facade for the 'dsspec' dataclass that incorporates the mask into get_iter_data method'''
-
-    def __init__(self, dataset, mask, iter_start=1):
-        self.dataset = dataset
-        self.mask = mask
-        self.dtype = dataset.dtype
+    '''A facade for the 'dsspec' dataclass presenting one field of the selected transition events
+    ending in each iteration, where the events for the i-th iteration from ``iter_start`` are 
+    ``data[offsets[i]:offsets[i+1]]``.'''
+    def __init__(self, data, offsets, iter_start=1):
+        self.data = data
+        self.offsets = offsets
+        self.dtype = data.dtype
         self.iter_start = iter_start
 
     def get_iter_data(self, n_iter):
-        try:
-            assert n_iter >= self.iter_start
-            dset = self.dataset[n_iter-1][self.mask[n_iter-self.iter_start]]
-        except(AssertionError, IndexError):
+        iiter = n_iter - self.iter_start
+        if iiter < 0 or iiter >= len(self.offsets) - 1:
             raise ValueError, "Iteration {} is not within the iteration range".format(n_iter)
+        dset = self.data[self.offsets[iiter]:self.offsets[iiter+1]]
         nsegs = dset.shape[0]
         if nsegs == 0:
             return None
@@ -53,7 +54,7 @@ def _remote_min_max(ndim, dset_dtype, n_iter, dsspec):
 
     dset = dsspec.get_iter_data(n_iter)
 
-    if dset == None:
+    if dset is None:
         return data_range
 
     for idim in xrange(ndim):
@@ -286,13 +287,14 @@ Command-line options
         pi = self.progress.indicator
         pi.operation = 'Initializing'
         with pi:
-            self.duration = self.kinetics_file['durations'][self.iter_start-1:self.iter_stop-1]
+            events = self.read_events()
 
             ##Only select transition events from specified istate to fstate
-            mask = (self.duration['istate'] == self.istate) & (self.duration['fstate'] == self.fstate)
+            events = events[(events['istate'] == self.istate) & (events['fstate'] == self.fstate)]
+            offsets = numpy.searchsorted(events['n_iter'], numpy.arange(self.iter_start, self.iter_stop+1))
 
-            self.duration_dsspec = DurationDataset(self.kinetics_file['durations']['duration'], mask, self.iter_start)
-            self.wt_dsspec = DurationDataset(self.kinetics_file['durations']['weight'], mask, self.iter_start)
+            self.duration_dsspec = DurationDataset(events['duration'], offsets, self.iter_start)
+            self.wt_dsspec = DurationDataset(events['weight'], offsets, self.iter_start)
 
             self.output_file = h5py.File(self.output_filename, 'w')
             h5io.stamp_creator_data(self.output_file)
@@ -314,6 +316,28 @@ Command-line options
             
             self.output_file.close()
 
+    def read_events(self):
+        '''Read transition events ending in iterations [iter_start, iter_stop) from the kinetics file,
+        as a flat array in order of iteration, with ``n_iter`` recorded for each event.'''
+        durations_ds = self.kinetics_file['durations']
+        kin_iter_start = self.kinetics_file.attrs.get('iter_start', 1)
+        iter_lb = self.iter_start - kin_iter_start
+        iter_ub = self.iter_stop - kin_iter_start
+        
+        if durations_ds.ndim == 1:
+            offsets = self.kinetics_file['duration_offsets']
+            return durations_ds[offsets[iter_lb]:offsets[iter_ub]]
+        
+        # Files from earlier versions store events as [iteration][event], padded to the largest number of
+        # events in any iteration
+        counts = self.kinetics_file['duration_count'][iter_lb:iter_ub]
+        ragged = durations_ds[iter_lb:iter_ub]
+        events = numpy.empty((counts.sum(),), dtype=[('n_iter', n_iter_dtype)] + ragged.dtype.descr)
+        for field in ragged.dtype.names:
+            events[field] = numpy.concatenate([ragged[field][i,:count] for (i, count) in enumerate(counts)])
+        events['n_iter'] = numpy.repeat(numpy.arange(self.iter_start, self.iter_stop), counts)
+        return events
+
     @staticmethod    
     def parse_binspec(binspec):
 
@@ -16,6 +16,7 @@
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import print_function, division; __metaclass__ = type
+import os
 import numpy, h5py
 from scipy.signal import fftconvolve
 
@@ -38,6 +39,9 @@ target_index_dtype = numpy.dtype([('target_label', vstr_dtype),
 
 from westtools.dtypes import iter_block_ci_dtype as ci_dtype
 
+# Number of iterations of recycling data to tally at once
+extract_block_size = 256
+
 def _extract_fluxes_fileversion_lt_7(iter_start, iter_stop, data_manager):
     '''Extract fluxes from old format, where groups for iterations where recyling
     occurs contain a 'recycling' table.'''
@@ -81,46 +85,125 @@ def _extract_fluxes_fileversion_7(iter_start, iter_stop, data_manager):
     # The most correct way to do this is tracing trajectories,
     # and warning if the boundary conditions change during the trace,
     # but that's for another tool.
-    by_target = {}
     
-    for iiter, n_iter in enumerate(xrange(iter_start, iter_stop)):
-        target_states = data_manager.get_target_states(n_iter)
-        try:
-            new_weight_index = data_manager.get_iter_group(n_iter+1)['new_weights']['index']
-        except KeyError:
-            # no recycling data available
-            continue
-        
-        for tstate in target_states:
+    # Load each set of target states in use once, numbering targets by label. Each set
+    # is described by a mapping of its state IDs onto label indices, stored contiguously
+    # in state_labels beginning at set_offsets[set_id]. Should a label be repeated
+    # within a set, only the last state bearing it counts towards its flux.
+    try:
+        tstate_index = data_manager.we_h5file['tstates']['index'][...]
+    except KeyError:
+        return {}
+    set_ids = (numpy.digitize(iters, tstate_index['iter_valid']) - 1) % len(tstate_index)
+    labels = []
+    label_ids = {}
+    set_states = []
+    for set_id in xrange(len(tstate_index)):
+        if (set_ids == set_id).any():
+            n_iter = iters[numpy.argmax(set_ids == set_id)]
+            set_labels = [tstate.label for tstate in data_manager.get_target_states(n_iter)]
+        else:
+            set_labels = []
+        for label in set_labels:
+            if label not in label_ids:
+                label_ids[label] = len(labels)
+                labels.append(label)
+        set_states.append([label_ids[label] if label not in set_labels[istate+1:] else -1
+                           for (istate, label) in enumerate(set_labels)])
+    n_labels = len(labels)
+    set_n_states = numpy.array(map(len, set_states), dtype=numpy.int64)
+    set_offsets = numpy.concatenate([[0], numpy.cumsum(set_n_states)])
+    state_labels = numpy.array(sum(set_states, []), dtype=numpy.int64)
+    set_present = numpy.zeros((len(set_states), n_labels), dtype=numpy.bool_)
+    for set_id, states in enumerate(set_states):
+        set_present[set_id, [ilabel for ilabel in states if ilabel >= 0]] = True
+    
+    fluxes = numpy.zeros((iter_count, n_labels), dtype=weight_dtype)
+    counts = numpy.zeros((iter_count, n_labels), dtype=numpy.int64)
+    have_recycling = numpy.zeros((iter_count,), dtype=numpy.bool_)
+    
+    for block_start in xrange(0, iter_count, extract_block_size):
+        block_stop = min(iter_count, block_start+extract_block_size)
+        new_weight_indices = []
+        block_iiters = []
+        for iiter in xrange(block_start, block_stop):
             try:
-                target_info = by_target[tstate.label]
+                new_weight_index = data_manager.get_iter_group(iters[iiter]+1)['new_weights']['index'][...]
             except KeyError:
-                # State not seen before
-                target_info = by_target[tstate.label] = numpy.zeros((iter_count,), dtype=fluxentry_dtype) 
-                # If the target happens not to exist in an iteration (for whatever reason),
-                # store a count of -1 as a sentinel
-                target_info['count'][:] = -1
-                target_info['n_iter'][:] = iters[:]
-                
-            recycled_from_tstate = ( (new_weight_index['source_type'] == NewWeightEntry.NW_SOURCE_RECYCLED)
-                                    &(new_weight_index['target_state_id'] == tstate.state_id)
-                                   )
-            
-            recycle_count = recycled_from_tstate.sum()
-            target_info['count'][iiter] = recycle_count
-            if recycle_count:
-                # flux is in units of per tau
-                target_info['flux'][iiter] = new_weight_index[recycled_from_tstate]['weight'].sum()
+                # no recycling data available
+                continue
+            have_recycling[iiter] = True
+            new_weight_indices.append(new_weight_index)
+            block_iiters.append(numpy.repeat(iiter-block_start, len(new_weight_index)))
+        if not new_weight_indices or not n_labels:
+            continue
+        
+        new_weight_index = numpy.concatenate(new_weight_indices)
+        block_iiters = numpy.concatenate(block_iiters)
+        recycled = new_weight_index['source_type'] == NewWeightEntry.NW_SOURCE_RECYCLED
+        state_ids = new_weight_index['target_state_id'][recycled].astype(numpy.int64)
+        block_iiters = block_iiters[recycled]
+        weights = new_weight_index['weight'][recycled]
         
-        del new_weight_index, target_states
+        # Identify the target (label) from which each walker was recycled, discarding state
+        # IDs not in use in the walker's iteration
+        iter_set_ids = set_ids[block_iiters + block_start]
+        valid = (state_ids >= 0) & (state_ids < set_n_states[iter_set_ids])
+        target_ids = numpy.empty_like(state_ids)
+        target_ids[valid] = state_labels[set_offsets[iter_set_ids[valid]] + state_ids[valid]]
+        valid[valid] = target_ids[valid] >= 0
+        
+        # Tally all targets in all iterations of this block at once
+        # flux is in units of per tau
+        bin_ids = block_iiters[valid]*n_labels + target_ids[valid]
+        block_len = (block_stop - block_start)*n_labels
+        counts[block_start:block_stop] = numpy.bincount(bin_ids, minlength=block_len).reshape(-1, n_labels)
+        fluxes[block_start:block_stop] = numpy.bincount(bin_ids, weights=weights[valid],
+                                                        minlength=block_len).reshape(-1, n_labels)
+        del new_weight_indices, new_weight_index
     
-    # Find the last contiguous run where target is available
-    for target_label in by_target:
-        fluxdata = by_target[target_label]
-        by_target[target_label] = fluxdata[numpy.searchsorted(fluxdata['count'],[0])[0]:]
+    # Targets have data for iterations which have recycling data and in which they are defined;
+    # in other iterations, a count of -1 is stored as a sentinel
+    present = have_recycling[:,None] & set_present[set_ids]
+    by_target = {}
+    for ilabel, label in enumerate(labels):
+        if not present[:,ilabel].any():
+            continue
+        target_info = by_target[label] = numpy.zeros((iter_count,), dtype=fluxentry_dtype)
+        target_info['n_iter'] = iters
+        target_info['count'] = numpy.where(present[:,ilabel], counts[:,ilabel], -1)
+        target_info['flux'] = fluxes[:,ilabel]
         
     return by_target
 
+def _trim_fluxdata(fluxdata):
+    '''Drop the leading iterations, marked by a count of -1, in which each target of the given
+    dictionary of flux data was not yet available, so that the data for each target begin with
+    the first iteration in which it was defined.'''
+    missing_count = numpy.array(-1).astype(fluxentry_dtype['count'])
+    trimmed = {}
+    for target_label, target_fluxdata in fluxdata.iteritems():
+        available = numpy.flatnonzero(target_fluxdata['count'] != missing_count)
+        trimmed[target_label] = target_fluxdata[available[0]:] if len(available) else target_fluxdata[:0]
+    return trimmed
+
+def _merge_fluxdata(iter_start, iter_stop, *fluxdatas):
+    '''Combine dictionaries of flux data, as returned by ``extract_fluxes()``, covering
+    parts of the iteration range [iter_start, iter_stop) into one covering all of it. Later
+    dictionaries take precedence over earlier ones.'''
+    iters = numpy.arange(iter_start, iter_stop, dtype=n_iter_dtype)
+    merged = {}
+    for fluxdata in fluxdatas:
+        for target_label, target_fluxdata in fluxdata.iteritems():
+            try:
+                target_info = merged[target_label]
+            except KeyError:
+                target_info = merged[target_label] = numpy.zeros((len(iters),), dtype=fluxentry_dtype)
+                target_info['count'][:] = -1
+                target_info['n_iter'][:] = iters
+            target_info[target_fluxdata['n_iter'].astype(numpy.int64) - iter_start] = target_fluxdata
+    return merged
+
 def extract_fluxes(iter_start=None, iter_stop=None, data_manager=None):
     '''Extract flux values from the WEST HDF5 file for iterations >= iter_start
     and < iter_stop, optionally using another data manager instance instead of the
@@ -139,7 +222,7 @@ def extract_fluxes(iter_start=None, iter_stop=None, data_manager=None):
     if data_manager.we_h5file_version < 7:
         return _extract_fluxes_fileversion_lt_7(iter_start, iter_stop, data_manager)
     else:
-        return _extract_fluxes_fileversion_7(iter_start, iter_stop,data_manager)
+        return _trim_fluxdata(_extract_fluxes_fileversion_7(iter_start, iter_stop,data_manager))
     
 
 class WFluxanlTool(WESTTool):
@@ -154,6 +237,14 @@ All non-graphical output (including that to the terminal and HDF5) assumes that
 the propagation/resampling period ``tau`` is equal to unity; to obtain results
 in familiar units, divide all fluxes and multiply all correlation lengths by
 the true value of ``tau``.
+
+With --append, per-iteration fluxes stored in an existing output file are
+reused, and only iterations completed since it was last written are read
+from the WEST HDF5 file; averages and confidence intervals are then
+recalculated over the entire iteration range. The existing file must
+have been created (by this version of w_fluxanl) with the same starting
+iteration; otherwise, an error is raised and the file is left untouched.
+If the output file does not exist, all iterations are processed as usual.
 '''
     
     output_format_version = 2
@@ -162,7 +253,9 @@ the true value of ``tau``.
         super(WFluxanlTool,self).__init__()
         self.data_reader = WESTDataReader()
         self.iter_range = IterRangeSelection()
+        self.output_filename = None
         self.output_h5file = None
+        self.append = False
         self.output_group = None
         self.target_groups = {}
 
@@ -180,6 +273,9 @@ the true value of ``tau``.
         ogroup = parser.add_argument_group('output options')
         ogroup.add_argument('-o', '--output', default='fluxanl.h5',
                             help='Store intermediate data and analysis results to OUTPUT (default: %(default)s).')
+        ogroup.add_argument('--append', action='store_true',
+                            help='''If OUTPUT exists, reuse the per-iteration fluxes stored in it, extracting only
+                            those for iterations completed since it was written.''')
         cgroup = parser.add_argument_group('calculation options')
         cgroup.add_argument('-a', '--alpha', type=float, default=0.05, 
                              help='''Calculate a (1-ALPHA) confidence interval on the average flux'
@@ -203,7 +299,8 @@ the true value of ``tau``.
         self.iter_range.data_manager = self.data_reader
         self.iter_range.process_args(args)
         
-        self.output_h5file = h5py.File(args.output, 'w')
+        self.output_filename = args.output
+        self.append = args.append
         
         self.alpha = args.alpha
         self.autocorrel_alpha = args.acalpha or self.alpha
@@ -216,12 +313,28 @@ the true value of ``tau``.
         westpa.rc.pstatus('Calculating mean flux and confidence intervals for iterations [{},{})'
                         .format(self.iter_range.iter_start, self.iter_range.iter_stop))
         
-        fluxdata = extract_fluxes(self.iter_range.iter_start, self.iter_range.iter_stop, self.data_reader)
+        iter_start, iter_stop = self.iter_range.iter_start, self.iter_range.iter_stop
+        
+        # Recycling data for the most recent iteration are not yet complete
+        extracted_iter_stop = min(iter_stop, self.data_reader.current_iteration)
+        
+        if self.append and os.path.exists(self.output_filename):
+            stored_fluxdata, first_new_iter = self.load_stored_fluxdata()
+            westpa.rc.pstatus('Reusing fluxes stored in {} for iterations [{},{})'
+                              .format(self.output_filename, iter_start, first_new_iter))
+            new_fluxdata = extract_fluxes(first_new_iter, iter_stop, self.data_reader) if first_new_iter < iter_stop else {}
+            # Merging pads each target back to iter_start, so trim as for freshly-extracted data
+            fluxdata = _trim_fluxdata(_merge_fluxdata(iter_start, iter_stop, stored_fluxdata, new_fluxdata))
+        else:
+            fluxdata = extract_fluxes(iter_start, iter_stop, self.data_reader)
+        
+        self.output_h5file = h5py.File(self.output_filename, 'w')
         
         # Create a group to store data in
         output_group = h5io.create_hdf5_group(self.output_h5file, 'target_flux', replace=False, creating_program=self.prog)        
         self.output_group = output_group
         output_group.attrs['version_code'] = self.output_format_version
+        output_group.attrs['extracted_iter_stop'] = extracted_iter_stop
         self.iter_range.record_data_iter_range(output_group)
         
         n_targets = len(fluxdata)
@@ -275,6 +388,44 @@ the true value of ``tau``.
         self.output_h5file['avg_flux'] = avg_fluxdata
         
         
+
+    def load_stored_fluxdata(self):
+        '''Read the per-iteration fluxes stored in the existing output file, verifying that they
+        were produced by this version of w_fluxanl from the same starting iteration as requested
+        now. Raises ValueError if not. Returns a dictionary of flux data, as for ``extract_fluxes()``,
+        and the first iteration for which fluxes must be extracted anew.'''
+        
+        with h5py.File(self.output_filename, 'r') as output_file:
+            try:
+                output_group = output_file['target_flux']
+                version_code = output_group.attrs['version_code']
+                iter_start, iter_stop = h5io.get_iter_range(output_group)
+                extracted_iter_stop = int(output_group.attrs['extracted_iter_stop'])
+                index = output_group['index'][...]
+            except KeyError:
+                raise ValueError('cannot append to {}: file is incomplete or was not created by this version of {}'
+                                 .format(self.output_filename, self.prog))
+            if version_code != self.output_format_version:
+                raise ValueError('cannot append to {}: file was not created by this version of {}'
+                                 .format(self.output_filename, self.prog))
+            if iter_start != self.iter_range.iter_start:
+                raise ValueError('cannot append to {}: it begins at iteration {:d}, not {:d}'
+                                 .format(self.output_filename, iter_start, self.iter_range.iter_start))
+            if iter_stop > self.iter_range.iter_stop:
+                raise ValueError('cannot append to {}: it already extends to iteration {:d}'
+                                 .format(self.output_filename, iter_stop-1))
+            
+            fluxdata = {}
+            for itarget, target_label in enumerate(index['target_label']):
+                target_group = output_group['target_{}'.format(itarget)]
+                n_iters = target_group['n_iter'][...]
+                target_fluxdata = numpy.empty((len(n_iters),), dtype=fluxentry_dtype)
+                target_fluxdata['n_iter'] = n_iters
+                target_fluxdata['count'] = target_group['count'][...]
+                target_fluxdata['flux'] = target_group['flux'][...]
+                fluxdata[str(target_label)] = target_fluxdata[n_iters < extracted_iter_stop]
+        
+        return fluxdata, extracted_iter_stop
          
     def calc_evol_flux(self):
         westpa.rc.pstatus('Calculating cumulative evolution of flux confidence intervals every {} iteration(s)'
@@ -18,20 +18,19 @@
 from __future__ import print_function, division; __metaclass__ = type
 import logging
 
-import sys, random, math
-import numpy, h5py
-from h5py import h5s
+import sys, random, math, warnings
+import numpy, scipy.sparse, h5py
 
 import westpa
 from west.data_manager import weight_dtype, n_iter_dtype
 from westtools import (WESTMasterCommand, WESTParallelTool, WESTDataReader, IterRangeSelection, WESTSubcommand,
                        ProgressIndicatorComponent)
 from westpa import h5io
-from westpa.kinetics import labeled_flux_to_rate, sequence_macro_flux_to_rate
-from westpa.kinetics.matrates import get_macrostate_rates
+from westpa.kinetics import labeled_flux_to_rate, sequence_macro_flux_to_rate, SteadyStateSolver
+from westpa.kinetics.matrates import get_sparse_macrostate_rates
 
 import mclib
-from mclib import mcbs_correltime, mcbs_ci_correl
+from mclib import mcbs_correltime, mcbs_ci_correl_multi
 
 
 log = logging.getLogger('westtools.w_kinavg')
@@ -146,26 +145,26 @@ class KinAvgSubcommands(WESTSubcommand):
 
         
 def _eval_block(iblock, start, stop, nstates, total_fluxes, cond_fluxes, rates, mcbs_alpha, mcbs_nsets, mcbs_acalpha):
-    results = [[],[],[]]
+    # All fluxes and rates are bootstrapped in one call; those sharing a correlation time share resampling indices
+    offdiag = ~numpy.eye(nstates, dtype=numpy.bool_)
+    targets = numpy.hstack([total_fluxes, cond_fluxes[:,offdiag], rates[:,offdiag]])
+    ci_res = mcbs_ci_correl_multi(targets, alpha=mcbs_alpha, n_sets=mcbs_nsets, autocorrel_alpha=mcbs_acalpha,
+                                  subsample=numpy.mean)
+    
+    target_cis = numpy.zeros((targets.shape[1],), dtype=ci_dtype)
+    target_cis['iter_start'] = start
+    target_cis['iter_stop'] = stop
+    for field, values in zip(('expected', 'ci_lbound', 'ci_ubound', 'corr_len'), ci_res):
+        target_cis[field] = values
+    
     # results are target fluxes, conditional fluxes, rates
-    for istate in xrange(nstates):
-        ci_res = mcbs_ci_correl(total_fluxes[:,istate],estimator=numpy.mean,
-                                    alpha=mcbs_alpha,n_sets=mcbs_nsets,autocorrel_alpha=mcbs_acalpha,
-                                    subsample=numpy.mean)
-        results[0].append((iblock,istate,(start,stop)+ci_res))
-        
-        for jstate in xrange(nstates):
-            if istate == jstate: continue
-            ci_res = mcbs_ci_correl(cond_fluxes[:,istate,jstate],estimator=numpy.mean,
-                                    alpha=mcbs_alpha,n_sets=mcbs_nsets,autocorrel_alpha=mcbs_acalpha,
-                                    subsample=numpy.mean)
-            results[1].append((iblock, istate, jstate, (start,stop) + ci_res))
-            
-            ci_res = mcbs_ci_correl(rates[:,istate,jstate],estimator=numpy.mean,
-                                    alpha=mcbs_alpha,n_sets=mcbs_nsets,autocorrel_alpha=mcbs_acalpha,
-                                    subsample=numpy.mean)
-            results[2].append((iblock, istate, jstate, (start,stop) + ci_res))
-    return results
+    noffdiag = nstates*(nstates-1)
+    results = [target_cis[:nstates],
+               numpy.zeros((nstates,nstates), dtype=ci_dtype),
+               numpy.zeros((nstates,nstates), dtype=ci_dtype)]
+    results[1][offdiag] = target_cis[nstates:nstates+noffdiag]
+    results[2][offdiag] = target_cis[nstates+noffdiag:]
+    return iblock, results
         
 class AvgTraceSubcommand(KinAvgSubcommands):
     subcommand = 'trace'
@@ -197,35 +196,42 @@ class AvgTraceSubcommand(KinAvgSubcommands):
             rates = h5io.IterBlockedDataset.empty_like(cond_fluxes)
             rates.data = sequence_macro_flux_to_rate(cond_fluxes.data, pops.data[:nstates,:nbins])
             
-            avg_total_fluxes = numpy.zeros((nstates,), dtype=ci_dtype)
-            avg_conditional_fluxes = numpy.zeros((nstates,nstates), dtype=ci_dtype)
-            avg_rates = numpy.zeros((nstates,nstates), dtype=ci_dtype)
+            # Calculate overall averages and their evolution in parallel, one task per block
+            blocks = []
+            if self.evolution_mode != 'none' and step_iter:
+                for start in xrange(start_iter, stop_iter, step_iter):
+                    stop = min(start+step_iter, stop_iter)
+                    if self.evolution_mode == 'cumulative':
+                        windowsize = int(self.evol_window_frac * (stop - start_iter))
+                        block_start = max(start_iter, stop - windowsize)
+                    else: # self.evolution_mode == 'blocked'
+                        block_start = start
+                    blocks.append((block_start, stop))
             
-            # Calculate overall average rates
-            pi.new_operation('Averaging overall fluxes into states', nstates)
-            for istate in xrange(nstates):
-                ci_res = mcbs_ci_correl(total_fluxes.iter_slice(start_iter,stop_iter)[:,istate],estimator=numpy.mean,
-                                            alpha=self.mcbs_alpha,n_sets=self.mcbs_nsets,autocorrel_alpha=self.mcbs_acalpha,
-                                            subsample=numpy.mean)
-                avg_total_fluxes[istate] = (start_iter, stop_iter) + ci_res
-                pi.progress += 1
+            pi.new_operation('Calculating averages and flux/rate evolution', len(blocks)+1)
+            futures = []
+            for iblock, (block_start, stop) in enumerate([(start_iter, stop_iter)] + blocks):
+                future = self.work_manager.submit(_eval_block, kwargs=dict(iblock=iblock-1, start=block_start, stop=stop,
+                                                                           nstates=nstates,
+                                                                           total_fluxes=total_fluxes.iter_slice(block_start,stop),
+                                                                           cond_fluxes = cond_fluxes.iter_slice(block_start,stop),
+                                                                           rates=rates.iter_slice(block_start,stop),
+                                                                           mcbs_alpha=self.mcbs_alpha, mcbs_nsets=self.mcbs_nsets,
+                                                                           mcbs_acalpha=self.mcbs_acalpha))
+                futures.append(future)
             
-            pi.new_operation('Averaging state-to-state fluxes and rates', nstates*(nstates-1))
-            for istate in xrange(nstates):
-                for jstate in xrange(nstates):
-                    if istate == jstate: continue
-                    
-                    flux_ci_res = mcbs_ci_correl(cond_fluxes.iter_slice(start_iter,stop_iter)[:,istate,jstate],estimator=numpy.mean,
-                                                 alpha=self.mcbs_alpha,n_sets=self.mcbs_nsets,autocorrel_alpha=self.mcbs_acalpha,
-                                                 subsample=numpy.mean)
-                    
-                    rate_ci_res = mcbs_ci_correl(rates.iter_slice(start_iter,stop_iter)[:,istate,jstate],estimator=numpy.mean,
-                                                 alpha=self.mcbs_alpha,n_sets=self.mcbs_nsets,autocorrel_alpha=self.mcbs_acalpha,
-                                                 subsample=numpy.mean)
-                    
-                    avg_conditional_fluxes[istate, jstate] = (start_iter, stop_iter) + flux_ci_res
-                    avg_rates[istate, jstate] = (start_iter, stop_iter) + rate_ci_res
-                    pi.progress += 1
+            target_evol = numpy.zeros((len(blocks), nstates), dtype=ci_dtype)
+            flux_evol = numpy.zeros((len(blocks), nstates, nstates), dtype=ci_dtype)
+            rate_evol = numpy.zeros((len(blocks), nstates, nstates), dtype=ci_dtype)
+            for future in self.work_manager.as_completed(futures):
+                pi.progress += 1
+                iblock, (target_results, condflux_results, rate_results) = future.get_result(discard=True)
+                if iblock < 0:
+                    avg_total_fluxes, avg_conditional_fluxes, avg_rates = target_results, condflux_results, rate_results
+                else:
+                    target_evol[iblock] = target_results
+                    flux_evol[iblock] = condflux_results
+                    rate_evol[iblock] = rate_results
                     
             pi.new_operation('Saving averages')
             self.output_file['avg_rates'] = avg_rates
@@ -270,46 +276,8 @@ class AvgTraceSubcommand(KinAvgSubcommands):
                                   maxlabellen=maxlabellen))
             
             # skip evolution if not requested
-            if self.evolution_mode == 'none' or not step_iter: return
-            
-            start_pts = range(start_iter, stop_iter, step_iter)
-            target_evol = numpy.zeros((len(start_pts), nstates), dtype=ci_dtype)
-            flux_evol = numpy.zeros((len(start_pts), nstates, nstates), dtype=ci_dtype)
-            rate_evol = numpy.zeros((len(start_pts), nstates, nstates), dtype=ci_dtype)
-            pi.new_operation('Calculating flux/rate evolution', len(start_pts))
-            futures = []
-            for iblock, start in enumerate(start_pts):
-                stop = min(start+step_iter, stop_iter)
-                if self.evolution_mode == 'cumulative':
-                    windowsize = int(self.evol_window_frac * (stop - start_iter))
-                    block_start = max(start_iter, stop - windowsize)
-                else: # self.evolution_mode == 'blocked'
-                    block_start = start
-                
-                future = self.work_manager.submit(_eval_block, kwargs=dict(iblock=iblock, start=block_start, stop=stop,
-                                                                           nstates=nstates,
-                                                                           total_fluxes=total_fluxes.iter_slice(block_start,stop),
-                                                                           cond_fluxes = cond_fluxes.iter_slice(block_start,stop),
-                                                                           rates=rates.iter_slice(block_start,stop),
-                                                                           mcbs_alpha=self.mcbs_alpha, mcbs_nsets=self.mcbs_nsets,
-                                                                           mcbs_acalpha=self.mcbs_acalpha))
-                futures.append(future)
+            if not blocks: return
             
-            for future in self.work_manager.as_completed(futures):
-                pi.progress += 1
-                target_results, condflux_results, rate_results = future.get_result(discard=True)
-                for result in target_results:
-                    iblock,istate,ci_result = result
-                    target_evol[iblock,istate] = ci_result
-                    
-                for result in condflux_results:
-                    iblock,istate,jstate,ci_result = result
-                    flux_evol[iblock,istate, jstate] = ci_result
-                
-                for result in rate_results:
-                    iblock, istate, jstate, ci_result = result 
-                    rate_evol[iblock, istate, jstate] = ci_result
-
             df_ds = self.output_file.create_dataset('conditional_flux_evolution', data=flux_evol, shuffle=True, compression=9)
             tf_ds = self.output_file.create_dataset('target_flux_evolution', data=target_evol, shuffle=True, compression=9)
             rate_ds = self.output_file.create_dataset('rate_evolution', data=rate_evol, shuffle=True, compression=9)
@@ -318,103 +286,139 @@ class AvgTraceSubcommand(KinAvgSubcommands):
                 self.stamp_mcbs_info(ds)
 
 
-def _calc_ci_block(block_label, assignments_filename, kinetics_filename, istate, jstate, start_iter, stop_iter,
+def _read_labeled_fluxes(kinetics_file, start_iter, stop_iter, nstates, nbins):
+    '''Read the nonzero labeled bin-to-bin fluxes for iterations [start_iter, stop_iter) from
+    ``kinetics_file``. Returns ``(offsets, indices, fluxes)``, where ``indices`` are linear indices into
+    a nested [state][state][bin][bin] matrix, and the entries for the ``i``th iteration of the window
+    are ``offsets[i]:offsets[i+1]``. Both sparse and (older) dense storage are supported.'''
+    
+    fluxes_obj = kinetics_file['labeled_bin_fluxes']
+    if h5io.SparseIterMatrix.is_sparse(fluxes_obj):
+        offsets, rows, cols, fluxes = h5io.SparseIterMatrix(fluxes_obj).iter_slice_entries(start_iter, stop_iter)
+        rows = rows.astype(numpy.intp)
+        cols = cols.astype(numpy.intp)
+        ibins, istates = numpy.divmod(rows, nstates)
+        jbins, jstates = numpy.divmod(cols, nstates)
+        indices = ((istates*nstates + jstates)*nbins + ibins)*nbins + jbins
+    else:
+        fluxes_iter_start = fluxes_obj.attrs.get('iter_start',1)
+        niters = stop_iter - start_iter
+        offsets = numpy.zeros((niters+1,), numpy.int64)
+        index_blocks = []
+        flux_blocks = []
+        for iiter, n_iter in enumerate(xrange(start_iter, stop_iter)):
+            labeled_fluxes = fluxes_obj[n_iter-fluxes_iter_start].ravel()
+            nonzero = labeled_fluxes.nonzero()[0]
+            index_blocks.append(nonzero)
+            flux_blocks.append(labeled_fluxes[nonzero])
+            offsets[iiter+1] = offsets[iiter] + len(nonzero)
+        indices = numpy.concatenate(index_blocks)
+        fluxes = numpy.concatenate(flux_blocks)
+    return offsets, indices, fluxes
+
+def _calc_ci_block(block_label, assignments_filename, kinetics_filename, start_iter, stop_iter,
                    mcbs_alpha, mcbs_acalpha, mcbs_nsets, extrapolate):
-    log.debug('istate={} jstate={} start_iter={} stop_iter={}'.format(istate,jstate,start_iter,stop_iter))
-    assignments_file = h5py.File(assignments_filename, 'r')
-    kinetics_file = h5py.File(kinetics_filename, 'r')
+    '''Calculate averages and confidence intervals of all state-to-state rates in the window
+    [start_iter, stop_iter). Returns ``(block_label, rates)``, where ``rates`` is an
+    [nstates][nstates] array of ``iter_block_ci_dtype``.'''
+    log.debug('start_iter={} stop_iter={}'.format(start_iter,stop_iter))
     
-    nstates, nbins = assignments_file.attrs['nstates'], assignments_file.attrs['nbins']        
+    # Only nonzero fluxes are read, once for the whole window; averages (including
+    # those of bootstrap samples) are then weighted sums over iterations
+    with h5py.File(assignments_filename, 'r') as assignments_file, h5py.File(kinetics_filename, 'r') as kinetics_file:
+        nstates, nbins = assignments_file.attrs['nstates'], assignments_file.attrs['nbins']
+        pops_ds = assignments_file['labeled_populations']
+        pops_iter_start = pops_ds.attrs.get('iter_start',1)
+        labeled_pops = pops_ds[start_iter-pops_iter_start:stop_iter-pops_iter_start,:nstates,:nbins]
+        offsets, indices, fluxes = _read_labeled_fluxes(kinetics_file, start_iter, stop_iter, nstates, nbins)
+
     niters = stop_iter - start_iter
+    nfbins = nstates*nbins
+    entry_iters = numpy.repeat(numpy.arange(niters), numpy.diff(offsets))
     
-    # Fluxes and populations are averaged as they are read, as these are generally
-    # very large datasets
-    avg_fluxes = numpy.zeros((nstates,nstates,nbins,nbins), weight_dtype)
-    avg_pops = numpy.zeros((nstates,nbins), weight_dtype)
-    
-    # Per-iteration macrostate-macrostate fluxes, for correlation calculation
-    macro_fluxes = numpy.empty((niters, nstates, nstates), weight_dtype)
+    # Nonzero elements of the window's (flat) labeled rate matrix, which include those of any
+    # bootstrap sample
+    nz_indices, entry_nz = numpy.unique(indices, return_inverse=True)
+    nz_istates, nz_jstates, nz_ibins, nz_jbins = numpy.unravel_index(nz_indices, (nstates,nstates,nbins,nbins))
+    nz_rows = nz_ibins*nstates + nz_istates
+    nz_cols = nz_jbins*nstates + nz_jstates
     
-    # Source datasets
-    pops_ds = assignments_file['labeled_populations']
-    fluxes_ds = kinetics_file['labeled_bin_fluxes']
-    pops_iter_start = pops_ds.attrs.get('iter_start',1)
-    fluxes_iter_start = fluxes_ds.attrs.get('iter_start',1)
+    # Bootstrap samples are solved for steady state starting from the overall solution
+    solver = SteadyStateSolver()
     
-    # prepend 1 so that rank of dest == rank of src
-    labeled_fluxes = numpy.empty((1,nstates,nstates,nbins,nbins), weight_dtype)
-    labeled_pops = numpy.empty((1,nstates,nbins), weight_dtype)
+    def window_macro_rates(iter_weights):
+        norm = iter_weights.sum()
+        avg_fluxes = numpy.bincount(entry_nz, weights=fluxes*iter_weights[entry_iters], minlength=len(nz_indices))/norm
+        avg_pops = numpy.tensordot(iter_weights, labeled_pops, axes=1) / norm
+        
+        nz_pops = avg_pops[nz_istates, nz_ibins]
+        if (avg_fluxes[nz_pops == 0] > 0).any():
+            warnings.warn('flux matrix entry nonzero but population zero')
+        avg_rates = numpy.zeros_like(avg_fluxes)
+        numpy.divide(avg_fluxes, nz_pops, out=avg_rates, where=(nz_pops != 0))
+        avg_rates = scipy.sparse.coo_matrix((avg_rates, (nz_rows, nz_cols)), shape=(nfbins,nfbins))
+        
+        ss, macro_rates = get_sparse_macrostate_rates(avg_rates, avg_pops, extrapolate, solver)
+        return macro_rates
     
-    lflux_memsel = h5s.create_simple(labeled_fluxes.shape, (h5s.UNLIMITED,)*labeled_fluxes.ndim)
-    lpop_memsel  = h5s.create_simple(labeled_pops.shape, (h5s.UNLIMITED,)*labeled_pops.ndim)
-
-    fluxes_dsid = fluxes_ds.id
-    pops_dsid = pops_ds.id
+    # Overall average
+    overall_avg_rates = window_macro_rates(numpy.ones((niters,), weight_dtype))
     
-    lflux_filesel = fluxes_dsid.get_space()
-    lpop_filesel  = pops_dsid.get_space()
+    # Per-iteration macrostate-macrostate fluxes, for correlation calculation. A single
+    # set of bootstrap samples serves all state pairs, so the blocks of iterations sampled
+    # must be long enough to decorrelate the most strongly-correlated flux
+    macro_fluxes = numpy.bincount(entry_iters*nstates*nstates + indices // (nbins*nbins), weights=fluxes,
+                                  minlength=niters*nstates*nstates).reshape((niters,nstates,nstates))
+    ctimes = numpy.zeros((nstates,nstates), numpy.int64)
+    for istate in xrange(nstates):
+        for jstate in xrange(nstates):
+            if istate == jstate: continue
+            ctimes[istate,jstate] = mcbs_correltime(macro_fluxes[:,istate, jstate], mcbs_acalpha, mcbs_nsets)
     
+    # Pairs too correlated for meaningful calculations (including those whose fluxes are constant,
+    # such as transitions never observed) must not set the block length; as for mcbs_ci_correl,
+    # the full range of their values (here, over all bootstrap samples) is reported instead
+    offdiag = ~numpy.eye(nstates, dtype=numpy.bool_)
+    correlated = offdiag & (ctimes >= niters)
+    uncorrelated = offdiag & ~correlated
     
-    # Overall average
-    for iiter, n_iter in enumerate(xrange(start_iter, stop_iter)):
-        lflux_filesel.select_hyperslab((n_iter-fluxes_iter_start,0,0,0,0), (1,nstates,nstates,nbins,nbins),
-                                       op=h5s.SELECT_SET)
-        lpop_filesel.select_hyperslab((n_iter-pops_iter_start,0,0), (1,nstates,nbins),
-                                      op=h5s.SELECT_SET)                    
-        fluxes_dsid.read(lflux_memsel, lflux_filesel, labeled_fluxes)
-        pops_dsid.read(lpop_memsel, lpop_filesel, labeled_pops)
-        avg_fluxes += labeled_fluxes[0]
-        avg_pops += labeled_pops[0]        
-        macro_fluxes[iiter] = labeled_fluxes[0].sum(axis=3).sum(axis=2)
-        
-    avg_fluxes /= niters
-    avg_pops /= niters     
-    avg_rates = labeled_flux_to_rate(avg_fluxes, avg_pops)
-    ss, macro_rates = get_macrostate_rates(avg_rates, avg_pops, extrapolate)
-    overall_avg_rates = macro_rates.copy()
-    ctime = mcbs_correltime(macro_fluxes[istate, jstate], mcbs_acalpha, mcbs_nsets)
-
-
     # bootstrap
     lbi = int(math.floor(mcbs_nsets*mcbs_alpha/2.0))
     ubi = int(math.ceil(mcbs_nsets*(1-mcbs_alpha/2.0)))        
-    stride = ctime + 1
-    synth_rates = numpy.empty((mcbs_nsets,), weight_dtype)
+    stride = ctimes[uncorrelated].max() + 1 if uncorrelated.any() else 1
+    synth_rates = numpy.empty((mcbs_nsets,nstates,nstates), weight_dtype)
     
-    starts = numpy.arange(start_iter, stop_iter, stride, dtype=numpy.uintc)
-    stops = numpy.arange(start_iter+stride, stop_iter+stride, stride, dtype=numpy.uintc)
+    starts = numpy.arange(0, niters, stride, dtype=numpy.uintc)
+    stops = numpy.arange(stride, niters+stride, stride, dtype=numpy.uintc)
     nblocks = len(starts)
-    if stops[-1] > stop_iter: stops[-1] = stop_iter    
+    if stops[-1] > niters: stops[-1] = niters
     
+    iter_weights = numpy.empty((niters,), weight_dtype)
     for iset in xrange(mcbs_nsets):
-        avg_fluxes.fill(0)
-        avg_pops.fill(0)
-        iters_averaged = 0
-        log.debug('iset={} istate={} jstate={}'.format(iset,istate,jstate))
+        log.debug('iset={}'.format(iset))
         
+        # Number of times each iteration appears in this synthetic data set
+        iter_weights.fill(0)
         for _block in xrange(nblocks):
             iblock = random.randint(0,nblocks-1)
-            for n_iter in xrange(starts[iblock], stops[iblock]):
-                iters_averaged += 1
-
-                lflux_filesel.select_hyperslab((n_iter-fluxes_iter_start,0,0,0,0), (1,nstates,nstates,nbins,nbins),
-                                               op=h5s.SELECT_SET)
-                lpop_filesel.select_hyperslab((n_iter-pops_iter_start,0,0), (1,nstates,nbins),
-                                              op=h5s.SELECT_SET)                    
-                fluxes_dsid.read(lflux_memsel, lflux_filesel, labeled_fluxes)
-                pops_dsid.read(lpop_memsel, lpop_filesel, labeled_pops)
-                avg_fluxes += labeled_fluxes[0]
-                avg_pops += labeled_pops[0]
+            iter_weights[starts[iblock]:stops[iblock]] += 1
         
-        avg_fluxes /= iters_averaged
-        avg_pops /= iters_averaged
-        avg_rates = labeled_flux_to_rate(avg_fluxes, avg_pops)
-        ss, macro_rates = get_macrostate_rates(avg_rates, avg_pops, extrapolate)
-        synth_rates[iset] = macro_rates[istate, jstate]
-    synth_rates.sort()
-                
-    return (block_label, istate, jstate,
-            (start_iter, stop_iter, overall_avg_rates[istate, jstate], synth_rates[lbi], synth_rates[ubi], ctime))    
+        synth_rates[iset] = window_macro_rates(iter_weights)
+    synth_rates.sort(axis=0)
+    
+    ci_lbounds = synth_rates[lbi]
+    ci_ubounds = synth_rates[ubi]
+    ci_lbounds[correlated] = synth_rates[0][correlated]
+    ci_ubounds[correlated] = synth_rates[-1][correlated]
+    
+    rates = numpy.zeros((nstates,nstates), dtype=ci_dtype)
+    rates['iter_start'][offdiag] = start_iter
+    rates['iter_stop'][offdiag] = stop_iter
+    rates['expected'][offdiag] = overall_avg_rates[offdiag]
+    rates['ci_lbound'][offdiag] = ci_lbounds[offdiag]
+    rates['ci_ubound'][offdiag] = ci_ubounds[offdiag]
+    rates['corr_len'][offdiag] = ctimes[offdiag]
+    return (block_label, rates)
 
 
 class AvgMatrixSubcommand(KinAvgSubcommands):
@@ -455,21 +459,11 @@ class AvgMatrixSubcommand(KinAvgSubcommands):
         self.open_files()
         self.init_ivars()
         
-        avg_rates = numpy.zeros((self.nstates,self.nstates), dtype=ci_dtype)
-        
         print('evaluating overall averages...')
-        futures = []
-        for istate in xrange(self.nstates):
-            for jstate in xrange(self.nstates):
-                if istate == jstate: continue
-                args = (None, self.assignments_filename, self.kinetics_filename, istate, jstate,
-                        self.iter_range.iter_start, self.iter_range.iter_stop,
-                        self.mcbs_alpha, self.mcbs_acalpha, self.mcbs_nsets, self.extrapolate)
-                futures.append(self.work_manager.submit(_calc_ci_block, args=args))
-
-        for future in self.work_manager.as_completed(futures):
-            _iblock, istate, jstate, ci_result = future.get_result(discard=True)
-            avg_rates[istate,jstate] = ci_result
+        args = (None, self.assignments_filename, self.kinetics_filename,
+                self.iter_range.iter_start, self.iter_range.iter_stop,
+                self.mcbs_alpha, self.mcbs_acalpha, self.mcbs_nsets, self.extrapolate)
+        _iblock, avg_rates = self.work_manager.submit(_calc_ci_block, args=args).get_result(discard=True)
                 
         self.output_file['avg_rates'] = avg_rates
         self.stamp_mcbs_info(self.output_file['avg_rates'])
@@ -493,32 +487,27 @@ class AvgMatrixSubcommand(KinAvgSubcommands):
         evol = numpy.zeros((len(start_pts), self.nstates, self.nstates), dtype=ci_dtype)
         futures = []
         
-        for istate in xrange(self.nstates):
-            for jstate in xrange(self.nstates):
-                if istate == jstate: continue
-                for iblock, start in enumerate(start_pts):
-                    stop = min(start+step_iter, stop_iter)
-                    if self.evolution_mode == 'cumulative':
-                        windowsize = int(self.evol_window_frac * (stop - start_iter))
-                        block_start = max(start_iter, stop - windowsize)
-                    else: # self.evolution_mode == 'blocked'
-                        block_start = start
-                    log.debug('dispatching block {}, istate={}, jstate={}, start={}, stop={}'
-                              .format(iblock, istate, jstate, block_start,stop))
-
-                    args = (iblock, self.assignments_filename, self.kinetics_filename, istate, jstate,
-                            block_start, stop,
-                            self.mcbs_alpha, self.mcbs_acalpha, self.mcbs_nsets, self.extrapolate)
-                    futures.append(self.work_manager.submit(_calc_ci_block, args=args))
+        for iblock, start in enumerate(start_pts):
+            stop = min(start+step_iter, stop_iter)
+            if self.evolution_mode == 'cumulative':
+                windowsize = int(self.evol_window_frac * (stop - start_iter))
+                block_start = max(start_iter, stop - windowsize)
+            else: # self.evolution_mode == 'blocked'
+                block_start = start
+            log.debug('dispatching block {}, start={}, stop={}'.format(iblock, block_start, stop))
+
+            args = (iblock, self.assignments_filename, self.kinetics_filename,
+                    block_start, stop,
+                    self.mcbs_alpha, self.mcbs_acalpha, self.mcbs_nsets, self.extrapolate)
+            futures.append(self.work_manager.submit(_calc_ci_block, args=args))
 
         if sys.stdout.isatty() and not westpa.rc.quiet_mode:
-            print('\r{} of {} rates done...'.format(0,len(futures)), end='')        
+            print('\r{} of {} blocks done...'.format(0,len(futures)), end='')        
         for iresult, future in enumerate(self.work_manager.as_completed(futures)):
             if sys.stdout.isatty() and not westpa.rc.quiet_mode:
-                print('\r{} of {} rates done...'.format(iresult+1,len(futures)), end='')
-            result = future.get_result(discard=True)
-            iblock, istate, jstate, ci_result = result 
-            evol[iblock, istate, jstate] = ci_result
+                print('\r{} of {} blocks done...'.format(iresult+1,len(futures)), end='')
+            iblock, rates = future.get_result(discard=True)
+            evol[iblock] = rates
         if sys.stdout.isatty() and not westpa.rc.quiet_mode:
             print()
                     
@@ -18,7 +18,6 @@
 from __future__ import print_function, division; __metaclass__ = type
 
 import sys, logging
-from collections import deque
 
 import numpy
 
@@ -27,15 +26,13 @@ from westpa import h5io
 from west.data_manager import weight_dtype
 from west.data_manager import seg_id_dtype
 from westpa.binning import index_dtype
-from westpa.kinetics import find_macrostate_transitions
-from westpa.kinetics._kinetics import _fast_transition_state_copy #@UnresolvedImport
-from westpa.kinetics.matrates import estimate_rates
+from westpa.kinetics import MacrostateTransitionTracer, transition_event_dtype
+from westpa.kinetics.matrates import WindowedRateEstimator
 from westtools import (WESTSubcommand, WESTMasterCommand, WESTDataReader, IterRangeSelection,
                        ProgressIndicatorComponent)
 
 
-ed_list_dtype = numpy.dtype([('istate', numpy.uint16), ('fstate', numpy.uint16), ('duration', numpy.float64),
-                             ('weight', numpy.float64), ('seg_id', seg_id_dtype)])
+ed_list_dtype = transition_event_dtype
 
 log = logging.getLogger('westtools.w_kinetics')
 
@@ -125,10 +122,16 @@ following datasets:
   ``/duration_count`` [iteration]
     *(Integer)* The number of event durations recorded in each iteration.
     
-  ``/durations`` [iteration][event duration]
-    *(Structured -- see below)*  Event durations for transition events ending
-    during a given iteration. These are stored as follows:
+  ``/duration_offsets`` [iteration+1]
+    *(Integer)* Index into ``/durations``, such that the events ending during
+    the i-th stored iteration are ``durations[duration_offsets[i]:duration_offsets[i+1]]``.
+    
+  ``/durations`` [event]
+    *(Structured -- see below)*  Event durations for transition events, in
+    order of the iteration during which they end. These are stored as follows:
       
+      n_iter
+        *(Integer)* Iteration during which the transition event ended.
       istate
         *(Integer)* Initial state of transition event.
       fstate
@@ -151,6 +154,19 @@ Command-line options
 -----------------------------------------------------------------------------
 '''
     
+    def __init__(self, parent):
+        super(KinTraceSubcommand,self).__init__(parent)
+        self.nthreads = None
+        
+    def add_args(self, parser):
+        parser.add_argument('--threads', type=int, default=1,
+                            help='''Trace segments of each iteration in parallel using THREADS threads, in addition
+                            to any parallelism provided by the work manager. (Default: %(default)s.)''')
+        
+    def process_args(self, args):
+        if args.threads < 1:
+            raise ValueError('at least one thread is required')
+        self.nthreads = args.threads
 
     def go(self):
         pi = self.progress.indicator
@@ -161,11 +177,14 @@ Command-line options
             start_iter, stop_iter = self.iter_range.iter_start, self.iter_range.iter_stop # h5io.get_iter_range(self.assignments_file)
             iter_count = stop_iter - start_iter
             durations_ds = self.output_file.create_dataset('durations', 
-                                                           shape=(iter_count,0), maxshape=(iter_count,None),
+                                                           shape=(0,), maxshape=(None,),
                                                            dtype=ed_list_dtype,
-                                                           chunks=(1,15360) if self.do_compression else None,
+                                                           chunks=(15360,),
                                                            shuffle=self.do_compression,
                                                            compression=9 if self.do_compression else None)
+            duration_offsets_ds = self.output_file.create_dataset('duration_offsets',
+                                                                  shape=(iter_count+1,), dtype=numpy.int64,
+                                                                  shuffle=True, compression=9)
             durations_count_ds = self.output_file.create_dataset('duration_count',
                                                                  shape=(iter_count,), dtype=numpy.int_, shuffle=True,compression=9)
             cond_fluxes_ds = self.output_file.create_dataset('conditional_fluxes',
@@ -200,11 +219,21 @@ Command-line options
             self.output_file['state_labels'] = self.assignments_file['state_labels'][...]
 
             # Put nice labels on things
-            for ds in (self.output_file, durations_count_ds, cond_fluxes_ds, total_fluxes_ds):
+            for ds in (self.output_file, durations_count_ds, duration_offsets_ds, durations_ds, cond_fluxes_ds,
+                       total_fluxes_ds):
                 h5io.stamp_iter_range(ds, start_iter, stop_iter)
 
+            # Results are accumulated in memory and written a block of iterations at a time
+            block_size = h5io.calc_chunksize((iter_count,nstates,nstates),weight_dtype)[0]
+            cond_fluxes = numpy.zeros((block_size,nstates,nstates), weight_dtype)
+            total_fluxes = numpy.zeros((block_size,nstates), weight_dtype)
+            cond_counts = numpy.zeros((block_size,nstates,nstates), numpy.uint)
+            total_counts = numpy.zeros((block_size,nstates), numpy.uint)
+            duration_counts = numpy.zeros((block_size,), numpy.int64)
+            block_start = 0
+
             # Calculate instantaneous rate matrices and trace trajectories
-            last_state = None
+            tracer = MacrostateTransitionTracer(nstates, self.nthreads)
             pi.new_operation('Tracing trajectories', iter_count)
             for iiter, n_iter in enumerate(xrange(start_iter, stop_iter)):
                 # Get data from the main HDF5 file
@@ -217,40 +246,41 @@ Command-line options
                 
                 # Get bin and traj. ensemble assignments from the previously-generated assignments file
                 assignment_iiter = h5io.get_iteration_entry(self.assignments_file, n_iter)
-                bin_assignments = numpy.require(self.assignments_file['assignments'][assignment_iiter + numpy.s_[:nsegs,:npts]],
-                                                dtype=index_dtype)
                 label_assignments = numpy.require(self.assignments_file['trajlabels'][assignment_iiter + numpy.s_[:nsegs,:npts]],
                                                   dtype=index_dtype)
                 state_assignments = numpy.require(self.assignments_file['statelabels'][assignment_iiter + numpy.s_[:nsegs,:npts]],
                                                   dtype=index_dtype)
                 
-                # Prepare to run analysis
-                cond_fluxes = numpy.zeros((nstates,nstates), weight_dtype)
-                total_fluxes = numpy.zeros((nstates,), weight_dtype)
-                cond_counts = numpy.zeros((nstates,nstates), numpy.uint)
-                total_counts = numpy.zeros((nstates,), numpy.uint)
-                durations = []
-    
                 # Estimate macrostate fluxes and calculate event durations using trajectory tracing
-                # state is opaque to the find_macrostate_transitions function            
-                state = _fast_transition_state_copy(iiter, nstates, parent_ids, last_state)
-                find_macrostate_transitions(nstates, weights, label_assignments, state_assignments, 1.0/(npts-1), state,
-                                            cond_fluxes, cond_counts, total_fluxes, total_counts, durations)
-                last_state = state
+                iblock = iiter - block_start
+                duration_counts[iblock] = tracer.trace(n_iter, weights, parent_ids, label_assignments, state_assignments,
+                                                       1.0/(npts-1), cond_fluxes[iblock], cond_counts[iblock],
+                                                       total_fluxes[iblock], total_counts[iblock])
                 
                 # Store trace-based kinetics data
-                cond_fluxes_ds[iiter] = cond_fluxes
-                total_fluxes_ds[iiter] = total_fluxes
-                arrival_counts_ds[iiter] = total_counts
-                cond_arrival_counts_ds[iiter] = cond_counts
-                
-                durations_count_ds[iiter] = len(durations)
-                if len(durations) > 0:
-                    durations_ds.resize((iter_count, max(len(durations), durations_ds.shape[1])))
-                    durations_ds[iiter,:len(durations)] = durations
+                if iblock == block_size - 1 or iiter == iter_count - 1:
+                    block_stop = iiter + 1
+                    nblock = block_stop - block_start
+                    cond_fluxes_ds[block_start:block_stop] = cond_fluxes[:nblock]
+                    total_fluxes_ds[block_start:block_stop] = total_fluxes[:nblock]
+                    arrival_counts_ds[block_start:block_stop] = total_counts[:nblock]
+                    cond_arrival_counts_ds[block_start:block_stop] = cond_counts[:nblock]
+                    durations_count_ds[block_start:block_stop] = duration_counts[:nblock]
+                    
+                    ndurations = durations_ds.shape[0]
+                    duration_offsets_ds[block_start+1:block_stop+1] = ndurations + numpy.cumsum(duration_counts[:nblock])
+                    durations = tracer.pop_events()
+                    if len(durations):
+                        durations_ds.resize((ndurations+len(durations),))
+                        durations_ds[ndurations:] = durations
+                    
+                    for array in (cond_fluxes, total_fluxes, cond_counts, total_counts):
+                        array.fill(0)
+                    del durations
+                    block_start = block_stop
                         
                 # Do a little manual clean-up to prevent memory explosion
-                del iter_group, weights, parent_ids, bin_assignments, label_assignments, state, cond_fluxes, total_fluxes
+                del iter_group, weights, parent_ids, label_assignments, state_assignments
                 pi.progress += 1
             
 
@@ -276,13 +306,28 @@ Output format
 -----------------------------------------------------------------------------
 
 The output file (-o/--output, by default "kinmat.h5") contains the
-following dataset:
+following sparse matrices:
 
-  ``/labeled_bin_fluxes`` [iteration][state][state][bin][bin]
+  ``/labeled_bin_fluxes`` [iteration][state*bin][state*bin]
     *(Floating-point)* Bin-to-bin (microstate) flux matrix for each trajectory
-    ensemble. ``labeled_bin_fluxes[100][0][1][2][3]`` is the flux from bin
-    2 to bin 3 at iteration 100, among trajectories that switched labels from
-    0 to 1 within that iteration. Units are inverse tau.
+    ensemble. The entry at row ``ibin*nstates+istate`` and column
+    ``jbin*nstates+jstate`` for iteration 100 is the flux from bin ``ibin``
+    to bin ``jbin`` at iteration 100, among trajectories that switched labels
+    from ``istate`` to ``jstate`` within that iteration. Units are inverse tau.
+
+  ``/labeled_bin_rates`` [iteration][state*bin][state*bin]
+    *(Floating-point)* As above, normalized by the labeled population of the
+    initial bin. Shares its sparsity pattern with ``/labeled_bin_fluxes``.
+
+  ``/bin_rates`` [iteration][bin][bin]
+    *(Floating-point)* Bin-to-bin rate matrix, ignoring trajectory labels.
+
+Only nonzero matrix elements are stored. Each matrix is an HDF5 group
+containing one-dimensional ``rows``, ``cols``, and ``values`` datasets, which
+list the nonzero elements of all iterations in coordinate form, and an
+``offsets`` dataset such that the elements for the i-th stored iteration are
+those in ``offsets[i]:offsets[i+1]``. The number of states and bins are
+stored in the ``nstates`` and ``nbins`` attributes of each group.
                 
 Because fluxes stored in this file are not normalized by initial populations, 
 they cannot be used as rates without further processing. The ``w_kinavg``
@@ -319,48 +364,30 @@ Command-line options
             self.data_reader.open('r')
             nbins = self.assignments_file.attrs['nbins']
             state_labels = self.assignments_file['state_labels'][...]
-            state_map = self.assignments_file['state_map'][...]
             nstates = len(state_labels)
             start_iter, stop_iter = self.iter_range.iter_start, self.iter_range.iter_stop # h5io.get_iter_range(self.assignments_file)
             iter_count = stop_iter - start_iter
 
-            weights_ring = deque(maxlen=self.window_size)
-            parent_ids_ring = deque(maxlen=self.window_size)
-            bin_assignments_ring = deque(maxlen=self.window_size)
-            label_assignments_ring = deque(maxlen=self.window_size)
-
-            labeled_matrix_shape = (iter_count,nstates,nstates,nbins,nbins)
-            unlabeled_matrix_shape = (iter_count,nbins,nbins)
-            labeled_matrix_chunks = (1, nstates, nstates, nbins, nbins)
-            unlabeled_matrix_chunks = (1, nbins, nbins)
-
-            labeled_bin_fluxes_ds = self.output_file.create_dataset('labeled_bin_fluxes',
-                                                                    shape=labeled_matrix_shape,
-                                                                    chunks=labeled_matrix_chunks if self.do_compression else None,
-                                                                    compression=9 if self.do_compression else None,
-                                                                    dtype=weight_dtype)
-            labeled_bin_rates_ds = self.output_file.create_dataset('labeled_bin_rates',
-                                                                   shape=labeled_matrix_shape,
-                                                                   chunks=labeled_matrix_chunks if self.do_compression else None,
-                                                                   compression=9 if self.do_compression else None,
-                                                                   dtype=weight_dtype)
-            unlabeled_bin_rates_ds = self.output_file.create_dataset('bin_rates', shape=unlabeled_matrix_shape,
-                                                                     chunks=unlabeled_matrix_chunks if self.do_compression else None,
-                                                                     compression=9 if self.do_compression else None,
-                                                                     dtype=weight_dtype)
-
-            fluxes = numpy.empty(labeled_matrix_shape[1:], weight_dtype)
-            labeled_rates = numpy.empty(labeled_matrix_shape[1:], weight_dtype)
-            unlabeled_rates = numpy.empty(unlabeled_matrix_shape[1:], weight_dtype)
-
-            for ds in (self.output_file, labeled_bin_fluxes_ds, labeled_bin_rates_ds, unlabeled_bin_rates_ds):
-                h5io.stamp_iter_range(ds, start_iter, stop_iter)
-
-            for ds in (labeled_bin_fluxes_ds, labeled_bin_rates_ds):
-                h5io.label_axes(ds, ['iteration','initial state','final state','inital bin','final bin'])
-
-            for ds in (unlabeled_bin_rates_ds,):
-                h5io.label_axes(ds, ['iteration', 'initial bin', 'final bin'])
+            rate_estimator = WindowedRateEstimator(nstates, nbins, self.window_size, self.all_lags)
+
+            # Rate matrices are overwhelmingly sparse (only bins adjacent in a single iteration
+            # exchange flux), so store only nonzero entries
+            nfbins = nstates*nbins
+            labeled_bin_fluxes = h5io.SparseIterMatrix.create(self.output_file, 'labeled_bin_fluxes',
+                                                              (nfbins, nfbins), start_iter, dtype=weight_dtype,
+                                                              compression=self.do_compression)
+            labeled_bin_rates = h5io.SparseIterMatrix.create(self.output_file, 'labeled_bin_rates',
+                                                             (nfbins, nfbins), start_iter, dtype=weight_dtype,
+                                                             index_from=labeled_bin_fluxes,
+                                                             compression=self.do_compression)
+            unlabeled_bin_rates = h5io.SparseIterMatrix.create(self.output_file, 'bin_rates',
+                                                               (nbins, nbins), start_iter, dtype=weight_dtype,
+                                                               compression=self.do_compression)
+
+            for matrix in (labeled_bin_fluxes, labeled_bin_rates, unlabeled_bin_rates):
+                matrix.group.attrs['nstates'] = nstates
+                matrix.group.attrs['nbins'] = nbins
+            h5io.stamp_iter_range(self.output_file, start_iter, stop_iter)
 
             pi.new_operation('Calculating flux matrices', iter_count)
             # Calculate instantaneous rate matrices and trace trajectories
@@ -380,26 +407,18 @@ Command-line options
                                                   dtype=index_dtype)
                 labeled_pops = self.assignments_file['labeled_populations'][assignment_iiter]
 
-                # Prepare to run analysis
-                weights_ring.append(weights)
-                parent_ids_ring.append(parent_ids)
-                bin_assignments_ring.append(bin_assignments)
-                label_assignments_ring.append(label_assignments)
-
                 # Estimate rates using bin-to-bin fluxes
-                estimate_rates(nbins, state_labels,
-                               weights_ring, parent_ids_ring, bin_assignments_ring, label_assignments_ring, state_map,
-                               labeled_pops,
-                               self.all_lags,
-                               fluxes, labeled_rates, unlabeled_rates)
+                rate_estimator.add_iteration(weights, parent_ids, bin_assignments, label_assignments)
+                fluxes, labeled_rates, unlabeled_rates = rate_estimator.estimate_rates(labeled_pops)
 
                 # Store bin-based kinetics data
-                labeled_bin_fluxes_ds[iiter] = fluxes
-                labeled_bin_rates_ds[iiter] = labeled_rates
-                unlabeled_bin_rates_ds[iiter] = unlabeled_rates
+                labeled_bin_fluxes.append_matrix(fluxes)
+                labeled_bin_rates.append_matrix(labeled_rates)
+                unlabeled_bin_rates.append_matrix(unlabeled_rates)
 
                 # Do a little manual clean-up to prevent memory explosion
                 del iter_group, weights, parent_ids, bin_assignments, label_assignments, labeled_pops
+                del fluxes, labeled_rates, unlabeled_rates
                 pi.progress += 1
 
 class WKinetics(WESTMasterCommand):
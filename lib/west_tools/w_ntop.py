@@ -16,16 +16,75 @@
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import print_function, division; __metaclass__ = type
-from westtools import WESTTool, WESTDataReader, IterRangeSelection, ProgressIndicatorComponent
+from westtools import WESTParallelTool, WESTDataReader, IterRangeSelection, ProgressIndicatorComponent
 import numpy, h5py
 
 import westpa
 from westpa import h5io
 from west.data_manager import seg_id_dtype, n_iter_dtype, weight_dtype
-from westpa.binning import assignments_list_to_table
-
-
-class WNTopTool(WESTTool):
+from westpa.binning import assignments_list_to_groups
+
+# Maximum number of iterations processed per task
+max_iter_block_size = 250
+
+def _select_segments(seg_ids, weights, count, what, rng):
+    '''Return the positions (in ``seg_ids`` and ``weights``) of the ``count`` segments of highest weight
+    (if ``what`` is "highweight"), lowest weight ("lowweight"), or chosen at random using the
+    ``numpy.random.RandomState`` ``rng`` ("random"), in order of decreasing (or increasing) weight,
+    or in random order. Segments of equal weight are ordered by seg_id.'''
+
+    nsegs = len(seg_ids)
+    if what == 'random':
+        return rng.permutation(nsegs)[:count]
+
+    keys = -weights if what == 'highweight' else weights
+    if nsegs > count:
+        selected = numpy.argpartition(keys, count-1)[:count]
+        selected.sort()
+    else:
+        selected = numpy.arange(nsegs)
+    return selected[numpy.argsort(keys[selected], kind='mergesort')]
+
+def _find_top_segments(west_h5filename, assignments_filename, iter_start, iter_stop, nbins, count, timepoint,
+                       what, seed=None):
+    '''Select segments from each bin for iterations ``iter_start`` through ``iter_stop-1``, as described
+    in ``_select_segments``. Returns the (first) iteration number, and arrays of the number of segments
+    selected from each bin, their seg_ids, and their weights, indexed by [iteration][bin] and
+    [iteration][bin][segment].'''
+
+    rng = numpy.random.RandomState(seed)
+    block_count = iter_stop - iter_start
+    seg_counts = numpy.zeros((block_count,nbins), numpy.uint)
+    seg_ids = numpy.zeros((block_count,nbins,count), seg_id_dtype)
+    weights = numpy.zeros((block_count,nbins,count), weight_dtype)
+
+    with h5py.File(assignments_filename, 'r') as assignments_file, \
+         h5io.WESTPAH5File(west_h5filename, 'r') as west_h5file:
+        assignments_ds = assignments_file['assignments']
+        nsegs = assignments_file['nsegs'][h5io.get_iteration_slice(assignments_file['nsegs'], iter_start, iter_stop)]
+        block_assignments = assignments_ds[h5io.get_iteration_slice(assignments_ds, iter_start, iter_stop)
+                                           + numpy.index_exp[:,timepoint]]
+        block_assignments = numpy.require(block_assignments, dtype=westpa.binning.index_dtype)
+
+        for iiter, n_iter in enumerate(xrange(iter_start, iter_stop)):
+            all_weights = west_h5file.get_iter_group(n_iter)['seg_index']['weight']
+
+            # Group segments by bin, then select from each occupied bin
+            bin_seg_ids, offsets = assignments_list_to_groups(nbins, block_assignments[iiter,:nsegs[iiter]])
+            for ibin in numpy.flatnonzero(numpy.diff(offsets)):
+                segs = bin_seg_ids[offsets[ibin]:offsets[ibin+1]]
+                segs_weights = all_weights.take(segs)
+                selected = _select_segments(segs, segs_weights, count, what, rng)
+                n_selected = len(selected)
+                seg_counts[iiter,ibin] = n_selected
+                seg_ids[iiter,ibin,:n_selected] = segs.take(selected)
+                weights[iiter,ibin,:n_selected] = segs_weights.take(selected)
+            del all_weights, bin_seg_ids, offsets
+
+    return iter_start, seg_counts, seg_ids, weights
+
+
+class WNTopTool(WESTParallelTool):
     prog='w_ntop'
     description = '''\
 Select walkers from bins . An assignment file mapping walkers to
@@ -35,6 +94,10 @@ selected (hence the name ``w_ntop``: select the N top-weighted walkers from
 each bin); however, minimum weight walkers and randomly-selected walkers
 may be selected instead.
 
+Iterations are processed in blocks, in parallel. Within each iteration,
+segments are grouped by bin with a counting sort of their assignments,
+and only the selected segments of each bin are sorted.
+
 
 -----------------------------------------------------------------------------
 Output format
@@ -116,6 +179,8 @@ Command-line arguments
         self.what = args.select_what
         self.output_filename = args.output
         self.assignments_filename = args.assignments
+        if args.count < 1:
+            raise ValueError('--count must be at least 1 (got {:d})'.format(args.count))
         self.count = args.count
         self.timepoint = args.timepoint
 
@@ -133,7 +198,7 @@ Command-line arguments
         iter_start, iter_stop = self.iter_range.iter_start, self.iter_range.iter_stop
         iter_count = iter_stop - iter_start
         h5io.check_iter_range_least(assignments_ds, iter_start, iter_stop)
-        nsegs = assignments_file['nsegs'][h5io.get_iteration_slice(assignments_file['nsegs'], iter_start,iter_stop)]
+        assignments_file.close()
 
         output_file.create_dataset('n_iter', dtype=n_iter_dtype, data=range(iter_start,iter_stop))
 
@@ -150,37 +215,27 @@ Command-line arguments
 
         with pi:
             pi.new_operation('Finding matching segments', extent=iter_count)
-            for iiter, n_iter in enumerate(xrange(iter_start, iter_stop)):
-                assignments = numpy.require(assignments_ds[h5io.get_iteration_entry(assignments_ds, n_iter)
-                                                           + numpy.index_exp[:,timepoint]], dtype=westpa.binning.index_dtype)
-                all_weights = self.data_reader.get_iter_group(n_iter)['seg_index']['weight']
-
-                # the following Cython function just executes this loop:
-                #for iseg in xrange(nsegs[iiter]):
-                #    segs_by_bin[iseg,assignments[iseg]] = True
-                segs_by_bin = assignments_list_to_table(nsegs[iiter],nbins,assignments)
-                for ibin in xrange(nbins):
-                    segs = numpy.nonzero(segs_by_bin[:,ibin])[0]
-
-                    seg_count_ds[iiter,ibin] = min(len(segs),count)
-
-                    if len(segs):
-                        weights = all_weights.take(segs)
-
-                        if what == 'lowweight':
-                            indices = numpy.argsort(weights)[:count]
-                        elif what == 'highweight':
-                            indices = numpy.argsort(weights)[::-1][:count]
-                        else:
-                            assert what == 'random'
-                            indices = numpy.random.permutation(len(weights))
-
-                        matching_segs_ds[iiter,ibin,:len(segs)] = segs.take(indices)
-                        weights_ds[iiter,ibin,:len(segs)] = weights.take(indices)
-                        del segs, weights
-
-                del assignments, segs_by_bin, all_weights
-                pi.progress += 1
+            n_workers = self.work_manager.n_workers or 1
+            block_size = max(1, min(max_iter_block_size, -(-iter_count // (4*n_workers))))
+
+            # Each block draws random numbers (if necessary) from its own generator
+            block_starts = range(iter_start, iter_stop, block_size)
+            seeds = numpy.random.randint(numpy.iinfo(numpy.int32).max, size=len(block_starts))
+            task_gen = ((_find_top_segments,
+                         (self.data_reader.we_h5filename, self.assignments_filename, block_start,
+                          min(iter_stop, block_start+block_size), nbins, count, timepoint, what, seed),
+                         {}) for (block_start, seed) in zip(block_starts, seeds))
+            for future in self.work_manager.submit_as_completed(task_gen, self.max_queue_len):
+                block_start, seg_counts, seg_ids, weights = future.get_result(discard=True)
+                iiter_start = block_start - iter_start
+                iiter_stop = iiter_start + len(seg_counts)
+                seg_count_ds[iiter_start:iiter_stop] = seg_counts
+                matching_segs_ds[iiter_start:iiter_stop] = seg_ids
+                weights_ds[iiter_start:iiter_stop] = weights
+                pi.progress += len(seg_counts)
+                del seg_counts, seg_ids, weights, future
+
+        output_file.close()
 
 if __name__ == '__main__':
     WNTopTool().main()
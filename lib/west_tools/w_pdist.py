@@ -16,17 +16,21 @@
 # along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import print_function, division; __metaclass__ = type
-import logging
+import logging, os, math
 from itertools import izip
 from westtools import (WESTParallelTool, WESTDataReader, WESTDSSynthesizer, IterRangeSelection, 
                        ProgressIndicatorComponent)
 import numpy, h5py
-from fasthist import histnd, normhistnd
+from fasthist import histnd_timeseries, normhistnd, histnd_sparse, normhistnd_sparse
 from westpa import h5io
 from westpa.h5io import SingleIterDSSpec
+from west.data_manager import n_iter_dtype
 
 log = logging.getLogger('westtools.w_pdist')
 
+# Length of chunks of sparse histogram data
+sparse_chunk_length = 16384
+
 def isiterable(x):
     try:
         iter(x)
@@ -56,24 +60,122 @@ def _remote_min_max(ndim, dset_dtype, n_iter, dsspec):
     del dset
     return data_range
 
-def _remote_bin_iter(iiter, n_iter, dsspec, wt_dsspec, initpoint, binbounds, ignore_out_of_range):
-
-    iter_hist_shape = tuple(len(bounds)-1 for bounds in binbounds)
-    iter_hist = numpy.zeros(iter_hist_shape, dtype=numpy.float64)
+def _remote_bin_iter(iiter, n_iter, dsspec, wt_dsspec, initpoint, binbounds, ignore_out_of_range, sparse=False,
+                     nthreads=1, deterministic=False):
 
     dset = dsspec.get_iter_data(n_iter)
-    npts = dset.shape[1]
     weights = wt_dsspec.get_iter_data(n_iter)
 
     dset = dset[:,initpoint:,:]
-    for ipt in xrange(npts-initpoint):
-        histnd(dset[:,ipt,:], binbounds, weights, out=iter_hist, binbound_check = False, ignore_out_of_range=ignore_out_of_range)
+    if sparse:
+        iter_hist = histnd_sparse(dset, binbounds, weights, binbound_check = False,
+                                  ignore_out_of_range=ignore_out_of_range, nthreads=nthreads)
+    else:
+        iter_hist_shape = tuple(len(bounds)-1 for bounds in binbounds)
+        iter_hist = numpy.zeros(iter_hist_shape, dtype=numpy.float64)
+        histnd_timeseries(dset, binbounds, weights, out=iter_hist, binbound_check = False,
+                          ignore_out_of_range=ignore_out_of_range, nthreads=nthreads, deterministic=deterministic)
+
+    # count points falling outside the bins (which raise an error unless ignored)
+    n_clipped = 0
+    if ignore_out_of_range:
+        in_range = numpy.ones(dset.shape[:2], numpy.bool_)
+        for idim, boundset in enumerate(binbounds):
+            dimdata = dset[:,:,idim]
+            in_range &= (dimdata >= boundset[0]) & (dimdata < boundset[-1])
+        n_clipped = in_range.size - numpy.count_nonzero(in_range)
+        del in_range, dimdata
 
     del weights, dset
 
     # normalize histogram
-    normhistnd(iter_hist,binbounds)
-    return iiter, n_iter, iter_hist
+    if sparse:
+        normhistnd_sparse(iter_hist[0], iter_hist[1], binbounds)
+    else:
+        normhistnd(iter_hist,binbounds)
+    return iiter, n_iter, iter_hist, n_clipped
+
+def _pow2_bin_count(lb, ub, exponent):
+    '''Return the number of bins of width 2**exponent, with boundaries at integer multiples of
+    2**exponent, required to cover [lb, ub].'''
+    return int(math.floor(math.ldexp(ub, -exponent)) - math.floor(math.ldexp(lb, -exponent))) + 1
+
+def _pow2_bin_exponent(lb, ub, nbins):
+    '''Return the smallest integer exponent for which no more than ``nbins`` (at least two) bins of
+    width 2**exponent, with boundaries at integer multiples of 2**exponent, cover [lb, ub]. Bins
+    narrower than 2**-40 times the magnitude of the data are not used, so that bin indices are always
+    exactly representable.'''
+    exponent = math.frexp(max(abs(lb), abs(ub), numpy.finfo(numpy.float64).tiny))[1] - 40
+    if ub > lb:
+        exponent = max(exponent, math.frexp((ub-lb)/nbins)[1] - 1)
+    while _pow2_bin_count(lb, ub, exponent) > nbins:
+        exponent += 1
+    return exponent
+
+def _remote_bin_iter_pow2(iiter, n_iter, dsspec, wt_dsspec, initpoint, nbins):
+    '''Histogram one iteration of data on the narrowest power-of-two grid (in each dimension) for
+    which at most ``nbins`` bins cover its data. Returns the exponents of the bin widths, the (absolute)
+    bin indices of the occupied bins and their unnormalized weights, and the range of the data, or
+    None for all but the first of these if the iteration contains no data.'''
+
+    dset = dsspec.get_iter_data(n_iter)
+    weights = wt_dsspec.get_iter_data(n_iter)
+    dset = dset[:,initpoint:,:]
+    ndim = dset.shape[2]
+
+    if not dset.size:
+        return iiter, n_iter, None, None, None, None
+
+    exponents = numpy.empty((ndim,), numpy.int64)
+    data_range = numpy.empty((ndim,2), numpy.float64)
+    indices = numpy.empty((ndim,) + dset.shape[:2], numpy.int64)
+    for idim in xrange(ndim):
+        dimdata = numpy.require(dset[:,:,idim], numpy.float64)
+        if not numpy.isfinite(dimdata).all():
+            raise ValueError('non-finite values in dimension {} of iteration {}'.format(idim, n_iter))
+        lb, ub = data_range[idim] = dimdata.min(), dimdata.max()
+        exponents[idim] = _pow2_bin_exponent(lb, ub, nbins[idim])
+        indices[idim] = numpy.floor(numpy.ldexp(dimdata, -int(exponents[idim])))
+        del dimdata
+    del dset
+
+    # Find the occupied bins, as (absolute) indices along each dimension
+    indices = indices.reshape((ndim,-1))
+    origin = indices.min(axis=1)
+    local_shape = tuple(indices.max(axis=1) - origin + 1)
+    flat_indices = numpy.ravel_multi_index(tuple(indices - origin[:,numpy.newaxis]), local_shape)
+    del indices
+    occupied, inverse = numpy.unique(flat_indices, return_inverse=True)
+    ntimepoints = len(flat_indices) // len(weights)
+    values = numpy.bincount(inverse, weights=numpy.repeat(weights, ntimepoints), minlength=len(occupied))
+    occupied = numpy.array(numpy.unravel_index(occupied, local_shape), dtype=numpy.int64) + origin[:,numpy.newaxis]
+    return iiter, n_iter, exponents, occupied, values, data_range
+
+
+class _SparseHistogramWriter:
+    '''Append sparse histograms, which may arrive in any order, to the ``index`` and ``value`` datasets
+    of ``hist_group`` in iteration order, recording where each begins in ``offsets``.'''
+
+    def __init__(self, hist_group, first_iiter):
+        self.index_ds = hist_group['index']
+        self.value_ds = hist_group['value']
+        self.offsets_ds = hist_group['offsets']
+        self.next_iiter = first_iiter
+        self.offset = long(self.offsets_ds[first_iiter])
+        self.pending = {}
+
+    def add(self, iiter, indices, values):
+        self.pending[iiter] = (indices, values)
+        while self.next_iiter in self.pending:
+            indices, values = self.pending.pop(self.next_iiter)
+            offset_stop = self.offset + len(indices)
+            self.index_ds.resize((offset_stop,))
+            self.value_ds.resize((offset_stop,))
+            self.index_ds[self.offset:offset_stop] = indices
+            self.value_ds[self.offset:offset_stop] = values
+            self.offsets_ds[self.next_iiter+1] = offset_stop
+            self.offset = offset_stop
+            self.next_iiter += 1
 
 
 class WPDist(WESTParallelTool):
@@ -135,12 +237,44 @@ kinds of arguments:
 The first two forms (integer, list of integers) will trigger a scan of all
 data in each dimension in order to determine the minimum and maximum values,
 which may be very expensive for large datasets. This can be avoided by
-explicitly providing bin boundaries using the list-of-lists form.
+explicitly providing bin boundaries using the list-of-lists form, or
+mitigated with --single-pass, which finds the data range while binning, so
+that data are read only once. In that case, bins in each dimension are of
+a width that is a power of two (such as 0.25, 1, or 8), with boundaries at
+integer multiples of that width; the width is the smallest for which no
+more than the requested number of bins cover the data, so that somewhat
+fewer bins than requested (but no fewer than about half as many) may be
+used. Each iteration is histogrammed on its own grid of this kind, and
+histograms are merged into the common (coarser) grid once all data have
+been read. Iterations are held in memory (as their occupied bins) until
+then.
 
 Note that these bins are *NOT* at all related to the bins used to drive WE
 sampling.
 
 
+-----------------------------------------------------------------------------
+Incremental histogramming
+-----------------------------------------------------------------------------
+
+With --append, an existing output file is extended with histograms for only
+those iterations completed since it was last written, rather than rebinning
+the entire simulation. The bin boundaries stored in the file are reused (and
+-b/--bins is ignored), so no scan of the data range is required. The existing
+file must have been created (by this version of w_pdist) from the same input
+data and starting iteration; otherwise, an error is raised and the file is
+left untouched. If the output file does not exist, all iterations are
+histogrammed as usual.
+
+New data may fall outside the stored bin boundaries. By default, such values
+are excluded from the new histograms (as with --loose), and the number of
+excluded (segment, timepoint) pairs in each iteration is recorded in the
+``n_clipped`` dataset and reported. Alternatively, with --rebin, new data are
+first scanned, and if any fall outside the stored boundaries, bins are
+constructed anew according to -b/--bins (covering both the range previously
+recorded and the new data) and all iterations are histogrammed again.
+
+
 -----------------------------------------------------------------------------
 Output format
 -----------------------------------------------------------------------------
@@ -152,6 +286,16 @@ HDF5 files) from this data. In short, the following datasets are created:
   ``histograms``
     Normalized histograms. The first axis corresponds to iteration, and
     remaining axes correspond to dimensions of the input dataset.
+
+    With --sparse, ``histograms`` is instead a group storing only the
+    occupied bins of each histogram, which is far more compact for
+    histograms of three or more dimensions. The values of the occupied bins
+    of all iterations are stored consecutively in ``histograms/value``, with
+    the corresponding indices into the flattened (C-ordered) array of bins in
+    ``histograms/index``. The entries for the i-th stored iteration are those
+    from ``histograms/offsets[i]`` up to (but not including)
+    ``histograms/offsets[i+1]``. The shape of a dense histogram is stored in
+    the ``shape`` attribute of the group. ``plothist`` reads either form.
     
   ``/binbounds_0``
     Vector of bin boundaries for the first (index 0) dimension. Additional
@@ -166,6 +310,15 @@ HDF5 files) from this data. In short, the following datasets are created:
     Vector of iteration numbers corresponding to the stored histograms (i.e.
     the first axis of the ``histograms`` dataset).
 
+  ``n_clipped``
+    Vector of the number of values in each iteration which fell outside the
+    bin boundaries and were excluded from the histogram (with --loose, or when
+    appending).
+
+  ``/data_range``
+    Array of the (minimum, maximum) of the data scanned in each dimension, if
+    bin boundaries were constructed from the data range.
+
 
 -----------------------------------------------------------------------------
 Subsequent processing
@@ -224,6 +377,13 @@ Command-line options
         self.data_range = None # data range for each dimension, as the pairs (min,max)
         self.ignore_out_of_range = False
         self.compress_output = False
+        self.dsspec_id = None
+        self.append = False
+        self.rebin = False
+        self.sparse = False
+        self.nthreads = 1
+        self.deterministic = False
+        self.single_pass = False
         
     
     def add_args(self, parser):
@@ -246,11 +406,39 @@ Command-line options
                             more tractable, at the (possible extreme) expense of increased analysis time.
                             (Default: no compression.)''')
         
+        parser.add_argument('--single-pass', dest='single_pass', action='store_true',
+                            help='''When bins are constructed from the data range (with a number of bins given by
+                            -b/--bins), read input data only once, rather than once to find the data range and again
+                            to histogram it. Bins are then of power-of-two width; see "Histogram binning" above.''')
+        parser.add_argument('--sparse', action='store_true',
+                            help='''Store only the occupied bins of each histogram (see "Output format" above).
+                            Recommended for histograms of three or more dimensions. When appending, the format
+                            of the existing file is used.''')
+        
         parser.add_argument('--loose', dest='ignore_out_of_range', action='store_true',
                             help='''Ignore values that do not fall within bins. (Risky, as this can make buggy bin
                             boundaries appear as reasonable data. Only use if you are
                             sure of your bin boundary specification.)''')
         
+        parser.add_argument('--append', action='store_true',
+                            help='''If OUTPUT exists, histogram only those iterations not already present in it,
+                            reusing its bin boundaries. OUTPUT must have been produced from the same input data.
+                            (See "Incremental histogramming" above.)''')
+        parser.add_argument('--rebin', action='store_true',
+                            help='''When appending, construct new bins and histogram all iterations again if new
+                            data fall outside the stored bin boundaries, rather than excluding (and counting)
+                            such values.''')
+        
+        parser.add_argument('--threads', type=int, default=1,
+                            help='''Bin the data of each iteration in parallel using THREADS threads, in addition
+                            to any parallelism across iterations provided by the work manager. Most useful with
+                            the serial or threads work managers and iterations with many segments or timepoints.
+                            (Default: %(default)s.)''')
+        parser.add_argument('--deterministic', action='store_true',
+                            help='''When binning with more than one thread, accumulate weights in the same order as
+                            serial binning, so that histograms do not depend (even by rounding) on the number of
+                            threads used. Somewhat slower.''')
+
         igroup = parser.add_argument_group('input dataset options').add_mutually_exclusive_group(required=False)
 
         igroup.add_argument('--construct-dataset',
@@ -283,35 +471,153 @@ Command-line options
         self.output_filename = args.output
         self.ignore_out_of_range = bool(args.ignore_out_of_range)
         self.compress_output = args.compress or False
+        self.append = bool(args.append)
+        self.rebin = bool(args.rebin)
+        self.sparse = bool(args.sparse)
+        self.single_pass = bool(args.single_pass)
+        if args.threads < 1:
+            raise ValueError('at least one thread is required')
+        self.nthreads = args.threads
+        self.deterministic = bool(args.deterministic)
+
+        if args.construct_dataset:
+            self.dsspec_id = 'function:{}'.format(args.construct_dataset)
+        else:
+            self.dsspec_id = 'dsspecs:{}'.format(' '.join(args.dsspecs or [self.input_dssynth.default_dsname]))
         
     
+    def check_append(self):
+        '''Verify that the existing output file was produced from the same input data and starting
+        iteration as requested now, and that its datasets can be extended. Raises ValueError if not.
+        Loads the stored bin boundaries and data range, and returns the first iteration not yet
+        histogrammed.'''
+
+        output_file = self.output_file
+        if output_file.attrs.get('dsspec') != self.dsspec_id:
+            raise ValueError('cannot append to {}: input dataset {!r} differs from that used to create it ({!r})'
+                             .format(self.output_filename, self.dsspec_id, output_file.attrs.get('dsspec')))
+
+        self.sparse = isinstance(output_file.get('histograms'), h5py.Group)
+        if self.sparse:
+            dsnames = ('histograms/index', 'histograms/value', 'histograms/offsets', 'n_iter', 'n_clipped')
+        else:
+            dsnames = ('histograms', 'n_iter', 'n_clipped')
+        for dsname in dsnames:
+            if dsname not in output_file or output_file[dsname].maxshape[0] is not None:
+                raise ValueError('cannot append to {}: dataset {!r} is missing or not extensible'
+                                 .format(self.output_filename, dsname))
+
+        try:
+            iter_start, iter_stop = h5io.get_iter_range(output_file['histograms'])
+        except KeyError:
+            raise ValueError('cannot append to {}: file is incomplete (was a previous run interrupted?)'
+                             .format(self.output_filename))
+        if iter_start != self.iter_start:
+            raise ValueError('cannot append to {}: it begins at iteration {:d}, not {:d}'
+                             .format(self.output_filename, iter_start, self.iter_start))
+        if iter_stop > self.iter_stop:
+            raise ValueError('cannot append to {}: it already extends to iteration {:d}'
+                             .format(self.output_filename, iter_stop-1))
+
+        if self.sparse:
+            ndim = len(output_file['histograms'].attrs['shape'])
+        else:
+            ndim = output_file['histograms'].ndim - 1
+        self.binbounds = [output_file['binbounds_{}'.format(idim)][...] for idim in xrange(ndim)]
+        self.midpoints = [output_file['midpoints_{}'.format(idim)][...] for idim in xrange(ndim)]
+        if 'data_range' in output_file:
+            self.data_range = [tuple(dim_range) for dim_range in output_file['data_range'][...]]
+
+        return iter_stop
+
+    def check_data_range(self, iter_start):
+        '''Scan data from ``iter_start`` onwards, and return True if it lies entirely within the current
+        bin boundaries. The range found is merged with that previously recorded, if any; otherwise,
+        ``self.data_range`` is cleared, so that any new bins are constructed from a full scan.'''
+
+        stored_range = self.data_range
+        self.scan_data_range(iter_start)
+        new_range = self.data_range
+
+        if len(new_range) != len(self.binbounds):
+            raise ValueError('dimensionality of input data ({}) does not match that of stored histograms ({})'
+                             .format(len(new_range), len(self.binbounds)))
+
+        if stored_range is not None:
+            self.data_range = [(min(lb, stored_lb), max(ub, stored_ub))
+                               for ((lb, ub), (stored_lb, stored_ub)) in izip(new_range, stored_range)]
+        else:
+            self.data_range = None
+
+        return all(lb >= boundset[0] and ub < boundset[-1]
+                   for ((lb, ub), boundset) in izip(new_range, self.binbounds))
+
     def go(self):
         self.data_reader.open('r')
         pi = self.progress.indicator
         pi.operation = 'Initializing'
         with pi:
-            self.output_file = h5py.File(self.output_filename, 'w')
-            h5io.stamp_creator_data(self.output_file)
-            
             self.iter_start = self.iter_range.iter_start
             self.iter_stop = self.iter_range.iter_stop
-    
-            # Construct bin boundaries
-            self.construct_bins(self.parse_binspec(self.binspec))
-            for idim, (binbounds, midpoints) in enumerate(izip(self.binbounds, self.midpoints)):
-                self.output_file['binbounds_{}'.format(idim)] = binbounds
-                self.output_file['midpoints_{}'.format(idim)] = midpoints
-    
-            # construct histogram
-            self.construct_histogram()
+            first_new_iter = self.iter_start
+
+            appending = self.append and os.path.exists(self.output_filename)
+            if appending:
+                self.output_file = h5py.File(self.output_filename, 'r+')
+                first_new_iter = self.check_append()
+                if self.rebin and first_new_iter < self.iter_stop and not self.check_data_range(first_new_iter):
+                    log.info('new data fall outside stored bin boundaries; rebinning all iterations')
+                    self.output_file.close()
+                    appending = False
+                    first_new_iter = self.iter_start
+
+            if not appending:
+                self.output_file = h5py.File(self.output_filename, 'w')
+                h5io.stamp_creator_data(self.output_file)
+                self.output_file.attrs['dsspec'] = self.dsspec_id
+
+                bins = self.parse_binspec(self.binspec)
+                single_pass = self.single_pass and not (isiterable(bins) and isiterable(bins[0]))
+            else:
+                single_pass = False
+
+            if single_pass:
+                # Construct bins and histograms together, reading data only once
+                self.construct_histogram_single_pass(bins)
+            else:
+                if not appending:
+                    # Construct bin boundaries
+                    self.construct_bins(bins)
+                    self.store_bins()
+
+                # construct histogram
+                self.construct_histogram(first_new_iter)
     
             # Record iteration range        
-            iter_range = self.iter_range.iter_range()
-            self.output_file['n_iter'] = iter_range
+            iter_range = self.iter_range.iter_range(dtype=n_iter_dtype)
+            if appending:
+                n_iter_ds = self.output_file['n_iter']
+                n_iter_ds.resize((len(iter_range),))
+                n_iter_ds[...] = iter_range
+            else:
+                self.output_file.create_dataset('n_iter', data=iter_range, maxshape=(None,))
+            if appending and self.data_range is not None and 'data_range' in self.output_file:
+                self.output_file['data_range'][...] = self.data_range
+
+            # Stamp the iteration range only once all iterations are histogrammed, so that an
+            # interrupted append resumes from the last complete run
             self.iter_range.record_data_iter_range(self.output_file['histograms'])
             
             self.output_file.close()
 
+    def store_bins(self):
+        '''Store bin boundaries, midpoints, and (if known) the data range in the output file.'''
+        for idim, (binbounds, midpoints) in enumerate(izip(self.binbounds, self.midpoints)):
+            self.output_file['binbounds_{}'.format(idim)] = binbounds
+            self.output_file['midpoints_{}'.format(idim)] = midpoints
+        if self.data_range is not None:
+            self.output_file['data_range'] = numpy.array(self.data_range, dtype=numpy.float64)
+
     @staticmethod    
     def parse_binspec(binspec):
         namespace = {'numpy': numpy,
@@ -357,11 +663,13 @@ Command-line options
             self.dset_dtype = dset.dtype
         
             
-    def scan_data_range(self):
-        '''Scan input data for range in each dimension. The number of dimensions is determined
-        from the shape of the progress coordinate as of self.iter_start.'''
+    def scan_data_range(self, iter_start=None):
+        '''Scan input data for range in each dimension, from iteration ``iter_start`` (default:
+        self.iter_start) onwards. The number of dimensions is determined from the shape of the
+        progress coordinate as of self.iter_start.'''
         
-        self.progress.indicator.new_operation('Scanning for data range', self.iter_stop-self.iter_start)
+        iter_start = self.iter_start if iter_start is None else iter_start
+        self.progress.indicator.new_operation('Scanning for data range', self.iter_stop-iter_start)
         self.scan_data_shape()
         
                 
@@ -385,7 +693,7 @@ Command-line options
         
         #for future in self.work_manager.as_completed(futures):
         for future in self.work_manager.submit_as_completed(((_remote_min_max, (ndim, dset_dtype, n_iter, dsspec), {})
-                                                             for n_iter in xrange(self.iter_start, self.iter_stop)),
+                                                             for n_iter in xrange(iter_start, self.iter_stop)),
                                                             self.max_queue_len):
             bounds = future.get_result(discard=True)
             for idim in xrange(ndim):
@@ -439,23 +747,27 @@ Command-line options
             self.binbounds.append(boundset)
             self.midpoints.append((boundset[:-1]+boundset[1:])/2.0)
             
-    def construct_histogram(self):
+    def construct_histogram(self, first_new_iter=None):
         '''Construct a histogram using bins previously constructed with ``construct_bins()``.
-        The time series of histogram values is stored in ``histograms``.
+        The time series of histogram values is stored in ``histograms``, extending any histograms
+        already present for iterations before ``first_new_iter``.
         Each histogram in the time series is normalized.'''
         
         self.scan_data_shape()
         
-        iter_count = self.iter_stop - self.iter_start
-        histograms_ds = self.output_file.create_dataset('histograms', dtype=numpy.float64,
-                                                        shape=((iter_count,) + tuple(len(bounds)-1 for bounds in self.binbounds)),
-                                                        compression=9 if self.compress_output else None)
+        first_new_iter = self.iter_start if first_new_iter is None else first_new_iter
+        histograms_ds, sparse_writer, n_clipped_ds = self.open_histogram_storage(first_new_iter)
         binbounds = [numpy.require(boundset, self.dset_dtype, 'C') for boundset in self.binbounds]
+
+        # Values outside the bins raise an error, unless ignored by request or appended to
+        # existing histograms (in which case they are counted)
+        ignore_out_of_range = self.ignore_out_of_range or first_new_iter > self.iter_start
         
-        self.progress.indicator.new_operation('Constructing histograms',self.iter_stop-self.iter_start)
+        self.progress.indicator.new_operation('Constructing histograms',self.iter_stop-first_new_iter)
         task_gen = ((_remote_bin_iter, (iiter, n_iter, self.dsspec, self.wt_dsspec, 1 if iiter > 0 else 0, binbounds,
-                                        self.ignore_out_of_range), {}) 
-                    for (iiter,n_iter) in enumerate(xrange(self.iter_start, self.iter_stop)))
+                                        ignore_out_of_range, self.sparse, self.nthreads, self.deterministic), {}) 
+                    for (iiter,n_iter) in enumerate(xrange(first_new_iter, self.iter_stop),
+                                                    first_new_iter-self.iter_start))
         #futures = set()
         #for iiter, n_iter in enumerate(xrange(self.iter_start, self.iter_stop)):
         #    initpoint = 1 if iiter > 0 else 0
@@ -466,15 +778,153 @@ Command-line options
             #future = self.work_manager.wait_any(futures)
         #for future in self.work_manager.submit_as_completed(task_gen, self.queue_size):
         log.debug('max queue length: {!r}'.format(self.max_queue_len))
+        total_clipped = 0
         for future in self.work_manager.submit_as_completed(task_gen, self.max_queue_len):
-            iiter, n_iter, iter_hist = future.get_result(discard=True)
+            iiter, n_iter, iter_hist, n_clipped = future.get_result(discard=True)
             self.progress.indicator.progress += 1
 
             # store histogram
-            histograms_ds[iiter] = iter_hist
+            if self.sparse:
+                sparse_writer.add(iiter, *iter_hist)
+            else:
+                histograms_ds[iiter] = iter_hist
+            n_clipped_ds[iiter] = n_clipped
+            total_clipped += n_clipped
             del iter_hist, future
-            
 
+        if total_clipped:
+            log.warning('{:d} values in iterations {:d}-{:d} fell outside bin boundaries and were excluded'
+                        .format(total_clipped, first_new_iter, self.iter_stop-1))
+
+    def open_histogram_storage(self, first_new_iter):
+        '''Create the ``histograms`` and ``n_clipped`` datasets for bins previously constructed, or extend
+        those already present for iterations before ``first_new_iter``. Returns the histograms dataset
+        (or None, if sparse), a ``_SparseHistogramWriter`` for sparse histograms (or None), and the
+        ``n_clipped`` dataset.'''
+        iter_count = self.iter_stop - self.iter_start
+        hist_shape = tuple(len(bounds)-1 for bounds in self.binbounds)
+        histograms_ds = sparse_writer = None
+        compression = 9 if self.compress_output else None
+        if 'histograms' in self.output_file:
+            n_clipped_ds = self.output_file['n_clipped']
+            n_clipped_ds.resize((iter_count,))
+            if self.sparse:
+                self.output_file['histograms/offsets'].resize((iter_count+1,))
+            else:
+                histograms_ds = self.output_file['histograms']
+                histograms_ds.resize((iter_count,) + hist_shape)
+        else:
+            n_clipped_ds = self.output_file.create_dataset('n_clipped', dtype=numpy.int64, shape=(iter_count,),
+                                                           maxshape=(None,))
+            if self.sparse:
+                hist_group = self.output_file.create_group('histograms')
+                hist_group.attrs['shape'] = hist_shape
+                for (dsname, dtype) in (('index', numpy.int64), ('value', numpy.float64)):
+                    hist_group.create_dataset(dsname, dtype=dtype, shape=(0,), maxshape=(None,),
+                                              chunks=(sparse_chunk_length,), compression=compression)
+                hist_group.create_dataset('offsets', dtype=numpy.int64, shape=(iter_count+1,), maxshape=(None,))
+            else:
+                histograms_ds = self.output_file.create_dataset('histograms', dtype=numpy.float64,
+                                                                shape=((iter_count,) + hist_shape),
+                                                                maxshape=((None,) + hist_shape),
+                                                                chunks=((1,) + hist_shape),
+                                                                compression=compression)
+        if self.sparse:
+            sparse_writer = _SparseHistogramWriter(self.output_file['histograms'], first_new_iter-self.iter_start)
+        return histograms_ds, sparse_writer, n_clipped_ds
+
+    def construct_histogram_single_pass(self, bins):
+        '''Construct bins and histograms together, reading each iteration of data only once, for
+        ``bins`` a scalar integer or sequence of integers (as for ``construct_bins()``). Each iteration
+        is histogrammed on the narrowest grid of power-of-two bin width (in each dimension), with bin
+        boundaries at integer multiples of that width, for which at most the requested number of bins
+        cover its data. Once the full data range is known, histograms are coarsened to the common grid
+        of this kind for all data by merging (aligned) groups of bins, which is exact. The resulting
+        number of bins in each dimension is at least half (approximately) and at most that requested.'''
+
+        self.scan_data_shape()
+        ndim = self.ndim
+        if isiterable(bins):
+            nbins = list(bins)
+            if len(nbins) != ndim:
+                raise ValueError('number of bin counts ({}) does not match dimensionality of data ({})'
+                                 .format(len(nbins), ndim))
+        else:
+            nbins = [bins]*ndim
+        if min(nbins) < 2:
+            raise ValueError('single-pass binning requires at least two bins in each dimension')
+
+        iter_count = self.iter_stop - self.iter_start
+        iter_results = [None]*iter_count
+        max_exponents = numpy.empty((ndim,), numpy.int64)
+        max_exponents.fill(numpy.iinfo(numpy.int64).min)
+        data_range = numpy.empty((ndim,2), numpy.float64)
+        data_range[:,0] = numpy.inf
+        data_range[:,1] = -numpy.inf
+
+        self.progress.indicator.new_operation('Constructing histograms', iter_count)
+        task_gen = ((_remote_bin_iter_pow2, (iiter, n_iter, self.dsspec, self.wt_dsspec, 1 if iiter > 0 else 0, nbins), {})
+                    for (iiter,n_iter) in enumerate(xrange(self.iter_start, self.iter_stop)))
+        for future in self.work_manager.submit_as_completed(task_gen, self.max_queue_len):
+            iiter, n_iter, exponents, occupied, values, iter_range = future.get_result(discard=True)
+            self.progress.indicator.progress += 1
+            if exponents is not None:
+                iter_results[iiter] = (exponents, occupied, values)
+                numpy.maximum(max_exponents, exponents, out=max_exponents)
+                numpy.minimum(data_range[:,0], iter_range[:,0], out=data_range[:,0])
+                numpy.maximum(data_range[:,1], iter_range[:,1], out=data_range[:,1])
+            del future, occupied, values
+
+        if not numpy.isfinite(data_range).all():
+            raise ValueError('no data to histogram')
+
+        # Construct the common grid, which is at least as coarse as that of every iteration
+        exponents = numpy.empty((ndim,), numpy.int64)
+        origins = numpy.empty((ndim,), numpy.int64)
+        self.binbounds = []
+        self.midpoints = []
+        for idim in xrange(ndim):
+            lb, ub = data_range[idim]
+            exponent = exponents[idim] = max(max_exponents[idim], _pow2_bin_exponent(lb, ub, nbins[idim]))
+            origins[idim] = math.floor(math.ldexp(lb, -exponent))
+            boundset = numpy.ldexp(numpy.arange(origins[idim], origins[idim] + _pow2_bin_count(lb, ub, exponent) + 1,
+                                                dtype=numpy.float64), int(exponent))
+            self.binbounds.append(boundset)
+            self.midpoints.append((boundset[:-1] + boundset[1:]) / 2.0)
+        self.data_range = [tuple(dim_range) for dim_range in data_range]
+        self.store_bins()
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('binbounds: {!r}'.format(self.binbounds))
+
+        histograms_ds, sparse_writer, n_clipped_ds = self.open_histogram_storage(self.iter_start)
+        hist_shape = tuple(len(bounds)-1 for bounds in self.binbounds)
+        n_clipped_ds[...] = 0
+
+        # Merge bins of each iteration into the common grid, then normalize and store
+        self.progress.indicator.new_operation('Storing histograms', iter_count)
+        for iiter in xrange(iter_count):
+            if iter_results[iiter] is not None:
+                iter_exponents, occupied, values = iter_results[iiter]
+                iter_results[iiter] = None
+                shifts = numpy.minimum(exponents - iter_exponents, 63)
+                occupied = (occupied >> shifts[:,numpy.newaxis]) - origins[:,numpy.newaxis]
+                flat_indices = numpy.ravel_multi_index(tuple(occupied), hist_shape)
+            else:
+                flat_indices = numpy.empty((0,), numpy.int64)
+                values = numpy.empty((0,), numpy.float64)
+
+            if self.sparse:
+                indices, inverse = numpy.unique(flat_indices, return_inverse=True)
+                iter_hist = numpy.bincount(inverse, weights=values, minlength=len(indices))
+                normhistnd_sparse(indices, iter_hist, self.binbounds)
+                sparse_writer.add(iiter, indices, iter_hist)
+            else:
+                iter_hist = numpy.bincount(flat_indices, weights=values,
+                                           minlength=numpy.multiply.reduce(hist_shape)).reshape(hist_shape)
+                normhistnd(iter_hist, self.binbounds)
+                histograms_ds[iiter] = iter_hist
+            self.progress.indicator.progress += 1
+            del flat_indices, values, iter_hist
 
 if __name__ == '__main__':
     WPDist().main()
@@ -20,16 +20,14 @@ import logging
 
 import numpy as np
 import scipy.sparse as sp
-from scipy.sparse import csgraph
 import h5py
 
-from collections import Counter
-
 import westpa
 from west.data_manager import weight_dtype, n_iter_dtype
 from westtools import (WESTTool, WESTDataReader, IterRangeSelection,
                        ProgressIndicatorComponent)
 from westpa import h5io
+from westpa.kinetics import SteadyStateSolver
 from westtools.dtypes import iter_block_ci_dtype as ci_dtype
 
 log = logging.getLogger('westtools.w_postanalysis_reweight')
@@ -45,31 +43,19 @@ def normalize(m):
     return nm
 
 
-def steadystate_solve(K):
-    # Reformulate K to remove sink/source states
-    n_components, component_assignments = csgraph.connected_components(K, connection="strong")
-    largest_component = Counter(component_assignments).most_common(1)[0][0]
-    components = np.where(component_assignments == largest_component)[0]
-
-    ii = np.ix_(components, components)
-    K_mod = K[ii]
-    K_mod = normalize(K_mod)
-
-    eigvals, eigvecs = np.linalg.eig(K_mod.T)
-    eigvals = np.real(eigvals)
-    eigvecs = np.real(eigvecs)
+def steadystate_solve(K, solver=None):
+    # Steady state over the largest strongly-connected component of K (sink/source states removed)
+    if solver is None:
+        solver = SteadyStateSolver()
+    bin_prob = solver.solve(K)
 
-    maxi = np.argmax(eigvals)
-    if not np.allclose(np.abs(eigvals[maxi]), 1.0):
+    if bin_prob is not None and len(solver.excluded_states):
+        print('WARNING: Steady state excludes {:d} bin(s) outside the largest strongly-connected component: {!r}'
+              .format(len(solver.excluded_states), list(solver.excluded_states)))
+    if bin_prob is None:
         print('WARNING: Steady-state undetermined for current iteration')
         bin_prob = K.diagonal().copy()
         bin_prob = bin_prob / np.sum(bin_prob)
-        return bin_prob
-
-    sub_bin_prob = eigvecs[:, maxi] / np.sum(eigvecs[:, maxi])
-
-    bin_prob = np.zeros(K.shape[0])
-    bin_prob[components] = sub_bin_prob
 
     return bin_prob
 
@@ -103,7 +89,8 @@ def accumulate_statistics(h5file, start_iter, stop_iter, nbins, total_fluxes=Non
     return total_fluxes, total_obs, total_pop
 
 
-def reweight(h5file, start, stop, nstates, nbins, state_labels, state_map, nfbins, obs_threshold=1, total_fluxes=None, total_obs=None):
+def reweight(h5file, start, stop, nstates, nbins, state_labels, state_map, nfbins, obs_threshold=1, total_fluxes=None, total_obs=None,
+             solver=None):
 
     total_fluxes, total_obs, total_pop = accumulate_statistics(h5file, start, stop, nfbins, total_fluxes, total_obs)
 
@@ -111,7 +98,7 @@ def reweight(h5file, start, stop, nstates, nbins, state_labels, state_map, nfbin
     flux_matrix[total_obs < obs_threshold] = 0.0
     transition_matrix = normalize(flux_matrix)
 
-    rw_bin_probs = steadystate_solve(transition_matrix)
+    rw_bin_probs = steadystate_solve(transition_matrix, solver)
 
     bin_last_state_map = np.tile(np.arange(nstates, dtype=np.int), nbins)
     bin_state_map = np.repeat(state_map[:-1], nstates)
@@ -300,6 +287,9 @@ Command-line options
             bin_prob_evol = np.zeros((len(start_pts), nfbins))
             pi.new_operation('Calculating flux evolution', len(start_pts))
 
+            # Successive windows are similar, so each steady-state solution starts from the last
+            solver = SteadyStateSolver()
+
             if self.evolution_mode == 'cumulative' and self.evol_window_frac == 1.0:
                 print('Using fast streaming accumulation')
 
@@ -313,7 +303,7 @@ Command-line options
                     params = dict(start=start, stop=stop, nstates=nstates, nbins=nbins,
                                   state_labels=state_labels, state_map=state_map, nfbins=nfbins,
                                   total_fluxes=total_fluxes, total_obs=total_obs,
-                                  h5file=self.kinetics_file, obs_threshold=self.obs_threshold)
+                                  h5file=self.kinetics_file, obs_threshold=self.obs_threshold, solver=solver)
 
                     rw_state_flux, rw_color_probs, rw_state_probs, rw_bin_probs, rw_bin_flux = reweight(**params)
                     for k in xrange(nstates):
@@ -343,7 +333,7 @@ Command-line options
                     params = dict(start=block_start, stop=stop, nstates=nstates, nbins=nbins,
                                   state_labels=state_labels, state_map=state_map, nfbins=nfbins,
                                   total_fluxes=None, total_obs=None,
-                                  h5file=self.kinetics_file)
+                                  h5file=self.kinetics_file, solver=solver)
 
                     rw_state_flux, rw_color_probs, rw_state_probs, rw_bin_probs, rw_bin_flux = reweight(**params)
                     for k in xrange(nstates):
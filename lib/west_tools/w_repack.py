@@ -0,0 +1,177 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function, division; __metaclass__ = type
+import os, shutil, tempfile
+import logging
+
+import numpy, h5py
+from westtools import WESTTool, ProgressIndicatorComponent
+from westpa import h5io
+
+log = logging.getLogger('westtools.w_repack')
+
+# Maximum amount of data (in bytes) to copy at once
+copy_block_nbytes = 64*1024*1024
+
+class WRepack(WESTTool):
+    prog='w_repack'
+    description = '''\
+Rewrite an HDF5 file produced by WESTPA analysis tools (for instance, the
+output of w_assign), changing the chunk layout and compression of its
+multidimensional datasets to suit the way they will be read. Groups,
+attributes, and all other datasets are copied unchanged.
+
+Two chunk layouts (--layout) are available:
+
+  iteration
+    (Default.) Each chunk spans a single iteration, all timepoints (and any
+    further axes), and as many segments as fit in one chunk. This suits
+    tools which read [iteration][segment][timepoint] data one iteration at a
+    time, such as w_kinetics, w_ntop, and w_postanalysis_matrix.
+
+  auto
+    Chunk sizes chosen without regard to access pattern, as used by earlier
+    versions of WESTPA.
+
+By default, all datasets with three or more dimensions are repacked;
+individual datasets may instead be selected by name with -d/--dataset.
+
+Unless an output file is given with -o/--output, the input file is replaced
+by its repacked version once repacking is complete.
+
+
+-----------------------------------------------------------------------------
+Command-line options
+-----------------------------------------------------------------------------
+'''
+
+    def __init__(self):
+        super(WRepack,self).__init__()
+        self.progress = ProgressIndicatorComponent()
+        self.input_filename = None
+        self.output_filename = None
+        self.layout = None
+        self.compression = None
+        self.dsnames = None
+
+    def add_args(self, parser):
+        parser.add_argument('input', metavar='INPUT',
+                            help='''Repack the HDF5 file INPUT.''')
+        parser.add_argument('-o', '--output', dest='output',
+                            help='''Store repacked data in OUTPUT (default: replace INPUT).''')
+        parser.add_argument('--layout', choices=('iteration', 'auto'), default='iteration',
+                            help='''Chunk repacked datasets for the given access pattern (see above;
+                            default: %(default)s).''')
+        parser.add_argument('--compression', choices=h5io.compression_codecs, default='gzip',
+                            help='''Compress repacked datasets with the given codec, as for w_assign
+                            (default: %(default)s).''')
+        parser.add_argument('-d', '--dataset', dest='dsnames', metavar='DSNAME', action='append',
+                            help='''Repack the dataset DSNAME (an HDF5 path within INPUT). May be given
+                            more than once. (Default: all datasets of three or more dimensions.)''')
+        self.progress.add_args(parser)
+
+    def process_args(self, args):
+        self.progress.process_args(args)
+        self.input_filename = args.input
+        self.output_filename = args.output
+        self.layout = args.layout
+        self.compression = args.compression
+        self.dsnames = set('/' + dsname.lstrip('/') for dsname in args.dsnames) if args.dsnames else None
+
+    def select_dataset(self, dataset):
+        if self.dsnames is not None:
+            return dataset.name in self.dsnames
+        else:
+            return dataset.ndim >= 3
+
+    def repack_dataset(self, src_ds, dest_group, name):
+        if self.layout == 'iteration' and src_ds.ndim >= 2:
+            chunks = h5io.calc_iter_chunksize(src_ds.shape, src_ds.dtype)
+        else:
+            chunks = h5io.calc_chunksize(src_ds.shape, src_ds.dtype)
+            chunks = tuple(max(1,dim) for dim in chunks)
+        log.debug('repacking {} with chunks {!r}'.format(src_ds.name, chunks))
+
+        dest_ds = dest_group.create_dataset(name, shape=src_ds.shape, dtype=src_ds.dtype, chunks=chunks,
+                                            maxshape=src_ds.maxshape, fillvalue=src_ds.fillvalue,
+                                            **h5io.get_compression_opts(self.compression))
+        for key, value in src_ds.attrs.iteritems():
+            dest_ds.attrs[key] = value
+
+        # copy whole chunks along the first axis, in blocks of bounded size
+        if src_ds.size:
+            row_nbytes = int(numpy.prod(src_ds.shape[1:], dtype=numpy.int64))*src_ds.dtype.itemsize
+            blocksize = max(1, copy_block_nbytes // max(1,row_nbytes))
+            blocksize = max(chunks[0], blocksize - blocksize % chunks[0])
+            for istart in xrange(0, src_ds.shape[0], blocksize):
+                istop = min(src_ds.shape[0], istart+blocksize)
+                dest_ds[istart:istop] = src_ds[istart:istop]
+
+    def copy_group(self, src_group, dest_group):
+        for key, value in src_group.attrs.iteritems():
+            dest_group.attrs[key] = value
+
+        pi = self.progress.indicator
+        for name in src_group:
+            link = src_group.get(name, getlink=True)
+            if isinstance(link, (h5py.SoftLink, h5py.ExternalLink)):
+                dest_group[name] = link
+                continue
+
+            obj = src_group[name]
+            if isinstance(obj, h5py.Group):
+                self.copy_group(obj, dest_group.create_group(name))
+            elif isinstance(obj, h5py.Dataset) and self.select_dataset(obj):
+                self.repack_dataset(obj, dest_group, name)
+                pi.progress += 1
+            else:
+                src_group.copy(obj, dest_group, name=name)
+
+    def go(self):
+        pi = self.progress.indicator
+        if self.output_filename:
+            output_filename = self.output_filename
+        else:
+            fd, output_filename = tempfile.mkstemp(suffix='.h5', prefix='w_repack_',
+                                                   dir=os.path.dirname(os.path.abspath(self.input_filename)))
+            os.close(fd)
+
+        with pi:
+            try:
+                with h5py.File(self.input_filename, 'r') as input_file, h5py.File(output_filename, 'w') as output_file:
+                    dsnames = []
+                    input_file.visititems(lambda name, obj: dsnames.append(name)
+                                          if isinstance(obj, h5py.Dataset) and self.select_dataset(obj) else None)
+                    if self.dsnames is not None:
+                        missing = self.dsnames - set('/' + name for name in dsnames)
+                        if missing:
+                            raise KeyError('dataset(s) not found in {}: {}'.format(self.input_filename,
+                                                                                   ', '.join(sorted(missing))))
+                    pi.new_operation('Repacking', len(dsnames))
+                    self.copy_group(input_file, output_file)
+            except:
+                if not self.output_filename:
+                    os.unlink(output_filename)
+                raise
+
+        if not self.output_filename:
+            shutil.copymode(self.input_filename, output_filename)
+            os.rename(output_filename, self.input_filename)
+
+if __name__ == '__main__':
+    WRepack().main()
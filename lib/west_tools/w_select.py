@@ -26,22 +26,52 @@ from westpa import h5io
 from west.data_manager import seg_id_dtype, n_iter_dtype, weight_dtype
 from westpa.extloader import get_object
 
-def _find_matching_segments(west_datafile_name, n_iter, predicate, invert=False):
-    '''Find all segments in iteration ``n_iter`` that match (or do not match, if
-    ``invert`` is true) the given ``predicate``. Returns a sequence of matching
-    seg_ids.'''
-
+# Maximum number of iterations evaluated per task
+max_iter_block_size = 250
+
+def _matching_mask(n_iter, iter_group, nsegs, predicate, invert=False):
+    '''Evaluate ``predicate`` for iteration ``n_iter``, returning a boolean array with one entry per segment,
+    true for segments matching the predicate (or not matching it, if ``invert`` is true). The predicate may
+    return either a collection of matching seg_ids or a boolean array with one entry per segment.'''
+
+    result = predicate(n_iter, iter_group)
+    if isinstance(result, numpy.ndarray) and result.dtype == numpy.bool_:
+        if result.shape != (nsegs,):
+            raise ValueError('predicate returned a boolean array of shape {!r} for iteration {} of {} segments'
+                             .format(result.shape, n_iter, nsegs))
+        mask = result.copy()
+    else:
+        if isinstance(result, numpy.ndarray):
+            matching_ids = result.astype(seg_id_dtype).ravel()
+        else:
+            matching_ids = numpy.fromiter(imap(long, result), dtype=seg_id_dtype)
+        mask = numpy.zeros((nsegs,), numpy.bool_)
+        mask[matching_ids] = True
+
+    if invert:
+        numpy.logical_not(mask, out=mask)
+    return mask
+
+def _find_matching_segments(west_datafile_name, iter_start, iter_stop, predicate, invert=False, get_weights=True):
+    '''Find all segments in iterations ``iter_start`` through ``iter_stop-1`` that match (or do not match, if
+    ``invert`` is true) the given ``predicate``. Returns a list with one tuple per iteration of the iteration
+    number, its number of segments, the (sorted) matching seg_ids, and (if ``get_weights`` is true) their
+    weights.'''
+
+    results = []
     with h5io.WESTPAH5File(west_datafile_name, 'r') as west_datafile:
-        iter_group = west_datafile.get_iter_group(n_iter)
-        nsegs = iter_group['seg_index'].shape[0]
-        matching_ids = set(imap(long, predicate(n_iter, iter_group)))
-
-        if invert:
-            matching_ids = set(xrange(nsegs)) - matching_ids
-
-        matchvec = numpy.fromiter(matching_ids, dtype=seg_id_dtype, count=len(matching_ids))
-        matchvec.sort()
-        return n_iter, matchvec
+        for n_iter in xrange(iter_start, iter_stop):
+            iter_group = west_datafile.get_iter_group(n_iter)
+            seg_index = iter_group['seg_index']
+            nsegs = seg_index.shape[0]
+            matching_ids = numpy.flatnonzero(_matching_mask(n_iter, iter_group, nsegs, predicate, invert))
+            matching_ids = matching_ids.astype(seg_id_dtype)
+            if get_weights:
+                weights = seg_index['weight'][matching_ids]
+            else:
+                weights = None
+            results.append((n_iter, nsegs, matching_ids, weights))
+    return results
 
 
 class WSelectTool(WESTParallelTool):
@@ -61,8 +91,16 @@ Segments are selected based on a predicate function, which must be callable
 as ``predicate(n_iter, iter_group)`` and return a collection of segment IDs
 matching the predicate in that iteration.
 
-The predicate may be inverted by specifying the -v/--invert command-line
-argument.
+The predicate may instead return a boolean array with one entry for each
+segment in the iteration, true for matching segments, which is usually the
+most efficient form for predicates operating on whole datasets (such as
+``iter_group['pcoord']``). The predicate may be inverted by specifying the
+-v/--invert command-line argument.
+
+The predicate is evaluated for blocks of consecutive iterations in parallel.
+With -a/--include-ancestors, ancestors are then found by following parent IDs
+backwards through the selected iterations, with matching segments and their
+ancestors in each iteration recorded as a bitmap over its segments.
 
 
 -----------------------------------------------------------------------------
@@ -114,8 +152,8 @@ Command-line arguments
         sgroup.add_argument('-p', '--predicate-function', metavar='MODULE.FUNCTION',
                              help='''Use the given predicate function to match segments. This function
                              should take an iteration number and the HDF5 group corresponding to that
-                             iteration and return a sequence of seg_ids matching the predicate, as in
-                             ``match_predicate(n_iter, iter_group)``.''')
+                             iteration and return a sequence of seg_ids matching the predicate (or a boolean
+                             array with one entry per segment), as in ``match_predicate(n_iter, iter_group)``.''')
         sgroup.add_argument('-v', '--invert', dest='invert', action='store_true',
                             help='''Invert the match predicate.''')
         sgroup.add_argument('-a', '--include-ancestors', action ='store_true',
@@ -142,80 +180,102 @@ Command-line arguments
 
     def go(self):
         self.data_reader.open('r')
-        output_file = h5io.WESTPAH5File(self.output_filename, mode='w')
         pi = self.progress.indicator
 
         iter_start, iter_stop = self.iter_range.iter_start, self.iter_range.iter_stop
         iter_count = iter_stop - iter_start
 
-        output_file.create_dataset('n_iter', dtype=n_iter_dtype, data=range(iter_start,iter_stop))
-        current_seg_count = 0
-        seg_count_ds = output_file.create_dataset('n_segs', dtype=numpy.uint, shape=(iter_count,))
-        matching_segs_ds = output_file.create_dataset('seg_ids', shape=(iter_count,0), maxshape=(iter_count,None),
-                                                      dtype=seg_id_dtype,
-                                                      chunks=h5io.calc_chunksize((iter_count,1000000), seg_id_dtype),
-                                                      shuffle=True, compression=9)
-        weights_ds = output_file.create_dataset('weights', shape=(iter_count,0), maxshape=(iter_count,None),
-                                                dtype=weight_dtype,
-                                                chunks=h5io.calc_chunksize((iter_count,1000000), weight_dtype),
-                                                shuffle=True,compression=9)
+        # Segment counts, matching seg_ids, and their weights, for each iteration
+        seg_counts = numpy.zeros((iter_count,), numpy.int64)
+        matching_ids = [None]*iter_count
+        matching_weights = [None]*iter_count
 
         with pi:
             pi.new_operation('Finding matching segments', extent=iter_count)
-#             futures = set()
-#             for n_iter in xrange(iter_start,iter_stop):
-#                 futures.add(self.work_manager.submit(_find_matching_segments, 
-#                                                      args=(self.data_reader.we_h5filename,n_iter,self.predicate,self.invert)))
-
-#             for future in self.work_manager.as_completed(futures):
-            for future in self.work_manager.submit_as_completed(((_find_matching_segments,
-                                                                  (self.data_reader.we_h5filename,n_iter,self.predicate,self.invert),
-                                                                  {}) for n_iter in xrange(iter_start,iter_stop)),
-                                                                self.max_queue_len):
-                n_iter, matching_ids = future.get_result()
-                n_matches = len(matching_ids)
-
-                if n_matches:
-                    if n_matches > current_seg_count:
-                        current_seg_count = len(matching_ids)
-                        matching_segs_ds.resize((iter_count,n_matches))
-                        weights_ds.resize((iter_count,n_matches))
-                        current_seg_count = n_matches
-
-                    seg_count_ds[n_iter-iter_start] = n_matches
-                    matching_segs_ds[n_iter-iter_start,:n_matches] = matching_ids
-                    weights_ds[n_iter-iter_start,:n_matches] = self.data_reader.get_iter_group(n_iter)['seg_index']['weight'][sorted(matching_ids)]
-                del matching_ids
-                pi.progress += 1
+            n_workers = self.work_manager.n_workers or 1
+            block_size = max(1, min(max_iter_block_size, -(-iter_count // (4*n_workers))))
+            task_gen = ((_find_matching_segments,
+                         (self.data_reader.we_h5filename, block_start, min(iter_stop, block_start+block_size),
+                          self.predicate, self.invert, not self.include_ancestors),
+                         {}) for block_start in xrange(iter_start, iter_stop, block_size))
+            for future in self.work_manager.submit_as_completed(task_gen, self.max_queue_len):
+                for (n_iter, nsegs, ids, weights) in future.get_result(discard=True):
+                    iiter = n_iter - iter_start
+                    seg_counts[iiter] = nsegs
+                    matching_ids[iiter] = ids
+                    matching_weights[iiter] = weights
+                    pi.progress += 1
+                del future
 
             if self.include_ancestors:
                 pi.new_operation('Tracing ancestors of matching segments', extent=iter_count)
-                from_previous = set()
-                current_seg_count = matching_segs_ds.shape[1]
-                for n_iter in xrange(iter_stop-1, iter_start-1, -1):
-                    iiter = n_iter - iter_start
-                    n_matches = seg_count_ds[iiter]
-                    matching_ids = set(from_previous)
-                    if n_matches:
-                        matching_ids.update(matching_segs_ds[iiter, :seg_count_ds[iiter]])
-                    from_previous.clear()
-
-                    n_matches = len(matching_ids)
-                    if n_matches > current_seg_count:
-                        matching_segs_ds.resize((iter_count,n_matches))
-                        weights_ds.resize((iter_count,n_matches))
-                        current_seg_count = n_matches
-
-                    if n_matches > 0:
-                        seg_count_ds[iiter] = n_matches
-                        matching_ids = sorted(matching_ids)
-                        matching_segs_ds[iiter,:n_matches] = matching_ids
-                        weights_ds[iiter,:n_matches] = self.data_reader.get_iter_group(n_iter)['seg_index']['weight'][sorted(matching_ids)]
-                        parent_ids = self.data_reader.get_iter_group(n_iter)['seg_index']['parent_id'][sorted(matching_ids)]
-                        from_previous.update(parent_id for parent_id in parent_ids if parent_id >= 0) # filter initial states
-                        del parent_ids
-                    del matching_ids
-                    pi.progress += 1
+                self.trace_ancestors(seg_counts, matching_ids, matching_weights)
+
+            pi.new_operation('Writing output', extent=iter_count)
+            self.write_output(matching_ids, matching_weights)
+
+    def trace_ancestors(self, seg_counts, matching_ids, matching_weights):
+        '''Add the ancestors (within the selected iteration range) of the segments in ``matching_ids`` to
+        ``matching_ids``, and store the weights of all resulting segments in ``matching_weights``. Selected
+        segments are marked in a bitmap over the segments of each iteration, which is propagated to the
+        previous iteration in a single operation on parent IDs.'''
+        pi = self.progress.indicator
+        iter_start = self.iter_range.iter_start
+        from_next = None
+        for iiter in xrange(len(seg_counts)-1, -1, -1):
+            n_iter = iter_start + iiter
+            selected = numpy.zeros((seg_counts[iiter],), numpy.bool_)
+            selected[matching_ids[iiter]] = True
+            if from_next is not None:
+                selected |= from_next
+
+            seg_ids = numpy.flatnonzero(selected).astype(seg_id_dtype)
+            seg_index = self.data_reader.get_iter_group(n_iter)['seg_index'][...]
+            matching_ids[iiter] = seg_ids
+            matching_weights[iiter] = seg_index['weight'][seg_ids]
+
+            if iiter > 0:
+                parent_ids = seg_index['parent_id'][seg_ids]
+                from_next = numpy.zeros((seg_counts[iiter-1],), numpy.bool_)
+                from_next[parent_ids[parent_ids >= 0]] = True # filter initial states
+            del seg_index, selected
+            pi.progress += 1
+
+    def write_output(self, matching_ids, matching_weights):
+        pi = self.progress.indicator
+        iter_start, iter_stop = self.iter_range.iter_start, self.iter_range.iter_stop
+        iter_count = iter_stop - iter_start
+        n_matches = numpy.array([len(ids) for ids in matching_ids], dtype=numpy.uint)
+        max_matches = int(n_matches.max()) if iter_count else 0
+
+        output_file = h5io.WESTPAH5File(self.output_filename, mode='w')
+        output_file.create_dataset('n_iter', dtype=n_iter_dtype, data=range(iter_start,iter_stop))
+        output_file.create_dataset('n_segs', dtype=numpy.uint, data=n_matches)
+        chunks = h5io.calc_chunksize((iter_count,1000000), seg_id_dtype)
+        matching_segs_ds = output_file.create_dataset('seg_ids', shape=(iter_count,max_matches),
+                                                      maxshape=(iter_count,None), dtype=seg_id_dtype,
+                                                      chunks=chunks, shuffle=True, compression=9)
+        weights_ds = output_file.create_dataset('weights', shape=(iter_count,max_matches),
+                                                maxshape=(iter_count,None), dtype=weight_dtype,
+                                                chunks=h5io.calc_chunksize((iter_count,1000000), weight_dtype),
+                                                shuffle=True, compression=9)
+
+        # Write whole rows of chunks at once, so that each chunk is compressed only once
+        block_size = chunks[0]
+        for block_start in xrange(0, iter_count, block_size):
+            block_stop = min(iter_count, block_start+block_size)
+            block_max = int(n_matches[block_start:block_stop].max())
+            if block_max:
+                seg_ids = numpy.zeros((block_stop-block_start, block_max), seg_id_dtype)
+                weights = numpy.zeros((block_stop-block_start, block_max), weight_dtype)
+                for iiter in xrange(block_start, block_stop):
+                    seg_ids[iiter-block_start,:n_matches[iiter]] = matching_ids[iiter]
+                    weights[iiter-block_start,:n_matches[iiter]] = matching_weights[iiter]
+                matching_segs_ds[block_start:block_stop,:block_max] = seg_ids
+                weights_ds[block_start:block_stop,:block_max] = weights
+                del seg_ids, weights
+            pi.progress += block_stop - block_start
+        output_file.close()
 
 if __name__ == '__main__':
     WSelectTool().main()
@@ -23,16 +23,19 @@ import numpy
 from west.data_manager import weight_dtype
 from westtools import (WESTParallelTool, WESTDataReader, IterRangeSelection, ProgressIndicatorComponent)
 from westpa import h5io
-from westpa.binning import accumulate_state_populations_from_labeled
+from westpa.binning import state_populations_from_labeled
 
 import mclib
-from mclib import mcbs_ci_correl
+from mclib import mcbs_ci_correl_windows
 
 
 log = logging.getLogger('westtools.w_stateprobs')
 
 from westtools.dtypes import iter_block_ci_dtype as ci_dtype
 
+# Maximum amount of labeled population data (in bytes) to reduce at once
+pops_block_nbytes = 64*1024*1024
+
 class StateProbTool(WESTParallelTool):
     prog='w_stateprobs'
     description = '''\
@@ -198,49 +201,24 @@ Command-line options
         iter_count = stop_iter-start_iter
         
         pi = self.progress.indicator
-        pi.new_operation('Calculating state populations')
+        pi.new_operation('Calculating state populations', iter_count)
         pops = h5io.IterBlockedDataset(self.assignments_file['labeled_populations'])
         
-        iter_state_pops = numpy.empty((nstates+1,), weight_dtype)
         all_state_pops = numpy.empty((iter_count,nstates+1), weight_dtype)
-        avg_state_pops = numpy.zeros((nstates+1,), weight_dtype)
-        pops.cache_data(max_size='available')
-        try:
-            for iiter,n_iter in enumerate(xrange(start_iter,stop_iter)):
-                iter_state_pops.fill(0)
-                labeled_pops = pops.iter_entry(n_iter)
-                accumulate_state_populations_from_labeled(labeled_pops, state_map, iter_state_pops, check_state_map=False)
-                all_state_pops[iiter] = iter_state_pops
-                avg_state_pops += iter_state_pops
-                del labeled_pops
-                pi.progress += 1
-        finally:
-            pops.drop_cache()
+        iter_nbytes = numpy.multiply.reduce(pops.iter_shape) * pops.dtype.itemsize
+        block_size = max(1, pops_block_nbytes // max(1,iter_nbytes))
+        for block_start in xrange(start_iter, stop_iter, block_size):
+            block_stop = min(block_start+block_size, stop_iter)
+            all_state_pops[block_start-start_iter:block_stop-start_iter] = \
+                state_populations_from_labeled(pops.iter_slice(block_start,block_stop), state_map)
+            pi.progress += block_stop - block_start
         self.output_file.create_dataset('state_pops', data=all_state_pops, compression=9, shuffle=True)
         h5io.stamp_iter_range(self.output_file['state_pops'], start_iter, stop_iter)
         
         self.all_state_pops = all_state_pops
+        pi.new_operation('Calculating overall average populations and CIs')
         avg_state_pops = numpy.zeros((nstates+1,), ci_dtype)
-        pi.new_operation('Calculating overall average populations and CIs', nstates)
-#        futures = []
-#         for istate in xrange(nstates):
-#             futures.append(self.work_manager.submit(_eval_block,kwargs=dict(iblock=None,istate=istate,
-#                                                                             start=start_iter,stop=stop_iter,
-#                                                                             state_pops=all_state_pops[:,istate],
-#                                                                             mcbs_alpha=self.mcbs_alpha, mcbs_nsets=self.mcbs_nsets,
-#                                                                             mcbs_acalpha = self.mcbs_acalpha)))
-#         for future in self.work_manager.as_completed(futures):
-        def taskgen():
-            for istate in xrange(nstates):
-                yield (_eval_block, (), dict(iblock=None,istate=istate,
-                                             start=start_iter,stop=stop_iter,
-                                             state_pops=all_state_pops[:,istate],
-                                             mcbs_alpha=self.mcbs_alpha, mcbs_nsets=self.mcbs_nsets,
-                                             mcbs_acalpha = self.mcbs_acalpha))
-        for future in self.work_manager.submit_as_completed(taskgen(), self.max_queue_len):
-            (_iblock,istate,ci_res) = future.get_result(discard=True)
-            avg_state_pops[istate] = ci_res
-            pi.progress += 1
+        avg_state_pops[:nstates] = self.calc_cis([(start_iter, stop_iter)])[0]
         self.output_file['avg_state_pops'] = avg_state_pops
         self.stamp_mcbs_info(self.output_file['avg_state_pops'])
         pi.clear()
@@ -254,50 +232,37 @@ Command-line options
                           avg_state_pops['ci_lbound'][istate],
                           avg_state_pops['ci_ubound'][istate],
                           maxlabellen=maxlabellen))
+    
+    def calc_cis(self, windows):
+        '''Calculate the average population of each state, and confidence intervals on it, within
+        each of the given ``(iter_start, iter_stop)`` windows. All windows and states are bootstrapped
+        in one batch. Returns an array of shape ``(len(windows), nstates)`` of ``ci_dtype``.'''
+        start_iter = self.iter_range.iter_start
+        windows = numpy.array(windows, dtype=numpy.int64).reshape(-1,2)
+        ci_res = mcbs_ci_correl_windows(self.all_state_pops[:,:self.nstates], windows - start_iter,
+                                        alpha=self.mcbs_alpha, n_sets=self.mcbs_nsets,
+                                        autocorrel_alpha=self.mcbs_acalpha, subsample=numpy.mean)
+        cis = numpy.zeros((len(windows), self.nstates), dtype=ci_dtype)
+        cis['iter_start'] = windows[:,0,numpy.newaxis]
+        cis['iter_stop'] = windows[:,1,numpy.newaxis]
+        for field, values in zip(('expected', 'ci_lbound', 'ci_ubound', 'corr_len'), ci_res):
+            cis[field] = values
+        return cis
         
     def calc_evolution(self):
-        nstates = self.nstates
         start_iter, stop_iter, step_iter = self.iter_range.iter_start, self.iter_range.iter_stop, self.iter_range.iter_step
-        start_pts = range(start_iter, stop_iter, step_iter)
-
-        pop_evol = numpy.zeros((len(start_pts), nstates), dtype=ci_dtype)
+        
+        windows = []
+        for start in xrange(start_iter, stop_iter, step_iter):
+            if self.evolution_mode == 'cumulative':
+                block_start = start_iter
+            else: # self.evolution_mode == 'blocked'
+                block_start = start
+            windows.append((block_start, min(start+step_iter, stop_iter)))
 
         pi = self.progress.indicator
-        pi.new_operation('Calculating population evolution', len(start_pts)*nstates)
-#         futures = []
-#         for iblock, start in enumerate(start_pts):
-#             if self.evolution_mode == 'cumulative':
-#                 block_start = start_iter
-#             else: # self.evolution_mode == 'blocked'
-#                 block_start = start
-#             stop = min(start+step_iter, stop_iter)
-# 
-#             for istate in xrange(nstates):
-#                 future = self.work_manager.submit(_eval_block,kwargs=dict(iblock=iblock,istate=istate,
-#                                                                           start=block_start,stop=stop,
-#                                                                           state_pops=self.all_state_pops[block_start-start_iter:stop-start_iter,istate],
-#                                                                           mcbs_alpha=self.mcbs_alpha, mcbs_nsets=self.mcbs_nsets,
-#                                                                           mcbs_acalpha = self.mcbs_acalpha))
-#                 futures.append(future)
-        def taskgen():
-            for iblock, start in enumerate(start_pts):
-                if self.evolution_mode == 'cumulative':
-                    block_start = start_iter
-                else: # self.evolution_mode == 'blocked'
-                    block_start = start
-                stop = min(start+step_iter, stop_iter)
-     
-                for istate in xrange(nstates):
-                    yield (_eval_block,(),dict(iblock=iblock,istate=istate,
-                                               start=block_start,stop=stop,
-                                               state_pops=self.all_state_pops[block_start-start_iter:stop-start_iter,istate],
-                                               mcbs_alpha=self.mcbs_alpha, mcbs_nsets=self.mcbs_nsets,
-                                               mcbs_acalpha = self.mcbs_acalpha))
-        #for future in self.work_manager.as_completed(futures):
-        for future in self.work_manager.submit_as_completed(taskgen(), self.max_queue_len):
-            (iblock,istate,ci_res) = future.get_result(discard=True)
-            pop_evol[iblock,istate] =  ci_res
-            pi.progress += 1
+        pi.new_operation('Calculating population evolution')
+        pop_evol = self.calc_cis(windows)
 
         self.output_file.create_dataset('state_pop_evolution', data=pop_evol, shuffle=True, compression=9)
         pi.clear()
@@ -325,10 +290,5 @@ Command-line options
             if self.evolution_mode != 'none' and self.iter_range.iter_step:
                 self.calc_evolution()
 
-def _eval_block(iblock, istate, start, stop, state_pops, mcbs_alpha, mcbs_nsets, mcbs_acalpha):
-    ci_res = mcbs_ci_correl(state_pops,estimator=numpy.mean,alpha=mcbs_alpha,n_sets=mcbs_nsets,
-                            autocorrel_alpha=mcbs_acalpha,subsample=numpy.mean)
-    return (iblock,istate,(start,stop)+ci_res)
-
 if __name__ == '__main__':
     StateProbTool().main()
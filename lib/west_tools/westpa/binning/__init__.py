@@ -4,7 +4,9 @@ from assign import (NopMapper, FuncBinMapper, PiecewiseBinMapper, RectilinearBin
                     RecursiveBinMapper, VectorizingFuncBinMapper, VoronoiBinMapper)
 
 from _assign import accumulate_labeled_populations, assign_and_label, accumulate_state_populations_from_labeled #@UnresolvedImport
-from _assign import assignments_list_to_table #@UnresolvedImport
+from _assign import state_populations_from_labeled #@UnresolvedImport
+from _assign import label_assignments #@UnresolvedImport
+from _assign import assignments_list_to_table, assignments_list_to_groups #@UnresolvedImport
 
-from assign import coord_dtype, index_dtype
+from assign import coord_dtype, index_dtype, get_mapper_hash
 from bins import Bin
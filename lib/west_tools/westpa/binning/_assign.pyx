@@ -213,33 +213,51 @@ cpdef assign_and_label(Py_ssize_t nsegs_lb,
     '''Assign trajectories to bins and last-visted macrostates for each timepoint.'''
     
     cdef:
-        Py_ssize_t ipt, nsegs, npts, iseg
-        index_t[:,:] _assignments, _trajlabels, _statelabels
-        index_t[:] seg_assignments
-        long seg_id, parent_id, msegid
-        index_t ptlabel
+        Py_ssize_t nsegs, npts, iseg
     
     nsegs = nsegs_ub - nsegs_lb
     npts = pcoords.shape[1]
     assignments = numpy.empty((nsegs,npts), index_dtype)
-    trajlabels = numpy.empty((nsegs,npts), index_dtype)
-    statelabels = numpy.empty((nsegs,npts), index_dtype)
-    
-    _assignments = assignments
-    _trajlabels = trajlabels
-    _statelabels = statelabels
     mask = numpy.ones((npts,), numpy.bool_)
     
     for iseg in range(nsegs):
         assign(pcoords[iseg,:], mask, assignments[iseg,:])
     
+    trajlabels, statelabels = label_assignments(parent_ids, nstates, state_map, last_labels, assignments)
+    return assignments, trajlabels, statelabels
+
+@cython.boundscheck(False)
+@cython.wraparound(False)    
+cpdef label_assignments(long[:] parent_ids,
+                        Py_ssize_t nstates,
+                        index_t[:] state_map,
+                        index_t[:] last_labels, # must be for all segments of the previous iteration
+                        index_t[:,:] assignments):
+    '''Label the given bin assignments (for a contiguous set of segments, with parents ``parent_ids``)
+    with the macrostate each trajectory last visited, at each timepoint. Trajectories which begin in a
+    transition region inherit ``last_labels[parent_id]``; this is the only dependence on previous
+    iterations. Returns ``(trajlabels, statelabels)``.'''
+
+    cdef:
+        Py_ssize_t ipt, nsegs, npts, iseg
+        index_t[:,:] _trajlabels, _statelabels
+        long parent_id
+        index_t ptlabel
+
+    nsegs = assignments.shape[0]
+    npts = assignments.shape[1]
+    trajlabels = numpy.empty((nsegs,npts), index_dtype)
+    statelabels = numpy.empty((nsegs,npts), index_dtype)
+    
+    _trajlabels = trajlabels
+    _statelabels = statelabels
+
     if state_map is not None:
         with nogil:
             for iseg in range(nsegs):
-                seg_id = iseg+nsegs_lb
                 parent_id = parent_ids[iseg]
                 for ipt in range(npts):
-                    ptlabel = state_map[_assignments[iseg,ipt]]
+                    ptlabel = state_map[assignments[iseg,ipt]]
                     _statelabels[iseg,ipt] = ptlabel
                     if ptlabel == nstates: # unknown state/transition region 
                         if ipt == 0:
@@ -261,7 +279,7 @@ cpdef assign_and_label(Py_ssize_t nsegs_lb,
         trajlabels.fill(nstates)
         statelabels.fill(nstates)
             
-    return assignments, trajlabels, statelabels
+    return trajlabels, statelabels
 
 @cython.cdivision(True)
 @cython.boundscheck(False)
@@ -327,6 +345,38 @@ cpdef accumulate_state_populations_from_labeled(weight_t[:,:] labeled_bin_pops,
                         raise ValueError('invalid state label {}'.format(istate))
                 state_pops[state_map[ibin]] += labeled_bin_pops[ilabel,ibin]
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef state_populations_from_labeled(weight_t[:,:,:] labeled_bin_pops, index_t[:] state_map):
+    '''Reduce a block of labeled bin populations, of shape ``(n_iter, nstates+1, nbins)``, to state
+    populations of shape ``(n_iter, nstates+1)``, as does `accumulate_state_populations_from_labeled`
+    for each iteration in turn.'''
+
+    cdef:
+        Py_ssize_t n_iter, nstates, nbins, iiter, ibin, ilabel
+        weight_t[:,:] _state_pops
+
+    n_iter = labeled_bin_pops.shape[0]
+    nstates = labeled_bin_pops.shape[1]
+    nbins = labeled_bin_pops.shape[2]
+
+    if state_map.shape[0] < nbins:
+        raise TypeError('shape mismatch')
+    for ibin in xrange(nbins):
+        if state_map[ibin] >= nstates:
+            raise ValueError('invalid state label {}'.format(state_map[ibin]))
+
+    state_pops = numpy.zeros((n_iter,nstates), numpy.float64)
+    _state_pops = state_pops
+
+    with nogil:
+        for iiter in xrange(n_iter):
+            for ilabel in xrange(nstates):
+                for ibin in xrange(nbins):
+                    _state_pops[iiter,state_map[ibin]] += labeled_bin_pops[iiter,ilabel,ibin]
+
+    return state_pops
+
 @cython.wraparound(False)
 cpdef assignments_list_to_table(Py_ssize_t nsegs, Py_ssize_t nbins, index_t[:] assignments):
     '''Convert a list of bin assignments (integers) to a boolean table indicating indicating 
@@ -343,3 +393,39 @@ cpdef assignments_list_to_table(Py_ssize_t nsegs, Py_ssize_t nbins, index_t[:] a
         _output[iseg,assignments[iseg]] = 1
 
     return output.astype(numpy.bool_, copy=False)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef assignments_list_to_groups(Py_ssize_t nbins, index_t[:] assignments):
+    '''Group segments by bin with a (stable) counting sort of their bin ``assignments``. Returns
+    ``(seg_ids, offsets)``, where the IDs of the segments in bin ``ibin`` are
+    ``seg_ids[offsets[ibin]:offsets[ibin+1]]``, in increasing order.'''
+    
+    cdef:
+        Py_ssize_t nsegs = assignments.shape[0]
+        Py_ssize_t iseg, ibin
+        numpy.int64_t[:] _seg_ids, _offsets, _next
+    
+    for iseg in xrange(nsegs):
+        if assignments[iseg] >= nbins:
+            raise ValueError('invalid bin assignment {} for segment {}'.format(assignments[iseg], iseg))
+    
+    seg_ids = numpy.empty((nsegs,), numpy.int64)
+    offsets = numpy.zeros((nbins+1,), numpy.int64)
+    _seg_ids = seg_ids
+    _offsets = offsets
+    
+    with nogil:
+        for iseg in xrange(nsegs):
+            _offsets[assignments[iseg]+1] += 1
+        for ibin in xrange(nbins):
+            _offsets[ibin+1] += _offsets[ibin]
+    
+    _next = offsets[:nbins].copy()
+    with nogil:
+        for iseg in xrange(nsegs):
+            ibin = assignments[iseg]
+            _seg_ids[_next[ibin]] = iseg
+            _next[ibin] += 1
+    
+    return seg_ids, offsets
@@ -55,6 +55,14 @@ scenarios.)
 A user-defined bin mapper must also make an ``nbins`` property available, containing
 the total number of bins within the mapper.
 
+Mappers may additionally support adaptive binning by implementing
+``update_from_samples(coords, weights=None, rate=None)``, which adjusts bin definitions
+in place (without changing the number of bins) to fit a new sample of coordinates.
+:class:`RectilinearBinMapper` moves its boundaries toward sample quantiles, and
+:class:`VoronoiBinMapper` moves its centers by online k-means. After such an update,
+``WEDriver.rebin_next()`` redistributes walkers already prepared for the next iteration
+among the updated bins.
+
 '''
 
 from __future__ import division, print_function; __metaclass__ = type
@@ -103,9 +111,26 @@ class BinMapper:
         hash = self.hashfunc(pkldat)
         return (pkldat, hash.hexdigest())
 
+    def update_from_samples(self, coords, weights=None, rate=None):
+        '''Adapt the bin definitions of this mapper (in place) to the given sample of coordinate
+        tuples ``coords``, optionally weighted by ``weights``. The number of bins does not change.
+        ``rate`` controls how far bin definitions move toward those indicated by the new sample;
+        its meaning (and default) depends on the mapper. Returns True if bin definitions were
+        changed. Mappers which do not support adaptive binning raise NotImplementedError.'''
+        raise NotImplementedError('{} does not support adaptive binning'.format(self.__class__.__name__))
+
     def __repr__(self):
         return '<{} at 0x{:x} with {:d} bins>'.format(self.__class__.__name__, id(self), self.nbins or 0)
 
+def get_mapper_hash(mapper):
+    '''Return the hash identifying ``mapper`` (as calculated by ``pickle_and_hash()``), or
+    None if the mapper cannot be pickled or hashed, in which case no data keyed on the
+    mapper's identity (such as cached assignments) may be used.'''
+    try:
+        return mapper.pickle_and_hash()[1]
+    except (pickle.PickleError, AttributeError, TypeError):
+        return None
+
 class NopMapper(BinMapper):
     '''Put everything into one bin.'''
     def __init__(self):
@@ -187,6 +212,55 @@ class RectilinearBinMapper(BinMapper):
 
         return output
 
+    def update_from_samples(self, coords, weights=None, rate=None):
+        '''Move interior bin boundaries toward the (weighted) quantiles of the sample ``coords``
+        which divide it evenly among the bins along each dimension; outermost boundaries are
+        fixed. Each boundary moves a fraction ``rate`` (default 1.0, i.e. all the way) of the
+        distance to its corresponding quantile. A dimension is left unchanged if the sample does
+        not resolve distinct boundaries within the outermost boundaries.'''
+
+        coords = numpy.asarray(coords, dtype=numpy.float64)
+        if coords.ndim != 2 or coords.shape[1] != self.ndim:
+            raise TypeError('coords must be of shape (nsamples, {:d})'.format(self.ndim))
+        if weights is None:
+            weights = numpy.ones((len(coords),), numpy.float64)
+        else:
+            weights = numpy.asarray(weights, dtype=numpy.float64)
+            if weights.shape != (len(coords),):
+                raise TypeError('weights must be of shape ({:d},)'.format(len(coords)))
+        rate = 1.0 if rate is None else rate
+
+        updated = False
+        new_boundaries = list(self._boundaries)
+        for idim, bounds in enumerate(self._boundaries):
+            if len(bounds) < 3:
+                continue
+            lb, ub = bounds[0], bounds[-1]
+            dimcoords = coords[:,idim]
+            inside = (dimcoords >= lb) & (dimcoords < ub)
+            if not inside.any():
+                continue
+            order = numpy.argsort(dimcoords[inside], kind='mergesort')
+            sorted_coords = dimcoords[inside][order]
+            cumul_weight = numpy.add.accumulate(weights[inside][order])
+            if not cumul_weight[-1] > 0:
+                continue
+            cumul_weight /= cumul_weight[-1]
+
+            nbounds = len(bounds)
+            levels = numpy.arange(1, nbounds-1, dtype=numpy.float64) / (nbounds-1)
+            quantiles = sorted_coords[numpy.minimum(numpy.searchsorted(cumul_weight, levels, side='right'),
+                                                    len(sorted_coords)-1)]
+            interior = bounds[1:-1] + rate*(quantiles - bounds[1:-1])
+            candidate = numpy.concatenate(([lb], interior, [ub])).astype(coord_dtype)
+            if (numpy.diff(candidate) > 0).all() and (candidate != bounds).any():
+                new_boundaries[idim] = candidate
+                updated = True
+
+        if updated:
+            self.boundaries = new_boundaries
+        return updated
+
 class PiecewiseBinMapper(BinMapper):
     '''Binning using a set of functions returing boolean values; if the Nth function
     returns True for a coordinate tuple, then that coordinate is in the Nth bin.'''
@@ -337,6 +411,51 @@ class VoronoiBinMapper(BinMapper):
 
         return output
 
+    def update_from_samples(self, coords, weights=None, rate=None):
+        '''Move centers by one step of online (sequential) k-means: each sample in ``coords`` is
+        assigned to its closest center, and each center moves toward the (weighted) mean of the
+        samples assigned to it. If ``rate`` is None (the default), each center is the running mean
+        of all samples ever assigned to it, so that centers settle as samples accumulate;
+        otherwise, each center moves a fixed fraction ``rate`` of the way toward the mean of the
+        new samples. Centers to which no samples are assigned do not move.'''
+
+        coords = numpy.asarray(coords)
+        if coords.ndim != 2 or coords.shape[1] != self.ndim:
+            raise TypeError('coords must be of shape (nsamples, {:d})'.format(self.ndim))
+        if weights is None:
+            weights = numpy.ones((len(coords),), numpy.float64)
+        else:
+            weights = numpy.asarray(weights, dtype=numpy.float64)
+            if weights.shape != (len(coords),):
+                raise TypeError('weights must be of shape ({:d},)'.format(len(coords)))
+
+        assignments = self.assign(coords)
+        batch_weights = numpy.bincount(assignments, weights=weights, minlength=self.nbins)
+        batch_sums = numpy.empty((self.nbins, self.ndim), numpy.float64)
+        for idim in xrange(self.ndim):
+            batch_sums[:,idim] = numpy.bincount(assignments, weights=weights*coords[:,idim], minlength=self.nbins)
+
+        occupied = batch_weights > 0
+        if not occupied.any():
+            return False
+        if getattr(self, 'center_weights', None) is None:
+            # Cumulative (weighted) number of samples contributing to each center; created only
+            # once the mapper adapts, so that the pickle (and hence the hash) of a mapper that
+            # never adapts is unchanged
+            self.center_weights = numpy.zeros((self.nbins,), numpy.float64)
+        batch_means = batch_sums[occupied] / batch_weights[occupied,numpy.newaxis]
+        centers = numpy.array(self.centers, dtype=numpy.float64)
+        if rate is None:
+            self.center_weights[occupied] += batch_weights[occupied]
+            step = (batch_weights[occupied] / self.center_weights[occupied])[:,numpy.newaxis]
+        else:
+            step = rate
+        centers[occupied] += step * (batch_means - centers[occupied])
+
+        self.centers = centers.astype(self.centers.dtype)
+        self.labels = ['center={!r}'.format(center) for center in self.centers]
+        return True
+
 class RecursiveBinMapper(BinMapper):
     '''Nest mappers one within another.'''
 
@@ -25,6 +25,10 @@ try:
     import psutil
 except ImportError:
     psutil = None
+try:
+    import hdf5plugin # registers additional compression filters (LZ4, Blosc) with HDF5
+except ImportError:
+    hdf5plugin = None
 import posixpath, errno
 from collections import deque
 
@@ -34,6 +38,11 @@ from collections import deque
 #
 default_iter_prec=8
 
+# Registered IDs of optional (dynamically-loaded) HDF5 compression filters
+LZ4_FILTER = 32004
+BLOSC_FILTER = 32001
+compression_codecs = ('gzip', 'fast', 'none')
+
 #
 # Helper functions
 #
@@ -87,6 +96,49 @@ def calc_chunksize(shape, dtype, max_chunksize=262144):
     chunk_shape = tuple(chunk_shape)
     return chunk_shape
 
+def calc_iter_chunksize(shape, dtype, max_chunksize=262144):
+    '''Calculate a chunk size for HDF5 data indexed by [iteration][segment][...], anticipating
+    that access will be one iteration at a time. Each chunk covers a single iteration, all
+    entries along the third and subsequent axes (e.g. timepoints), and as many segments as fit
+    within ``max_chunksize`` bytes.'''
+
+    dtype = numpy.dtype(dtype)
+    chunk_shape = [1] + [max(1,dim) for dim in shape[1:]]
+    if len(chunk_shape) > 1:
+        row_nbytes = int(numpy.prod(chunk_shape[2:], dtype=numpy.int64))*dtype.itemsize
+        chunk_shape[1] = max(1, min(chunk_shape[1], max_chunksize // row_nbytes))
+    return tuple(chunk_shape)
+
+def get_compression_opts(codec):
+    '''Return keyword arguments for ``create_dataset()`` applying the given compression ``codec``,
+    which may be one of:
+
+      ``gzip``
+        byte shuffling and gzip (deflate) compression at level 4. This is compact, and is
+        readable by any HDF5 installation.
+
+      ``fast``
+        byte shuffling and LZ4 or Blosc compression, if the corresponding HDF5 filter plugin
+        is available, and otherwise byte shuffling and gzip compression at level 1. This is
+        much cheaper to read and write, at some expense in file size. Files compressed with
+        LZ4 or Blosc can only be read where the same plugin is available.
+
+      ``none``
+        no compression.
+    '''
+
+    if codec == 'gzip':
+        return {'compression': 4, 'shuffle': True}
+    elif codec == 'fast':
+        for filter_id in (LZ4_FILTER, BLOSC_FILTER):
+            if h5py.h5z.filter_avail(filter_id):
+                return {'compression': filter_id, 'shuffle': True}
+        return {'compression': 1, 'shuffle': True}
+    elif codec == 'none':
+        return {'compression': None, 'shuffle': False}
+    else:
+        raise ValueError('unknown compression codec {!r}'.format(codec))
+
 #
 # Group and datset manipulation functions
 #
@@ -546,3 +598,130 @@ class IterBlockedDataset:
         return source[start - self.iter_start : stop - self.iter_start : step]
 
 
+
+class SparseIterMatrix:
+    '''A sequence of sparse matrices, one per iteration, stored in an HDF5 group in coordinate (COO)
+    form. The group contains four one-dimensional datasets: ``rows``, ``cols``, and ``values``, which
+    hold the nonzero entries of all iterations concatenated together, and ``offsets``, which holds 
+    (number of iterations + 1) indices into the other three, such that the entries for the ``i``th
+    stored iteration are ``offsets[i]:offsets[i+1]``. Matrices sharing a sparsity pattern (e.g. 
+    fluxes and the rates derived from them) may share ``rows``, ``cols``, and ``offsets`` (by hard link)
+    by passing ``index_from`` to ``create()``; values for such a matrix must be appended after those
+    of the matrix owning the index.'''
+    
+    sparse_format = 'coo'
+    index_dtype = numpy.int32
+    offset_dtype = numpy.int64
+    chunksize = 65536
+    
+    @classmethod
+    def create(cls, parent_group, name, shape, iter_start, dtype=numpy.float64, index_from=None, compression=True):
+        group = parent_group.create_group(name)
+        group.attrs['sparse_format'] = cls.sparse_format
+        group.attrs['shape'] = numpy.array(shape, dtype=numpy.int64)
+        stamp_iter_range(group, iter_start, iter_start)
+        
+        dsopts = {'shape': (0,), 'maxshape': (None,), 'chunks': (cls.chunksize,)}
+        if compression:
+            dsopts.update(compression=9, shuffle=True)
+        
+        if index_from is None:
+            group.create_dataset('rows', dtype=cls.index_dtype, **dsopts)
+            group.create_dataset('cols', dtype=cls.index_dtype, **dsopts)
+            group.create_dataset('offsets', data=numpy.zeros((1,), cls.offset_dtype), maxshape=(None,),
+                                 chunks=(4096,))
+        else:
+            for dsname in ('rows', 'cols', 'offsets'):
+                group[dsname] = index_from.group[dsname]
+            group.attrs['index_from'] = index_from.group.name
+        group.create_dataset('values', dtype=dtype, **dsopts)
+        return cls(group)
+    
+    @staticmethod
+    def is_sparse(h5object):
+        '''Return True if ``h5object`` is a group holding a ``SparseIterMatrix``.'''
+        return isinstance(h5object, h5py.Group) and 'sparse_format' in h5object.attrs
+        
+    def __init__(self, group):
+        if group.attrs.get('sparse_format') != self.sparse_format:
+            raise ValueError('{!r} does not contain sparse matrix data'.format(group))
+        self.group = group
+        self.shape = tuple(int(n) for n in group.attrs['shape'])
+        self.iter_start, self.iter_stop = get_iter_range(group)
+        self.shares_index = 'index_from' in group.attrs
+        
+    def __len__(self):
+        return self.iter_stop - self.iter_start
+        
+    def append(self, values, rows=None, cols=None):
+        '''Append the matrix for the next iteration. ``rows`` and ``cols`` are required unless this
+        matrix shares its index with another, in which case they must be omitted.'''
+        values_ds = self.group['values']
+        offsets_ds = self.group['offsets']
+        nvals = len(values)
+        start = values_ds.shape[0]
+        
+        if self.shares_index:
+            if rows is not None or cols is not None:
+                raise ValueError('cannot store indices for a matrix sharing indices with another')
+            if offsets_ds.shape[0] < len(self) + 2 or offsets_ds[len(self)+1] - start != nvals:
+                raise ValueError('number of values does not match shared index')
+        else:
+            if rows is None or cols is None:
+                raise ValueError('row and column indices are required')
+            if not (len(rows) == len(cols) == nvals):
+                raise ValueError('row, column, and value arrays must have the same length')
+            for dsname, data in (('rows', rows), ('cols', cols)):
+                ds = self.group[dsname]
+                ds.resize((start+nvals,))
+                if nvals:
+                    ds[start:] = data
+            offsets_ds.resize((offsets_ds.shape[0]+1,))
+            offsets_ds[-1] = start + nvals
+        
+        values_ds.resize((start+nvals,))
+        if nvals:
+            values_ds[start:] = values
+        self.iter_stop += 1
+        stamp_iter_range(self.group, self.iter_start, self.iter_stop)
+        
+    def append_matrix(self, matrix):
+        '''Append a ``scipy.sparse`` matrix as the next iteration.'''
+        coo = matrix.tocoo()
+        if self.shares_index:
+            self.append(coo.data)
+        else:
+            self.append(coo.data, coo.row, coo.col)
+        
+    def iter_slice_entries(self, start=None, stop=None):
+        '''Return ``(offsets, rows, cols, values)`` for iterations [start,stop), where ``offsets``
+        (relative to the returned arrays) delimits the entries for each iteration.'''
+        start = self.iter_start if start is None else start
+        stop = self.iter_stop if stop is None else min(stop, self.iter_stop)
+        if start < self.iter_start or start > stop:
+            raise IndexError('data for iterations [{},{}) not available in {!r}'.format(start, stop, self.group))
+        
+        offsets = self.group['offsets'][start-self.iter_start:stop-self.iter_start+1]
+        lb, ub = offsets[0], offsets[-1]
+        offsets -= lb
+        if ub > lb:
+            rows = self.group['rows'][lb:ub]
+            cols = self.group['cols'][lb:ub]
+            values = self.group['values'][lb:ub]
+        else:
+            rows = numpy.empty((0,), self.index_dtype)
+            cols = numpy.empty((0,), self.index_dtype)
+            values = numpy.empty((0,), self.group['values'].dtype)
+        return offsets, rows, cols, values
+    
+    def iter_entries(self, n_iter):
+        '''Return ``(rows, cols, values)`` for iteration ``n_iter``.'''
+        _offsets, rows, cols, values = self.iter_slice_entries(n_iter, n_iter+1)
+        return rows, cols, values
+    
+    def iter_dense(self, n_iter):
+        '''Return the matrix for iteration ``n_iter`` as a dense array.'''
+        rows, cols, values = self.iter_entries(n_iter)
+        matrix = numpy.zeros(self.shape, values.dtype)
+        numpy.add.at(matrix, (rows, cols), values)
+        return matrix
@@ -6,13 +6,15 @@ import logging
 log = logging.getLogger(__name__)
 
 
-from rate_averaging import RateAverager
+from rate_averaging import RateAverager, CachedRateAverager
+from steadystate import SteadyStateSolver
 
 import _kinetics
 from _kinetics import (calculate_labeled_fluxes, labeled_flux_to_rate, #@UnresolvedImport
-                       calculate_labeled_fluxes_alllags, #@UnresolvedImport
+                       calculate_labeled_fluxes_alllags, labeled_flux_entries, #@UnresolvedImport
                        nested_to_flat_matrix, nested_to_flat_vector, #@UnresolvedImport
                        flat_to_nested_matrix, flat_to_nested_vector, find_macrostate_transitions, #@UnresolvedImport
+                       MacrostateTransitionTracer, transition_event_dtype, #@UnresolvedImport
                        sequence_macro_flux_to_rate) #@UnresolvedImport
 
 
@@ -20,6 +20,9 @@ import cython
 import numpy
 import warnings
 cimport numpy
+from libc.stdlib cimport calloc, realloc, free
+from libc.string cimport memcpy
+from cython.parallel cimport prange, threadid
 
 ctypedef numpy.uint16_t index_t
 ctypedef numpy.float64_t weight_t
@@ -216,6 +219,95 @@ cpdef weight_t calculate_labeled_fluxes(Py_ssize_t nstates,
         twindow += weight*windowlen
     return twindow
 
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)    
+cpdef labeled_flux_entries(Py_ssize_t nstates, 
+                           weights,
+                           parent_ids,
+                           micro_assignments,
+                           traj_assignments,
+                           bint all_lags=False):
+    '''As ``calculate_labeled_fluxes()`` (or ``calculate_labeled_fluxes_alllags()``, if ``all_lags``
+    is true), but rather than accumulating into a dense flux matrix, return the individual
+    (unnormalized) contributions to the labeled flux matrix in coordinate form, as
+    ``(rows, cols, fluxes, twindow)``. Rows and columns are indices into the flat labeled
+    matrix (as produced by ``nested_to_flat_matrix()``), i.e. ``ibin*nstates+istate``, and
+    may be repeated; duplicate entries are to be summed.'''
+
+    cdef:
+        Py_ssize_t niters = len(weights), nsegs, npts, nentries, ientry
+        weight_t twindow = 0.0
+        long lastiter, firstiter, iiter, windowlen, minlen
+        long seg_id, current_id, parent_id
+        index_t ibin, ilabel, fbin, flabel
+        weight_t weight
+        weight_t[:] lweights
+        index_t[:,:] lmicro
+        index_t[:,:] ltraj
+        numpy.int64_t[:] _rows, _cols
+        weight_t[:] _fluxes
+
+    # Find an upper bound on the number of contributions
+    nentries = 0
+    for lastiter in range(niters):
+        if all_lags:
+            nentries += len(weights[lastiter]) * (lastiter+1)
+        elif lastiter == niters-1:
+            nentries += len(weights[lastiter])
+
+    rows = numpy.empty((nentries,), numpy.int64)
+    cols = numpy.empty((nentries,), numpy.int64)
+    fluxes = numpy.empty((nentries,), weight_dtype)
+    _rows = rows
+    _cols = cols
+    _fluxes = fluxes
+    ientry = 0
+
+    # We need to trace backward in each window, so we go from end to beginning
+    for lastiter in range(niters-1,-1,-1):
+        if not all_lags and lastiter < niters-1: break
+        minlen = 1 if all_lags else niters
+        for windowlen in range(minlen,niters+1):
+            firstiter = lastiter-windowlen+1
+            if firstiter < 0: continue
+
+            # we loop over all trajectories that are alive as of the last iteration
+            # in the averaging window
+            lweights = weights[lastiter]
+            lmicro = micro_assignments[lastiter]
+            ltraj  = traj_assignments[lastiter]
+            nsegs = lmicro.shape[0]
+            npts =  lmicro.shape[1]
+
+            for seg_id in range(nsegs):
+                weight = lweights[seg_id]
+                fbin = lmicro[seg_id,npts-1]
+                flabel = ltraj[seg_id,npts-1]
+
+                # trace upwards in history to firstiter
+                iiter = lastiter
+                current_id = seg_id
+                parent_id = parent_ids[iiter][seg_id]
+                while iiter > firstiter and parent_id >= 0:
+                    iiter -= 1
+                    current_id = parent_id
+                    parent_id = parent_ids[iiter][current_id]
+
+                ibin = micro_assignments[iiter][current_id][0]
+                ilabel = traj_assignments[iiter][current_id][0]
+
+                if ilabel < nstates and flabel < nstates:
+                    _rows[ientry] = ibin*nstates+ilabel
+                    _cols[ientry] = fbin*nstates+flabel
+                    _fluxes[ientry] = weight
+                    ientry += 1
+                elif all_lags:
+                    raise ValueError('invalid state index (ilabel={},flabel={})'.format(ilabel,flabel))
+                twindow += weight*windowlen
+
+    return rows[:ientry], cols[:ientry], fluxes[:ientry], twindow
+
 
 @cython.boundscheck(False)
 @cython.wraparound(False)    
@@ -340,6 +432,82 @@ cpdef _reduce_labeled_rate_matrix_to_macro(Py_ssize_t nstates, Py_ssize_t nbins,
     return macro_rates
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef strongly_connected_components(numpy.int64_t[:] indptr, numpy.int64_t[:] indices):
+    '''Find the strongly-connected components of the directed graph whose adjacency matrix is given
+    in CSR form by ``indptr`` and ``indices`` (explicit zeros should be eliminated beforehand).
+    Returns ``(ncomponents, labels)``. This is a non-recursive form of Tarjan's algorithm, used 
+    in preference to ``scipy.sparse.csgraph.connected_components``, which produces incorrect 
+    strong components in some versions of scipy.'''
+    
+    cdef:
+        Py_ssize_t n = indptr.shape[0] - 1
+        Py_ssize_t root, v, w, e, u, counter = 0, ncomp = 0, sp = 0, csp = 0
+        numpy.int64_t[:] _labels, index, lowlink, stack, call_nodes, call_edges
+        numpy.uint8_t[:] onstack
+        
+    labels = numpy.empty((n,), numpy.int64)
+    _labels = labels
+    index = numpy.empty((n,), numpy.int64)
+    lowlink = numpy.empty((n,), numpy.int64)
+    stack = numpy.empty((n,), numpy.int64)
+    call_nodes = numpy.empty((n,), numpy.int64)
+    call_edges = numpy.empty((n,), numpy.int64)
+    onstack = numpy.zeros((n,), numpy.uint8)
+    
+    with nogil:
+        for v in xrange(n):
+            index[v] = -1
+            
+        for root in xrange(n):
+            if index[root] != -1: continue
+            
+            index[root] = lowlink[root] = counter
+            counter += 1
+            stack[sp] = root
+            sp += 1
+            onstack[root] = 1
+            call_nodes[csp] = root
+            call_edges[csp] = indptr[root]
+            csp += 1
+            
+            while csp > 0:
+                v = call_nodes[csp-1]
+                e = call_edges[csp-1]
+                if e < indptr[v+1]:
+                    # visit the next successor of v
+                    call_edges[csp-1] = e+1
+                    w = indices[e]
+                    if index[w] == -1:
+                        index[w] = lowlink[w] = counter
+                        counter += 1
+                        stack[sp] = w
+                        sp += 1
+                        onstack[w] = 1
+                        call_nodes[csp] = w
+                        call_edges[csp] = indptr[w]
+                        csp += 1
+                    elif onstack[w] and index[w] < lowlink[v]:
+                        lowlink[v] = index[w]
+                else:
+                    # all successors of v visited
+                    csp -= 1
+                    if lowlink[v] == index[v]:
+                        while True:
+                            sp -= 1
+                            w = stack[sp]
+                            onstack[w] = 0
+                            _labels[w] = ncomp
+                            if w == v: break
+                        ncomp += 1
+                    if csp > 0:
+                        u = call_nodes[csp-1]
+                        if lowlink[v] < lowlink[u]:
+                            lowlink[u] = lowlink[v]
+                            
+    return ncomp, labels
+    
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
@@ -590,6 +758,263 @@ cpdef find_macrostate_transitions(Py_ssize_t nstates,
         _last_time[seg_id] = tm
 
 
+ctypedef struct transition_event_t:
+    numpy.uint32_t n_iter
+    index_t istate
+    index_t fstate
+    weight_t duration
+    weight_t weight
+    seg_id_t seg_id
+
+ctypedef struct event_buffer_t:
+    transition_event_t* events
+    Py_ssize_t size
+    Py_ssize_t capacity
+
+# Must match transition_event_t, field for field
+transition_event_dtype = numpy.dtype([('n_iter', numpy.uint32), ('istate', index_dtype), ('fstate', index_dtype),
+                                      ('duration', weight_dtype), ('weight', weight_dtype), ('seg_id', numpy.int64)])
+assert transition_event_dtype.itemsize == sizeof(transition_event_t)
+
+cdef int _reserve_events(event_buffer_t* buf, Py_ssize_t capacity) nogil:
+    cdef transition_event_t* events
+    if capacity <= buf.capacity:
+        return 0
+    if capacity < 2*buf.capacity:
+        capacity = 2*buf.capacity
+    if capacity < 64:
+        capacity = 64
+    events = <transition_event_t*> realloc(buf.events, capacity*sizeof(transition_event_t))
+    if events == NULL:
+        return -1
+    buf.events = events
+    buf.capacity = capacity
+    return 0
+
+cdef int _append_event(event_buffer_t* buf, numpy.uint32_t n_iter, index_t istate, index_t fstate,
+                       weight_t duration, weight_t weight, seg_id_t seg_id) nogil:
+    cdef transition_event_t* event
+    if buf.size == buf.capacity and _reserve_events(buf, buf.size+1) < 0:
+        return -1
+    event = &buf.events[buf.size]
+    event.n_iter = n_iter
+    event.istate = istate
+    event.fstate = fstate
+    event.duration = duration
+    event.weight = weight
+    event.seg_id = seg_id
+    buf.size += 1
+    return 0
+
+cdef class MacrostateTransitionTracer:
+    '''Trace macrostate transitions and event durations iteration by iteration, as
+    ``find_macrostate_transitions`` does, with all per-segment tracing state held in typed
+    arrays (reused from iteration to iteration) and event durations recorded in buffers
+    grown as needed. Segments are traced in parallel on ``nthreads`` threads (if compiled
+    with OpenMP), with fluxes and events accumulated per thread and combined at the end of
+    each iteration, in the same order as serial tracing would produce them.'''
+    
+    cdef readonly Py_ssize_t nstates, nthreads
+    cdef bint _has_state
+    cdef object _state, _spare_state
+    cdef weight_t[:,:,::1] _fluxes
+    cdef uint_t[:,:,::1] _counts
+    cdef weight_t[:,::1] _target_fluxes
+    cdef uint_t[:,::1] _target_counts
+    cdef event_buffer_t* _thread_events
+    cdef event_buffer_t _events
+    
+    def __cinit__(self, Py_ssize_t nstates, Py_ssize_t nthreads=1):
+        self._thread_events = <event_buffer_t*> calloc(max(nthreads,1), sizeof(event_buffer_t))
+        if self._thread_events == NULL:
+            raise MemoryError()
+        self._events.events = NULL
+        self._events.size = self._events.capacity = 0
+        
+    def __init__(self, Py_ssize_t nstates, Py_ssize_t nthreads=1):
+        if nthreads < 1:
+            raise ValueError('at least one thread is required')
+        self.nstates = nstates
+        self.nthreads = nthreads
+        self._has_state = False
+        self._state = self._spare_state = None
+        
+        # Use nstates + 1 to account for possible unknown states
+        self._fluxes = numpy.zeros((nthreads,nstates+1,nstates+1), weight_dtype)
+        self._counts = numpy.zeros((nthreads,nstates+1,nstates+1), numpy.uint)
+        self._target_fluxes = numpy.zeros((nthreads,nstates+1), weight_dtype)
+        self._target_counts = numpy.zeros((nthreads,nstates+1), numpy.uint)
+        
+    def __dealloc__(self):
+        cdef Py_ssize_t ithread
+        if self._thread_events != NULL:
+            for ithread in xrange(self.nthreads):
+                free(self._thread_events[ithread].events)
+            free(self._thread_events)
+        free(self._events.events)
+        
+    def _new_state(self, Py_ssize_t nsegs):
+        nstates = self.nstates
+        return (numpy.zeros((nsegs,), numpy.double),
+                numpy.zeros((nsegs,nstates+1), numpy.double),
+                numpy.zeros((nsegs,nstates+1), numpy.double),
+                numpy.zeros((nsegs,nstates+1), numpy.double),
+                numpy.zeros((nsegs,nstates+1,nstates+1), numpy.double))
+        
+    @property
+    def n_events(self):
+        '''Number of events recorded but not yet retrieved by ``pop_events()``.'''
+        return self._events.size
+    
+    def pop_events(self):
+        '''Return all events recorded since the last call, as an array of ``transition_event_dtype``
+        (iteration, initial and final state, duration, weight, and segment ID), in order of iteration.'''
+        events = numpy.empty((self._events.size,), dtype=transition_event_dtype)
+        if self._events.size:
+            memcpy(numpy.PyArray_DATA(events), self._events.events, self._events.size*sizeof(transition_event_t))
+        self._events.size = 0
+        return events
+    
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def trace(self, numpy.uint32_t n_iter,
+              weight_t[:] weights,
+              seg_id_t[:] parent_ids,
+              index_t[:,:] label_assignments,
+              index_t[:,:] state_assignments,
+              double dt,
+              macro_fluxes, macro_counts, target_fluxes, target_counts):
+        '''Trace iteration ``n_iter``, which must follow the previously-traced iteration (if any),
+        adding to ``macro_fluxes``, ``macro_counts``, ``target_fluxes``, and ``target_counts`` as 
+        ``find_macrostate_transitions`` does, and recording event durations. Returns the number of
+        events recorded for this iteration.'''
+        cdef:
+            Py_ssize_t nsegs, npts, nstates, ns1, seg_id, parent_id, ipt, i, j, tid, nthreads, ithread
+            Py_ssize_t nevents = 0, nfailed = 0
+            bint has_state
+            double itime, tm
+            index_t flabel, ilabel, slabel, iistate
+            weight_t weight
+            double[:] last_time, prev_last_time
+            double[:,:] last_entries, last_exits, last_exits_td, prev_last_entries, prev_last_exits, prev_last_exits_td
+            double[:,:,:] last_completions, prev_last_completions
+            weight_t[:,:,::1] fluxes = self._fluxes
+            uint_t[:,:,::1] counts = self._counts
+            weight_t[:,::1] tfluxes = self._target_fluxes
+            uint_t[:,::1] tcounts = self._target_counts
+            event_buffer_t* thread_events = self._thread_events
+            event_buffer_t* buf
+            
+        nsegs = label_assignments.shape[0]
+        npts = label_assignments.shape[1]
+        nstates = self.nstates
+        ns1 = nstates + 1
+        nthreads = self.nthreads
+        has_state = self._has_state
+        
+        # Tracing state is double-buffered; the previous iteration's state is indexed by parent ID
+        prev_state = self._state
+        state = self._spare_state
+        if state is None or len(state[0]) < nsegs:
+            state = self._new_state(nsegs)
+        if has_state:
+            if nsegs and numpy.max(parent_ids) >= len(prev_state[0]):
+                raise ValueError('parent IDs out of range of the previous iteration')
+        else:
+            prev_state = state
+        last_time, last_entries, last_exits, last_exits_td, last_completions = state
+        prev_last_time, prev_last_entries, prev_last_exits, prev_last_exits_td, prev_last_completions = prev_state
+        
+        fluxes[:,:,:] = 0
+        counts[:,:,:] = 0
+        tfluxes[:,:] = 0
+        tcounts[:,:] = 0
+        
+        with nogil:
+            for seg_id in prange(nsegs, num_threads=nthreads, schedule='static'):
+                tid = threadid()
+                parent_id = parent_ids[seg_id]
+                if has_state and parent_id >= 0:
+                    last_time[seg_id] = prev_last_time[parent_id]
+                    for i in range(ns1):
+                        last_entries[seg_id,i] = prev_last_entries[parent_id,i]
+                        last_exits[seg_id,i] = prev_last_exits[parent_id,i]
+                        last_exits_td[seg_id,i] = prev_last_exits_td[parent_id,i]
+                        for j in range(ns1):
+                            last_completions[seg_id,i,j] = prev_last_completions[parent_id,i,j]
+                else:
+                    last_time[seg_id] = 0.0
+                    for i in range(ns1):
+                        last_entries[seg_id,i] = 0.0
+                        last_exits[seg_id,i] = 0.0
+                        last_exits_td[seg_id,i] = 0.0
+                        for j in range(ns1):
+                            last_completions[seg_id,i,j] = 0.0
+                
+                itime = last_time[seg_id]
+                weight = weights[seg_id]
+                tm = itime
+                
+                # transitions never occur between the (overlapping) end point of previous iteration and beginning of
+                # current iteration, so it suffices to start looking at timepoint 1 (and backwards to timepoint 0)
+                for ipt in range(1,npts):
+                    tm = itime + ipt*dt
+                    flabel = label_assignments[seg_id,ipt]
+                    ilabel = label_assignments[seg_id,ipt-1]
+                    slabel = state_assignments[seg_id,ipt]
+                    
+                    # if we have left our state transition barrier...
+                    if flabel == slabel:
+                        last_exits_td[seg_id,flabel] = tm
+                        
+                    if flabel != ilabel:
+                        tfluxes[tid,flabel] += weight
+                        tcounts[tid,flabel] += 1
+                        last_exits[seg_id,ilabel] = tm
+                        last_entries[seg_id,flabel] = tm
+                        
+                        for iistate in range(nstates):
+                            # see find_macrostate_transitions
+                            if (last_exits[seg_id,iistate] > 0 
+                                and last_entries[seg_id,iistate] >= last_completions[seg_id,iistate,flabel]):
+                                fluxes[tid,iistate,flabel] += weight
+                                counts[tid,iistate,flabel] += 1
+                                last_completions[seg_id,iistate,flabel] = tm
+                                
+                                if iistate != flabel:
+                                    nfailed += (_append_event(&thread_events[tid], n_iter, iistate, flabel,
+                                                              tm - last_exits_td[seg_id,iistate], weight, seg_id) < 0)
+                last_time[seg_id] = tm
+                
+            # Combine events from all threads; with static scheduling, each thread traces a
+            # contiguous run of segments, so this preserves the serial order of events
+            for ithread in range(nthreads):
+                nevents += thread_events[ithread].size
+            if _reserve_events(&self._events, self._events.size + nevents) < 0:
+                nfailed += 1
+            else:
+                for ithread in range(nthreads):
+                    buf = &thread_events[ithread]
+                    if buf.size:
+                        memcpy(&self._events.events[self._events.size], buf.events, buf.size*sizeof(transition_event_t))
+                        self._events.size += buf.size
+                    buf.size = 0
+        
+        if nfailed:
+            for ithread in xrange(nthreads):
+                thread_events[ithread].size = 0
+            raise MemoryError('could not allocate storage for transition events')
+        
+        self._has_state = True
+        self._state, self._spare_state = state, (prev_state if prev_state is not state else None)
+        
+        macro_fluxes += numpy.sum(self._fluxes, axis=0)[:nstates,:nstates]
+        macro_counts += numpy.sum(self._counts, axis=0)[:nstates,:nstates]
+        target_fluxes += numpy.sum(self._target_fluxes, axis=0)[:nstates]
+        target_counts += numpy.sum(self._target_counts, axis=0)[:nstates]
+        return nevents
+
+
 cdef class StreamingStats2D:
     '''Calculate mean and variance of a series of two-dimensional arrays of shape (nbins, nbins)
     using an online algorithm. The statistics are accumulated along what would be axis=0 if the 
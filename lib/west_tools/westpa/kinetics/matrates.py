@@ -31,57 +31,52 @@ easily during development) -- mcz
 
 
 import logging, warnings
+from collections import deque
 log = logging.getLogger(__name__)
 
 from _kinetics import (calculate_labeled_fluxes, #@UnresolvedImport
-                       calculate_labeled_fluxes_alllags, #@UnresolvedImport
+                       calculate_labeled_fluxes_alllags, labeled_flux_entries, #@UnresolvedImport
                        labeled_flux_to_rate, #@UnresolvedImport
                        nested_to_flat_matrix, nested_to_flat_vector, #@UnresolvedImport
                        flat_to_nested_vector, _reduce_labeled_rate_matrix_to_macro) #@UnresolvedImport
 
 import numpy
-import scipy.linalg
+import scipy.linalg, scipy.sparse
 
 from west.data_manager import weight_dtype
+from steadystate import SteadyStateSolver
 
 class ConsistencyWarning(UserWarning):
     pass
 
-def get_steady_state(rates):
-    '''Get steady state solution for a rate matrix. As an optimization, returns the
-    flattened labeled population vector (of length nstates*nbins); to convert to the
-    nested vector used for storage, use nested_to_flat_vector().'''
-
-    rates = rates.copy()
-
-    # Convert to a transition probability matrix
-    for i in xrange(rates.shape[0]):
-        rowsum = rates[i,:].sum()
-        if rowsum > 0:
-            rates[i,:] = rates[i,:] / rowsum
-        else:
-            if rates[:,i].sum() != 0:
-                warnings.warn('sink microstate in rate matrix', ConsistencyWarning)
-            rates[i,:] = 0
-
-    try:
-        vals, vecs = scipy.linalg.eig(rates.T)
-    except Exception:
-        log.debug('exception obtaining eigenvectors', exc_info=True)
-        return None
-
-    vals = numpy.abs(vals)
-    log.debug('eigenvalues: {!r}'.format(list(reversed(sorted(vals)))))
-    asort = numpy.argsort(vals)
-    vec = vecs[:,asort[-1]]
-    ss = numpy.abs(vec)
-
-    ss /= ss.sum()
+def get_steady_state(rates, solver=None):
+    '''Get steady state solution for a rate matrix (dense or ``scipy.sparse``). As an optimization, returns
+    the flattened labeled population vector (of length nstates*nbins); to convert to the nested vector
+    used for storage, use nested_to_flat_vector(). If a ``SteadyStateSolver`` is given as ``solver``, it
+    is used (and its state updated), so that repeated calculations on similar matrices can start from
+    the previous solution. The steady state is found on the largest strongly-connected component of the
+    matrix; a ``ConsistencyWarning`` lists any microstates with transitions left out of it. Returns None
+    if no steady state can be found.'''
+
+    rates = scipy.sparse.csr_matrix(rates)
+    rowsums = numpy.asarray(rates.sum(axis=1)).ravel()
+    colsums = numpy.asarray(rates.sum(axis=0)).ravel()
+    if ((rowsums == 0) & (colsums != 0)).any():
+        warnings.warn('sink microstate in rate matrix', ConsistencyWarning)
+
+    if solver is None:
+        solver = SteadyStateSolver()
+    ss = solver.solve(rates)
+    if ss is not None and len(solver.excluded_states):
+        warnings.warn('steady state restricted to the largest strongly-connected component; '
+                      'no probability assigned to {:d} microstate(s) with transitions: {!r}'
+                      .format(len(solver.excluded_states), list(solver.excluded_states)), ConsistencyWarning)
     return ss
 
-def get_macrostate_rates(labeled_rates, labeled_pops, extrapolate=True):
+def get_macrostate_rates(labeled_rates, labeled_pops, extrapolate=True, solver=None):
     '''Using a labeled rate matrix and labeled bin populations, calculate the steady state
-    probability distribution and consequent state-to-state rates.
+    probability distribution and consequent state-to-state rates. ``solver`` is as for
+    ``get_steady_state()``.
 
     Returns ``(ss, macro_rates)``, where ``ss`` is the steady-state probability distribution
     and ``macro_rates`` is the state-to-state rate matrix.'''
@@ -92,7 +87,7 @@ def get_macrostate_rates(labeled_rates, labeled_pops, extrapolate=True):
 
     # Find steady-state solution
     if extrapolate:
-        ss = get_steady_state(rates)
+        ss = get_steady_state(rates, solver)
         if ss is None:
             warnings.warn('no well-defined steady state; using average populations',ConsistencyWarning)
             ss = nested_to_flat_vector(labeled_pops)
@@ -103,6 +98,32 @@ def get_macrostate_rates(labeled_rates, labeled_pops, extrapolate=True):
 
     return flat_to_nested_vector(nstates, nbins, ss), macro_rates
 
+def get_sparse_macrostate_rates(rates, labeled_pops, extrapolate=True, solver=None):
+    '''As ``get_macrostate_rates()``, but taking the labeled rate matrix as a flat ``scipy.sparse``
+    matrix (as produced by ``estimate_sparse_rates()``), and without forming any dense
+    (nstates*nbins)**2 array.'''
+
+    nstates, nbins = labeled_pops.shape
+    rates = scipy.sparse.coo_matrix(rates)
+
+    # Find steady-state solution
+    if extrapolate:
+        ss = get_steady_state(rates, solver)
+        if ss is None:
+            warnings.warn('no well-defined steady state; using average populations',ConsistencyWarning)
+            ss = nested_to_flat_vector(labeled_pops)
+    else:
+        ss = nested_to_flat_vector(labeled_pops)
+
+    # Flux out of each trajectory ensemble into each other, normalized by ensemble population
+    macro_fluxes = numpy.bincount((rates.row % nstates)*nstates + rates.col % nstates, weights=ss[rates.row]*rates.data,
+                                  minlength=nstates*nstates).reshape((nstates,nstates))
+    traj_ens_pops = ss.reshape((nbins,nstates)).sum(axis=0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        macro_rates = macro_fluxes / traj_ens_pops[:,numpy.newaxis]
+
+    return flat_to_nested_vector(nstates, nbins, ss), macro_rates
+
 def estimate_rates(nbins, state_labels, weights, parent_ids, bin_assignments, label_assignments, state_map, labeled_pops,
                    all_lags=False,
                    labeled_fluxes = None, labeled_rates = None, unlabeled_rates = None):
@@ -154,3 +175,149 @@ def estimate_rates(nbins, state_labels, weights, parent_ids, bin_assignments, la
 
     return labeled_fluxes, labeled_rates, unlabeled_rates
 
+def _sparse_flux_to_rate(fluxes, pops):
+    '''Convert a sparse (CSR) flux matrix to a rate matrix with the same sparsity pattern, by
+    dividing each row by the corresponding entry of ``pops``.'''
+    rates = fluxes.copy()
+    row_pops = numpy.repeat(pops, numpy.diff(rates.indptr))
+    unpopulated = (row_pops == 0.0)
+    if (rates.data[unpopulated] > 0.0).any():
+        warnings.warn('flux matrix entry nonzero but population zero')
+    row_pops[unpopulated] = 1.0
+    rates.data /= row_pops
+    rates.data[unpopulated] = 0.0
+    return rates
+
+def estimate_sparse_rates(nbins, state_labels, weights, parent_ids, bin_assignments, label_assignments, state_map, 
+                          labeled_pops, all_lags=False):
+    '''As ``estimate_rates()``, but accumulating fluxes and rates in sparse matrices rather than dense
+    arrays of (nstates*nbins)**2 elements, nearly all of which are generally zero.
+    
+    Returns ``(labeled_fluxes, labeled_rates, unlabeled_rates)`` as ``scipy.sparse.csr_matrix``
+    objects, with canonical (sorted, duplicate-free) indices. The labeled matrices are in the flat
+    form produced by ``nested_to_flat_matrix()``, and share a sparsity pattern.'''
+
+    assert len(weights) == len(parent_ids) == len(bin_assignments) == len(label_assignments)
+    nstates = len(state_labels)
+    nbins = labeled_pops.shape[1]-1
+
+    rows, cols, fluxes, twindow = labeled_flux_entries(nstates, weights, parent_ids, bin_assignments, label_assignments,
+                                                       all_lags)
+    return _sparse_rates_from_entries(nstates, nbins, rows, cols, fluxes, twindow, labeled_pops)
+
+def _sparse_rates_from_entries(nstates, nbins, rows, cols, fluxes, twindow, labeled_pops):
+    nfbins = nstates*nbins
+    if len(fluxes):
+        fluxes = fluxes / twindow
+
+    # Conversion to CSR sums duplicate entries
+    labeled_fluxes = scipy.sparse.coo_matrix((fluxes, (rows, cols)), shape=(nfbins, nfbins)).tocsr()
+    labeled_fluxes.sum_duplicates()
+    labeled_fluxes.sort_indices()
+
+    # Calculate rate matrix for this window, using populations from the last iteration (which correspond
+    # to the weights that contribute to the flux matrix)
+    labeled_rates = _sparse_flux_to_rate(labeled_fluxes, labeled_pops[:nstates,:nbins].T.ravel())
+
+    # Calculate an unlabeled rate matrix
+    unlabeled_fluxes = scipy.sparse.coo_matrix((fluxes, (rows // nstates, cols // nstates)), shape=(nbins, nbins)).tocsr()
+    unlabeled_fluxes.sum_duplicates()
+    unlabeled_fluxes.sort_indices()
+    unlabeled_rates = _sparse_flux_to_rate(unlabeled_fluxes, labeled_pops.sum(axis=0)[:nbins])
+
+    return labeled_fluxes, labeled_rates, unlabeled_rates
+
+class WindowedRateEstimator:
+    '''Estimate sparse labeled and unlabeled rate matrices, as ``estimate_sparse_rates()`` does, over a
+    window of (at most) ``window_size`` iterations sliding forward one iteration at a time. Rather than
+    retaining full per-iteration data for the window and tracing every trajectory back through the whole
+    window for each new iteration, this keeps a lineage map giving, for each segment of the most recent
+    iteration, the (bin, label) at which its ancestor in each iteration of the window started. Each new
+    iteration extends that map by one parent lookup per window iteration. With ``all_lags``, flux
+    contributions are further accumulated per starting iteration of the window, so that a new iteration
+    only adds its own contributions and the oldest iteration's are dropped.'''
+    
+    def __init__(self, nstates, nbins, window_size, all_lags=False):
+        if window_size < 1:
+            raise ValueError('window size must be at least one iteration')
+        self.nstates = nstates
+        self.nbins = nbins
+        self.window_size = window_size
+        self.all_lags = all_lags
+        
+        # Start points (bin and label at the first timepoint) of ancestors of the current segments;
+        # entry k is for ancestors k iterations ago (or the earliest ancestor, if the lineage is younger)
+        self.start_bins = deque(maxlen=window_size)
+        self.start_labels = deque(maxlen=window_size)
+        
+        # Flux contributions (rows, cols, fluxes, twindow) for the current window;
+        # with all_lags, one per starting iteration, oldest first
+        self.contributions = deque(maxlen=window_size)
+        
+    def add_iteration(self, weights, parent_ids, bin_assignments, label_assignments):
+        '''Slide the window forward to include a new iteration.'''
+        nstates = self.nstates
+        weights = numpy.asarray(weights)
+        parent_ids = numpy.asarray(parent_ids)
+        bin_assignments = numpy.asarray(bin_assignments)
+        label_assignments = numpy.asarray(label_assignments)
+        
+        # Extend the lineage map by one generation
+        init_bins = bin_assignments[:,0]
+        init_labels = label_assignments[:,0]
+        has_parent = (parent_ids >= 0)
+        parents = parent_ids[has_parent]
+        for ancestors, init in ((self.start_bins, init_bins), (self.start_labels, init_labels)):
+            for k in xrange(len(ancestors)):
+                new_ancestors = init.copy()
+                new_ancestors[has_parent] = ancestors[k][parents]
+                ancestors[k] = new_ancestors
+            ancestors.appendleft(init)
+        
+        final_bins = bin_assignments[:,-1]
+        final_labels = label_assignments[:,-1]
+        cols = final_bins.astype(numpy.int64)*nstates + final_labels
+        total_weight = weights.sum()
+        windowlen = len(self.start_bins)
+        
+        if self.all_lags:
+            if (final_labels >= nstates).any() or (init_labels >= nstates).any():
+                raise ValueError('invalid state index')
+            
+            # Contributions of trajectory segments starting in each iteration of the window
+            # and ending in this one; those starting in the oldest are dropped from the window
+            # along with it
+            self.contributions.append(None)
+            for k in xrange(windowlen):
+                rows = self.start_bins[k].astype(numpy.int64)*nstates + self.start_labels[k]
+                ifirst = windowlen-k-1
+                previous = self.contributions[ifirst]
+                if previous is not None:
+                    prev_rows, prev_cols, prev_fluxes, prev_twindow = previous
+                    rows = numpy.concatenate((prev_rows, rows))
+                    cols_k = numpy.concatenate((prev_cols, cols))
+                    fluxes_k = numpy.concatenate((prev_fluxes, weights))
+                else:
+                    cols_k, fluxes_k, prev_twindow = cols, weights, 0.0
+                # Sum duplicates, so that storage scales with the number of distinct transitions
+                summed = scipy.sparse.coo_matrix((fluxes_k, (rows, cols_k)),
+                                                 shape=(self.nbins*nstates,)*2).tocsr().tocoo()
+                self.contributions[ifirst] = (summed.row.astype(numpy.int64), summed.col.astype(numpy.int64),
+                                              summed.data, prev_twindow + total_weight*(k+1))
+        else:
+            start_bins = self.start_bins[windowlen-1]
+            start_labels = self.start_labels[windowlen-1]
+            valid = (start_labels < nstates) & (final_labels < nstates)
+            rows = start_bins.astype(numpy.int64)*nstates + start_labels
+            self.contributions.clear()
+            self.contributions.append((rows[valid], cols[valid], weights[valid], total_weight*windowlen))
+            
+    def estimate_rates(self, labeled_pops):
+        '''Return ``(labeled_fluxes, labeled_rates, unlabeled_rates)`` for the current window, as would
+        ``estimate_sparse_rates()`` given data for all iterations in the window. ``labeled_pops`` are
+        the labeled bin populations for the most recent iteration.'''
+        rows = numpy.concatenate([contribution[0] for contribution in self.contributions])
+        cols = numpy.concatenate([contribution[1] for contribution in self.contributions])
+        fluxes = numpy.concatenate([contribution[2] for contribution in self.contributions])
+        twindow = sum(contribution[3] for contribution in self.contributions)
+        return _sparse_rates_from_entries(self.nstates, self.nbins, rows, cols, fluxes, twindow, labeled_pops)
@@ -18,6 +18,7 @@
 from __future__ import division,print_function; __metaclass__ = type
 import numpy
 import westpa
+from westpa.binning import get_mapper_hash
 
 from itertools import izip, izip_longest
 from collections import namedtuple
@@ -54,16 +55,81 @@ def tuple2stats(stat_tuple):
     return stats
 
 
-def process_iter_chunk(bin_mapper, iter_indices, iter_data=None):
-    '''Calculate the flux matrices and populations of a set of iterations specified
-    by iter_indices. Optionally provide the necessary arrays to perform the calculation
-    in iter_data. Otherwise get data from the data_manager directly.
-    '''
+def _iter_flux_populations(bin_mapper, n_iter, flux_matrix, population_vector, iter_data=None, bin_hash=None):
+    '''Fill ``flux_matrix`` and ``population_vector`` with the bin-to-bin fluxes and bin populations of
+    iteration ``n_iter``, reading from ``iter_data`` if given or from the data manager otherwise.'''
 
     data_manager = westpa.rc.get_data_manager()
     system = westpa.rc.get_system_driver()
 
-    itercount = len(iter_indices)
+    pcoord_len = system.pcoord_len
+    assign = bin_mapper.assign
+
+    flux_matrix.fill(0.0)
+    population_vector.fill(0.0)
+
+    if iter_data:
+        iter_group_name = 'iter_{:0{prec}d}'.format(long(n_iter), prec=data_manager.iter_prec)
+        iter_group = iter_data[iter_group_name]
+    else:
+        iter_group = data_manager.get_iter_group(n_iter)
+
+    # first, account for the flux due to recycling
+    # we access the hdf5 file directly to avoid nearly 50% overhead of creating a ton of
+    # tiny newweightentry objects
+    try:
+        nwgroup = iter_group['new_weights']
+    except KeyError:
+        # no new weight data
+        pass
+    else:
+        if iter_data:
+            index = None
+            weights = nwgroup['weight']
+            prev_init_pcoords = nwgroup['prev_init_pcoord']
+            new_init_pcoords = nwgroup['new_init_pcoord']
+        else:
+            index = nwgroup['index'][...]
+            weights = index['weight']
+            prev_init_pcoords = nwgroup['prev_init_pcoord'][...]
+            new_init_pcoords = nwgroup['new_init_pcoord'][...]
+
+        prev_init_assignments = assign(prev_init_pcoords)
+        new_init_assignments = assign(new_init_pcoords)
+
+        flux_assign(weights, prev_init_assignments, new_init_assignments, flux_matrix)
+        #for (weight,i,j) in izip (weights, prev_init_assignments, new_init_assignments):
+        #    flux_matrices[iiter,i,j] += weight
+        del index
+        del prev_init_pcoords, new_init_pcoords, prev_init_assignments, new_init_assignments, weights
+
+    if iter_data:
+        weights = iter_group['weight']
+        try:
+            initial_assignments = iter_group['initial_assignments']
+            final_assignments = iter_group['final_assignments']
+        except KeyError:
+            initial_assignments = assign(iter_group['initial_pcoords'])
+            final_assignments = assign(iter_group['final_pcoords'])
+    else:
+        weights = iter_group['seg_index']['weight']
+        try:
+            initial_assignments, final_assignments = data_manager.get_iter_assignments(n_iter, bin_hash)
+        except KeyError:
+            initial_assignments = assign(iter_group['pcoord'][:,0])
+            final_assignments = assign(iter_group['pcoord'][:,pcoord_len-1])
+
+    flux_assign(weights, initial_assignments, final_assignments, flux_matrix)
+    pop_assign(weights, initial_assignments, population_vector)
+
+
+def process_iter_chunk(bin_mapper, iter_indices, iter_data=None, bin_hash=None):
+    '''Calculate the flux matrices and populations of a set of iterations specified
+    by iter_indices. Optionally provide the necessary arrays to perform the calculation
+    in iter_data. Otherwise get data from the data_manager directly, using assignments
+    cached in the WEST HDF5 file for the mapper with hash ``bin_hash`` where available.
+    '''
+
     nbins = bin_mapper.nbins
 
     flux_stats = StreamingStats2D((nbins, nbins))
@@ -78,63 +144,8 @@ def process_iter_chunk(bin_mapper, iter_indices, iter_data=None):
     rate_matrix = numpy.zeros((nbins, nbins), numpy.float64)
     population_vector = numpy.zeros((nbins,), numpy.float64)
 
-    pcoord_len = system.pcoord_len
-    assign = bin_mapper.assign
-
-    for iiter, n_iter in enumerate(iter_indices):
-        flux_matrix.fill(0.0)
-        population_vector.fill(0.0)
-
-        if iter_data:
-            iter_group_name = 'iter_{:0{prec}d}'.format(long(n_iter), prec=data_manager.iter_prec)
-            iter_group = iter_data[iter_group_name]
-        else:
-            iter_group = data_manager.get_iter_group(n_iter)
-
-        # first, account for the flux due to recycling
-        # we access the hdf5 file directly to avoid nearly 50% overhead of creating a ton of
-        # tiny newweightentry objects
-        try:
-            nwgroup = iter_group['new_weights']
-        except KeyError:
-            # no new weight data
-            pass
-        else:
-            if iter_data:
-                index = None
-                weights = nwgroup['weight']
-                prev_init_pcoords = nwgroup['prev_init_pcoord']
-                new_init_pcoords = nwgroup['new_init_pcoord']
-            else:
-                index = nwgroup['index'][...]
-                weights = index['weight']
-                prev_init_pcoords = nwgroup['prev_init_pcoord'][...]
-                new_init_pcoords = nwgroup['new_init_pcoord'][...]
-
-            prev_init_assignments = assign(prev_init_pcoords)
-            new_init_assignments = assign(new_init_pcoords)
-
-            flux_assign(weights, prev_init_assignments, new_init_assignments, flux_matrix)
-            #for (weight,i,j) in izip (weights, prev_init_assignments, new_init_assignments):
-            #    flux_matrices[iiter,i,j] += weight
-            del index
-            del prev_init_pcoords, new_init_pcoords, prev_init_assignments, new_init_assignments, weights
-
-        #iter_group = data_manager.get_iter_group(n_iter)
-        if iter_data:
-            weights = iter_group['weight']
-            initial_pcoords = iter_group['initial_pcoords']
-            final_pcoords = iter_group['final_pcoords']
-        else:
-            weights = iter_group['seg_index']['weight']
-            initial_pcoords = iter_group['pcoord'][:,0]
-            final_pcoords = iter_group['pcoord'][:,pcoord_len-1]
-
-        initial_assignments = assign(initial_pcoords)
-        final_assignments = assign(final_pcoords)
-
-        flux_assign(weights, initial_assignments, final_assignments, flux_matrix)
-        pop_assign(weights, initial_assignments, population_vector)
+    for n_iter in iter_indices:
+        _iter_flux_populations(bin_mapper, n_iter, flux_matrix, population_vector, iter_data, bin_hash)
 
         flux_stats.update(flux_matrix, nomask2d)
         pop_stats.update(population_vector, nomask1d)
@@ -142,11 +153,6 @@ def process_iter_chunk(bin_mapper, iter_indices, iter_data=None):
         calc_rates(flux_matrix, population_vector, rate_matrix, rate_mask)
         rate_stats.update(rate_matrix, rate_mask)
 
-        del weights
-        del initial_assignments, final_assignments
-        del initial_pcoords, final_pcoords
-        del iter_group
-
     # Create namedtuple proxies for the cython StreamingStats objects
     # since the typed memoryviews class variables do not seem to return
     # cleanly from the zmq workers
@@ -157,6 +163,22 @@ def process_iter_chunk(bin_mapper, iter_indices, iter_data=None):
     return c_flux_stats, c_rate_stats, c_pop_stats 
 
 
+def process_iter_observations(bin_mapper, iter_indices, iter_data=None, bin_hash=None):
+    '''As ``process_iter_chunk``, but return the per-iteration observations themselves, as a tuple
+    ``(iter_indices, flux_matrices, population_vectors)`` of arrays of shape ``(n,)``, ``(n, nbins, nbins)``,
+    and ``(n, nbins)``.'''
+
+    iter_indices = list(iter_indices)
+    nbins = bin_mapper.nbins
+    flux_matrices = numpy.zeros((len(iter_indices), nbins, nbins), numpy.float64)
+    population_vectors = numpy.zeros((len(iter_indices), nbins), numpy.float64)
+
+    for iiter, n_iter in enumerate(iter_indices):
+        _iter_flux_populations(bin_mapper, n_iter, flux_matrices[iiter], population_vectors[iiter], iter_data, bin_hash)
+
+    return numpy.array(iter_indices, dtype=numpy.int64), flux_matrices, population_vectors
+
+
 class RateAverager():
     '''Calculate bin-to-bin kinetic properties (fluxes, rates, populations) at
     1-tau resolution'''
@@ -166,6 +188,7 @@ class RateAverager():
         self.data_manager = data_manager or westpa.rc.get_data_manager()
         self.system = system or westpa.rc.get_system_driver()
         self.work_manager = work_manager or westpa.rc.get_work_manager()
+        self.bin_hash = get_mapper_hash(bin_mapper)
 
     def extract_data(self, iter_indices):
         '''Extract data from the data_manger and place in dict mirroring the same
@@ -191,8 +214,12 @@ class RateAverager():
                 di_nw['new_init_pcoord'] = nwgroup['new_init_pcoord'][...]
 
             di['weight'] = iter_group['seg_index']['weight']
-            di['initial_pcoords'] = iter_group['pcoord'][:,0]
-            di['final_pcoords'] = iter_group['pcoord'][:,pcoord_len-1]
+            try:
+                di['initial_assignments'], di['final_assignments'] = self.data_manager.get_iter_assignments(n_iter,
+                                                                                                          self.bin_hash)
+            except KeyError:
+                di['initial_pcoords'] = iter_group['pcoord'][:,0]
+                di['final_pcoords'] = iter_group['pcoord'][:,pcoord_len-1]
 
         return data
 
@@ -218,7 +245,8 @@ class RateAverager():
         nbins = self.bin_mapper.nbins
 
         if n_blocks == 1:
-            flux_stats_t, rate_stats_t, population_stats_t = process_iter_chunk(self.bin_mapper, range(iter_start, iter_stop))
+            flux_stats_t, rate_stats_t, population_stats_t = process_iter_chunk(self.bin_mapper, range(iter_start, iter_stop),
+                                                                                bin_hash=self.bin_hash)
 
             flux_stats = tuple2stats(flux_stats_t)
             rate_stats = tuple2stats(rate_stats_t)
@@ -242,6 +270,9 @@ class RateAverager():
                 rate_stats += chunk_rate_stats
                 population_stats += chunk_pop_stats
 
+        self._set_results(flux_stats, rate_stats, population_stats)
+
+    def _set_results(self, flux_stats, rate_stats, population_stats):
         self.average_flux = flux_stats.mean 
         self.stderr_flux = numpy.nan_to_num(numpy.sqrt(flux_stats.var) / flux_stats.n)
 
@@ -256,6 +287,202 @@ class RateAverager():
         assert ~numpy.any(numpy.isinf(self.stderr_populations))
 
 
+class CachedRateAverager(RateAverager):
+    '''A ``RateAverager`` for a window of iterations which slides forward as a simulation progresses
+    (as for the WEED and WESS plugins). The flux matrix and population vector of each iteration in the
+    window are kept in a ring buffer, so that each call to ``calculate()`` reads from the WEST HDF5 file
+    only those iterations which have entered the window since the previous call. Statistics are then
+    accumulated from memory in iteration order, and so are identical to those of ``RateAverager``.
+    The ring may be stored in and restored from an HDF5 group with ``save_state()`` and
+    ``load_state()``, so that a restarted simulation need not re-read the window. The ring holds a
+    dense flux matrix for every iteration of the window, that is, window size * nbins**2 * 8 bytes
+    in memory and on disk, and so suits modest numbers of bins.'''
+
+    def __init__(self, bin_mapper, system=None, data_manager=None, work_manager=None):
+        super(CachedRateAverager,self).__init__(bin_mapper, system, data_manager, work_manager)
+        self.nbins = bin_mapper.nbins
+
+        # Iterations [cache_start, cache_stop) are held in the ring, iteration n_iter at
+        # position n_iter % capacity
+        self.capacity = 0
+        self.cache_start = self.cache_stop = 0
+        self.slot_iters = numpy.zeros((0,), numpy.int64)
+        self.flux_matrices = numpy.zeros((0, self.nbins, self.nbins), numpy.float64)
+        self.population_vectors = numpy.zeros((0, self.nbins), numpy.float64)
+
+        # Positions in the ring changed since the last call to save_state()
+        self._unsaved = set()
+
+    def _reserve(self, capacity):
+        if capacity <= self.capacity:
+            return
+        capacity = max(capacity, 2*self.capacity)
+        nbins = self.nbins
+        slot_iters = numpy.zeros((capacity,), numpy.int64)
+        flux_matrices = numpy.zeros((capacity, nbins, nbins), numpy.float64)
+        population_vectors = numpy.zeros((capacity, nbins), numpy.float64)
+
+        if self.cache_stop > self.cache_start:
+            iters = numpy.arange(self.cache_start, self.cache_stop)
+            old_slots = iters % self.capacity
+            new_slots = iters % capacity
+            slot_iters[new_slots] = iters
+            flux_matrices[new_slots] = self.flux_matrices[old_slots]
+            population_vectors[new_slots] = self.population_vectors[old_slots]
+            self._unsaved = set(new_slots)
+
+        self.capacity = capacity
+        self.slot_iters = slot_iters
+        self.flux_matrices = flux_matrices
+        self.population_vectors = population_vectors
+
+    def _store(self, iter_indices, flux_matrices, population_vectors):
+        slots = iter_indices % self.capacity
+        self.slot_iters[slots] = iter_indices
+        self.flux_matrices[slots] = flux_matrices
+        self.population_vectors[slots] = population_vectors
+        self._unsaved.update(slots)
+
+    def read_iterations(self, iter_indices, n_blocks=1, queue_size=1):
+        '''Read the flux matrices and population vectors of the given iterations into the ring, optionally
+        in n_blocks blocks, as for ``calculate()``.'''
+
+        if len(iter_indices) == 0:
+            return
+
+        if n_blocks == 1:
+            self._store(*process_iter_observations(self.bin_mapper, iter_indices, bin_hash=self.bin_hash))
+        else:
+            block_size = max(1, len(iter_indices) // n_blocks)
+            def task_generator():
+                for iter_block in grouper(block_size, iter_indices):
+                    iter_block = filter(lambda x: x is not None, iter_block)
+                    iter_data = self.extract_data(iter_block)
+                    yield (process_iter_observations, (self.bin_mapper, iter_block), {'iter_data': iter_data})
+                    del iter_data
+
+            for future in self.work_manager.submit_as_completed(task_generator(), queue_size):
+                self._store(*future.get_result())
+
+    def calculate(self, iter_start=None, iter_stop=None, n_blocks=1, queue_size=1):
+        '''Collect flux matrices and population vectors for each bin for each iteration in the range
+        [iter_start, iter_stop), reading only those iterations not already in the ring. Any reading
+        required is broken up into n_blocks blocks, as for ``RateAverager.calculate()``.'''
+
+        iter_start = iter_start or 1
+        iter_stop = iter_stop or self.data_manager.current_iteration
+        nbins = self.nbins
+
+        self._reserve(iter_stop - iter_start)
+
+        # Retain only that part of the ring overlapping the new window
+        cache_start = max(self.cache_start, iter_start)
+        cache_stop = min(self.cache_stop, iter_stop)
+        if cache_start >= cache_stop:
+            cache_start = cache_stop = iter_start
+        self.cache_start, self.cache_stop = cache_start, cache_stop
+
+        missing = range(iter_start, cache_start) + range(cache_stop, iter_stop)
+        self.read_iterations(missing, n_blocks, queue_size)
+        self.cache_start, self.cache_stop = iter_start, iter_stop
+
+        flux_stats = StreamingStats2D((nbins, nbins))
+        rate_stats = StreamingStats2D((nbins, nbins))
+        population_stats = StreamingStats1D(nbins)
+
+        nomask1d = numpy.zeros((nbins,), numpy.uint8)
+        nomask2d = numpy.zeros((nbins, nbins), numpy.uint8)
+        rate_mask = numpy.zeros((nbins, nbins), numpy.uint8)
+        rate_matrix = numpy.zeros((nbins, nbins), numpy.float64)
+
+        for n_iter in xrange(iter_start, iter_stop):
+            islot = n_iter % self.capacity
+            flux_matrix = self.flux_matrices[islot]
+            population_vector = self.population_vectors[islot]
+
+            flux_stats.update(flux_matrix, nomask2d)
+            population_stats.update(population_vector, nomask1d)
+
+            calc_rates(flux_matrix, population_vector, rate_matrix, rate_mask)
+            rate_stats.update(rate_matrix, rate_mask)
+
+        self._set_results(flux_stats, rate_stats, population_stats)
+
+    def save_state(self, group):
+        '''Store the contents of the ring in the HDF5 ``group``. Only those iterations which have entered
+        the ring since the last call are written, unless the ring has been resized or ``group`` holds
+        data for another bin mapper. Nothing is stored if the bin mapper cannot be hashed.'''
+
+        if self.bin_hash is None or self.capacity == 0:
+            return
+
+        try:
+            rewrite = (group.attrs['bin_hash'] != self.bin_hash or len(group['iter_indices']) != self.capacity)
+        except KeyError:
+            rewrite = True
+
+        if rewrite:
+            for name in ('iter_indices', 'flux_matrices', 'population_vectors'):
+                try:
+                    del group[name]
+                except KeyError:
+                    pass
+            group.create_dataset('iter_indices', data=self.slot_iters)
+            group.create_dataset('flux_matrices', data=self.flux_matrices, chunks=(1, self.nbins, self.nbins))
+            group.create_dataset('population_vectors', data=self.population_vectors, chunks=(1, self.nbins))
+            group.attrs['bin_hash'] = self.bin_hash
+        else:
+            iter_indices_ds = group['iter_indices']
+            flux_matrices_ds = group['flux_matrices']
+            population_vectors_ds = group['population_vectors']
+            for islot in sorted(self._unsaved):
+                iter_indices_ds[islot] = self.slot_iters[islot]
+                flux_matrices_ds[islot] = self.flux_matrices[islot]
+                population_vectors_ds[islot] = self.population_vectors[islot]
+
+        group.attrs['cache_start'] = self.cache_start
+        group.attrs['cache_stop'] = self.cache_stop
+        self._unsaved.clear()
+
+    def load_state(self, group, iter_stop=None):
+        '''Restore the ring from the HDF5 ``group``, as written by ``save_state()``. Stored iterations at or
+        beyond ``iter_stop`` (for instance, those discarded by truncating the simulation) are ignored, as is
+        a ring stored for a different bin mapper.'''
+
+        if self.bin_hash is None:
+            return
+
+        try:
+            if group.attrs['bin_hash'] != self.bin_hash:
+                return
+            cache_start = long(group.attrs['cache_start'])
+            cache_stop = long(group.attrs['cache_stop'])
+            slot_iters = group['iter_indices'][...]
+            flux_matrices = group['flux_matrices'][...]
+            population_vectors = group['population_vectors'][...]
+        except KeyError:
+            return
+
+        if iter_stop is not None:
+            cache_stop = min(cache_stop, iter_stop)
+        if cache_stop <= cache_start or flux_matrices.shape[1:] != (self.nbins, self.nbins):
+            return
+
+        # Keep the longest run of stored iterations ending at cache_stop
+        capacity = len(slot_iters)
+        iters = numpy.arange(cache_start, cache_stop)
+        stale = iters[slot_iters[iters % capacity] != iters]
+        if len(stale):
+            cache_start = stale.max() + 1
+
+        self.capacity = capacity
+        self.slot_iters = slot_iters
+        self.flux_matrices = flux_matrices
+        self.population_vectors = population_vectors
+        self.cache_start, self.cache_stop = cache_start, cache_stop
+        self._unsaved.clear()
+
+
 if __name__ == '__main__':
     # Tests this file on the west.h5 data in the current (sim root) directory
     westpa.rc.read_config()
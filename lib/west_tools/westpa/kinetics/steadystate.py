@@ -0,0 +1,268 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Steady-state (stationary) distributions of bin-to-bin transition matrices.
+
+Rate and transition matrices over (labeled) bins are large but very sparse, and the
+same calculation is typically repeated many times over closely related matrices
+(successive evolution windows, or bootstrap samples of one window). A
+``SteadyStateSolver`` therefore works on ``scipy.sparse`` matrices with iterative
+methods, starts each solution from the previous one, and caches the reduction of
+a matrix to its largest strongly-connected component (the only part of the state
+space on which a steady state is well-defined) for reuse by subsequent matrices with
+the same sparsity pattern.
+'''
+
+from __future__ import division; __metaclass__ = type
+import logging, hashlib
+
+import numpy
+import scipy.linalg, scipy.sparse, scipy.sparse.linalg
+
+from _kinetics import strongly_connected_components #@UnresolvedImport
+
+log = logging.getLogger(__name__)
+
+def normalize_rows(matrix):
+    '''Return a copy of the sparse ``matrix`` (in CSR form) with each row scaled to sum to one.
+    Rows summing to zero are left as zero.'''
+    matrix = scipy.sparse.csr_matrix(matrix, dtype=numpy.float64, copy=True)
+    rowsums = numpy.asarray(matrix.sum(axis=1)).ravel()
+    rowsums[rowsums == 0] = 1.0
+    matrix.data /= numpy.repeat(rowsums, numpy.diff(matrix.indptr))
+    return matrix
+
+class SteadyStateSolver:
+    '''Find the stationary distribution of a transition (or rate) matrix, restricted to its largest
+    strongly-connected component. Rows are normalized before solving, so rate and flux matrices may be
+    passed directly. Available methods are:
+
+      ``arpack``
+        Implicitly restarted Arnoldi iteration (``scipy.sparse.linalg.eigs``) for the dominant
+        left eigenvector.
+      ``power``
+        Power iteration.
+      ``gmres``
+        ILU-preconditioned GMRES on the stationary equations, with the probability of one state
+        fixed and its equation dropped.
+      ``direct``
+        Sparse LU decomposition of the same system.
+      ``dense``
+        Full dense eigendecomposition (``scipy.linalg.eig``), as used by earlier versions.
+      ``auto``
+        Currently ``direct``, which is both fastest and most accurate for the banded, nearly
+        decomposable matrices arising from typical binning schemes.
+
+    The iterative methods (``arpack``, ``power``, and ``gmres``) start from the previous
+    solution, so solving a sequence of similar matrices with one solver is considerably faster
+    than solving each from scratch. A solution is accepted only if it is stationary (an eigenvector
+    of the transition matrix with eigenvalue 1, to within ``rtol``); should a method fail, the
+    ``direct`` and then ``dense`` methods are tried in turn.
+
+    States outside the largest strongly-connected component receive no probability. After each
+    solution, ``excluded_states`` holds the indices of those among them which have any transitions
+    (and so whose probability is dropped); callers should report these to the user.'''
+
+    methods = ('auto', 'arpack', 'power', 'gmres', 'direct', 'dense')
+
+    def __init__(self, method='auto', tol=1.0e-12, maxiter=None, cache_components=True, rtol=1.0e-5):
+        if method not in self.methods:
+            raise ValueError('unknown steady-state method {!r}'.format(method))
+        self.method = method
+        self.tol = tol
+        self.maxiter = maxiter
+        self.cache_components = cache_components
+        self.rtol = rtol
+
+        # States with transitions left out of the most recent solution
+        self.excluded_states = numpy.empty((0,), numpy.int64)
+
+        # Previous solution (over the full state space), for warm starts
+        self.last_solution = None
+
+        # Sparsity pattern key -> indices of states in the largest strongly-connected component
+        self._component_cache = {}
+
+    def clear(self):
+        '''Forget previous solutions and cached component reductions.'''
+        self.last_solution = None
+        self._component_cache.clear()
+
+    @staticmethod
+    def _pattern_key(matrix):
+        digest = hashlib.sha1()
+        digest.update(numpy.ascontiguousarray(matrix.indptr).view(numpy.uint8))
+        digest.update(numpy.ascontiguousarray(matrix.indices).view(numpy.uint8))
+        return (matrix.shape, digest.hexdigest())
+
+    def largest_component(self, matrix):
+        '''Return the (sorted) indices of the states in the largest strongly-connected component
+        of the directed graph described by the nonzero entries of the CSR ``matrix``.'''
+        if self.cache_components:
+            key = self._pattern_key(matrix)
+            try:
+                return self._component_cache[key]
+            except KeyError:
+                pass
+
+        _ncomponents, labels = strongly_connected_components(numpy.require(matrix.indptr, numpy.int64),
+                                                             numpy.require(matrix.indices, numpy.int64))
+        # Break ties in favor of the component containing the lowest-numbered state
+        sizes = numpy.bincount(labels)
+        largest = labels[numpy.flatnonzero(sizes[labels] == sizes.max())[0]]
+        component = numpy.flatnonzero(labels == largest)
+
+        if self.cache_components:
+            self._component_cache[key] = component
+        return component
+
+    def solve(self, matrix, x0=None):
+        '''Return the steady-state probability distribution (over all states) of ``matrix``, which may
+        be dense or sparse, or None if none is well-defined. States outside the largest strongly-connected
+        component are assigned zero probability. ``x0``, if given, is used as the initial guess in place
+        of the previous solution.'''
+
+        matrix = scipy.sparse.csr_matrix(matrix, dtype=numpy.float64)
+        matrix.eliminate_zeros()
+        matrix.sort_indices()
+        nstates = matrix.shape[0]
+
+        component = self.largest_component(matrix)
+        ncomp = len(component)
+        if ncomp < nstates:
+            reduced = matrix[component,:][:,component]
+            connected = (numpy.diff(matrix.indptr) > 0) | (numpy.bincount(matrix.indices, minlength=nstates) > 0)
+            connected[component] = False
+            self.excluded_states = numpy.flatnonzero(connected)
+            if len(self.excluded_states):
+                log.info('steady state excludes {:d} state(s) outside the largest strongly-connected component: {!r}'
+                         .format(len(self.excluded_states), list(self.excluded_states)))
+        else:
+            reduced = matrix
+            self.excluded_states = numpy.empty((0,), numpy.int64)
+        transition_matrix = normalize_rows(reduced)
+
+        if ncomp == 1 and transition_matrix.nnz == 0:
+            # An isolated state with no self-transition; no steady state exists
+            return None
+
+        if x0 is None:
+            x0 = self.last_solution
+        if x0 is not None and len(x0) == nstates:
+            x0 = numpy.abs(x0[component])
+            x0_sum = x0.sum()
+            x0 = x0/x0_sum if x0_sum > 0 else None
+        else:
+            x0 = None
+
+        method = self.method
+        if method == 'auto':
+            method = 'direct'
+        if ncomp < 3:
+            # too small for ARPACK, and trivially cheap in any event
+            method = 'dense'
+
+        sub_ss = None
+        for method in [method] + [fallback for fallback in ('direct', 'dense') if fallback != method]:
+            try:
+                sub_ss = getattr(self, '_solve_' + method)(transition_matrix, x0)
+            except (ArithmeticError, RuntimeError, ValueError, scipy.sparse.linalg.ArpackError):
+                log.debug('{} steady-state solution failed'.format(method), exc_info=True)
+            if sub_ss is not None and numpy.isfinite(sub_ss).all() and sub_ss.any():
+                sub_ss = numpy.abs(sub_ss)
+                sub_ss /= sub_ss.sum()
+                if self.is_stationary(transition_matrix, sub_ss):
+                    break
+                log.debug('{} steady-state solution is not stationary'.format(method))
+            log.debug('{} steady-state solution failed; trying another method'.format(method))
+            sub_ss = None
+        else:
+            log.debug('steady state undetermined: no eigenvector with eigenvalue 1 found')
+            return None
+
+        ss = numpy.zeros((nstates,), numpy.float64)
+        ss[component] = sub_ss
+        self.last_solution = ss
+        return ss
+
+    def is_stationary(self, transition_matrix, ss):
+        '''Return True if the normalized distribution ``ss`` is left unchanged, to within ``rtol``, by
+        the (row-normalized) ``transition_matrix``; that is, if it is an eigenvector with eigenvalue 1.'''
+        return numpy.abs(transition_matrix.T.dot(ss) - ss).sum() <= self.rtol
+
+    def _solve_dense(self, transition_matrix, x0):
+        try:
+            vals, vecs = scipy.linalg.eig(transition_matrix.toarray().T)
+        except Exception:
+            log.debug('exception obtaining eigenvectors', exc_info=True)
+            return None
+        imax = numpy.argmax(numpy.abs(vals))
+        return numpy.real(vecs[:,imax])
+
+    def _solve_arpack(self, transition_matrix, x0):
+        try:
+            _vals, vecs = scipy.sparse.linalg.eigs(transition_matrix.T.tocsr(), k=1, which='LM', v0=x0,
+                                                   tol=self.tol, maxiter=self.maxiter)
+        except scipy.sparse.linalg.ArpackNoConvergence:
+            return None
+        return numpy.real(vecs[:,0])
+
+    def _solve_power(self, transition_matrix, x0):
+        n = transition_matrix.shape[0]
+        maxiter = self.maxiter or 100*n
+        tmatrix_t = transition_matrix.T.tocsr()
+        x = x0.copy() if x0 is not None else numpy.ones((n,), numpy.float64) / n
+        for _i in xrange(maxiter):
+            x_new = tmatrix_t.dot(x)
+            x_new /= x_new.sum()
+            if numpy.abs(x_new - x).sum() < self.tol:
+                return x_new
+            x = x_new
+        return None
+
+    @staticmethod
+    def _stationary_system(transition_matrix, x0):
+        # Solve (P^T - I) x = 0 with x[k] fixed at one (for a state k likely to be well-populated), by
+        # dropping row and column k; this keeps the system as sparse as P itself
+        n = transition_matrix.shape[0]
+        k = numpy.argmax(x0) if x0 is not None else n-1
+        others = numpy.r_[0:k,k+1:n]
+        system = (transition_matrix.T - scipy.sparse.identity(n, format='csr')).tocsc()
+        rhs = -system[others,k].toarray().ravel()
+        system = system[others,:][:,others]
+        return system, rhs, k, others
+
+    def _solve_gmres(self, transition_matrix, x0):
+        system, rhs, k, others = self._stationary_system(transition_matrix, x0)
+        # An incomplete LU preconditioner is essential for metastable (nearly decomposable) matrices
+        ilu = scipy.sparse.linalg.spilu(system)
+        preconditioner = scipy.sparse.linalg.LinearOperator(system.shape, ilu.solve)
+        xk0 = x0[others]/x0[k] if x0 is not None else None
+        xk, info = scipy.sparse.linalg.gmres(system, rhs, x0=xk0, tol=self.tol, maxiter=self.maxiter or 100,
+                                             M=preconditioner)
+        if info != 0:
+            return None
+        x = numpy.ones((len(others)+1,), numpy.float64)
+        x[others] = xk
+        return x
+
+    def _solve_direct(self, transition_matrix, x0):
+        system, rhs, k, others = self._stationary_system(transition_matrix, x0)
+        x = numpy.ones((len(others)+1,), numpy.float64)
+        x[others] = scipy.sparse.linalg.splu(system).solve(rhs)
+        return x
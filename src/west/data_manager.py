@@ -35,6 +35,8 @@ The data is laid out in HDF5 as follows:
             - wtg_parents -- data used to reconstruct the split/merge history of trajectories
             - recycling -- flux and event count for recycled particles, on a per-target-state basis
             - aux_data/ -- auxiliary datasets (data stored on the 'data' field of Segment objects)
+            - assignment_cache/ -- bin assignments of the initial and final points of each segment,
+              one dataset per bin mapper, named by the hash of that mapper
 
 The file root object has an integer attribute 'west_file_format_version' which can be used to
 determine how to access data even as the file format (i.e. organization of data within HDF5 file)
@@ -70,6 +72,7 @@ import westpa
 from west.segment import Segment
 from west.states import BasisState, TargetState, InitialState
 from west.we_driver import NewWeightEntry
+from westpa.binning import index_dtype
 
 file_format_version = 7
         
@@ -1299,6 +1302,65 @@ class WESTDataManager:
             pickle_ds[n_entries-1,:len(pickle_data)] = memoryview(pickle_data)
             return n_entries-1
         
+    def save_iter_assignments(self, n_iter, hashval, initial_assignments, final_assignments):
+        '''Cache the bin assignments of the initial and final points of every segment in iteration
+        n_iter, as calculated by the bin mapper whose hash is ``hashval``. Assignments are indexed
+        by seg_id. Consumers using a mapper with the same hash may use these in place of
+        reassigning progress coordinates.'''
+
+        try:
+            hashval = hashval.hexdigest()
+        except AttributeError:
+            pass
+
+        if not hashval:
+            return
+
+        assignments = numpy.empty((len(initial_assignments),2), dtype=index_dtype)
+        assignments[:,0] = initial_assignments
+        assignments[:,1] = final_assignments
+
+        with self.lock:
+            cache_group = self.get_iter_group(n_iter).require_group('assignment_cache')
+            try:
+                del cache_group[hashval]
+            except KeyError:
+                pass
+            cache_group.create_dataset(hashval, data=assignments, shuffle=True, compression=9)
+
+    def pcoords_stored_exactly(self, n_iter):
+        '''Return True if the progress coordinates of iteration n_iter are stored without loss of
+        precision, so that assigning stored progress coordinates gives the same bins as assigning
+        those held in memory during the simulation. This is not the case if they are stored with
+        a scale/offset filter (for floating-point data) or as a type other than the system's
+        progress coordinate type.'''
+
+        with self.lock:
+            pcoord_ds = self.get_iter_group(n_iter)['pcoord']
+            if pcoord_ds.dtype != numpy.dtype(self.system.pcoord_dtype):
+                return False
+            return pcoord_ds.scaleoffset is None or pcoord_ds.dtype.kind in 'iu'
+
+    def get_iter_assignments(self, n_iter, hashval):
+        '''Return a tuple ``(initial_assignments, final_assignments)`` of cached bin assignments for
+        all segments in iteration n_iter, as calculated by the bin mapper whose hash is ``hashval``.
+        Raises KeyError if no such assignments are stored.'''
+
+        try:
+            hashval = hashval.hexdigest()
+        except AttributeError:
+            pass
+
+        if not hashval:
+            raise KeyError('no bin mapper hash given')
+
+        with self.lock:
+            try:
+                assignments = self.get_iter_group(n_iter)['assignment_cache'][hashval][...]
+            except KeyError:
+                raise KeyError('no assignments cached for iteration {:d} with hash {}'.format(long(n_iter), hashval))
+        return (assignments[:,0], assignments[:,1])
+
     def save_iter_binning(self, n_iter, hashval, pickled_mapper, target_counts):
         '''Save information about the binning used to generate segments for iteration n_iter.'''
                 
@@ -571,6 +571,14 @@ class WESimManager:
             pickled = hashed = ''
 
         self.bin_mapper_hash = hashed
+        
+        # Cache this iteration's initial and final assignments, so that consumers using the same
+        # mapper (e.g. rate averaging for reweighting) need not reassign them. These are assignments
+        # of progress coordinates as held in memory, so they are cached only if progress coordinates
+        # are stored exactly; otherwise, consumers reassigning stored data could obtain different bins.
+        if hashed and self.data_manager.pcoords_stored_exactly(self.n_iter):
+            self.data_manager.save_iter_assignments(self.n_iter, hashed,
+                                                    *self.we_driver.get_segment_assignments(len(self.segments)))
         self.we_driver.construct_next()
         
         if self.we_driver.used_initial_states:
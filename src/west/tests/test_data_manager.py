@@ -0,0 +1,83 @@
+# Copyright (C) 2013 Matthew C. Zwier and Lillian T. Chong
+#
+# This file is part of WESTPA.
+#
+# WESTPA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WESTPA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with WESTPA.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division, print_function
+import os, shutil, tempfile
+
+import numpy, h5py
+
+from west.data_manager import WESTDataManager, create_dataset_from_dsopts, normalize_dataset_options
+from westpa.binning.assign import RectilinearBinMapper, get_mapper_hash
+
+class _System:
+    pcoord_dtype = numpy.float32
+
+class TestAssignmentCache:
+    def setup(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.data_manager = WESTDataManager()
+        self.data_manager.we_h5filename = os.path.join(self.tempdir, 'west.h5')
+        self.data_manager.system = _System()
+        with h5py.File(self.data_manager.we_h5filename, 'w') as we_h5file:
+            we_h5file.attrs['west_file_format_version'] = 7
+            we_h5file.attrs['west_iter_prec'] = 8
+            we_h5file.create_group('/iterations/iter_00000001')
+        self.data_manager.open_backing('r+')
+
+        self.mapper = RectilinearBinMapper([[0.0, 4.0, 8.0, 12.0]])
+        # Some points lie just below a bin boundary, and are moved across it by a scale/offset filter
+        self.pcoords = numpy.array([[[1.0], [7.99999]],
+                                    [[7.99999], [3.99999]],
+                                    [[5.0], [11.0]]], dtype=numpy.float32)
+
+    def teardown(self):
+        self.data_manager.close_backing()
+        shutil.rmtree(self.tempdir)
+
+    def store_and_reassign(self, dsopts):
+        data_manager = self.data_manager
+        dsopts = normalize_dataset_options(dict(dsopts, name='pcoord'))
+        create_dataset_from_dsopts(data_manager.get_iter_group(1), dsopts, data=self.pcoords)
+
+        # As the simulation manager caches assignments of progress coordinates held in memory...
+        hashval = get_mapper_hash(self.mapper)
+        if data_manager.pcoords_stored_exactly(1):
+            data_manager.save_iter_assignments(1, hashval, self.mapper.assign(self.pcoords[:,0]),
+                                               self.mapper.assign(self.pcoords[:,-1]))
+
+        # ...and consumers use cached assignments if available, or reassign stored progress coordinates
+        data_manager.close_backing()
+        data_manager.open_backing('r')
+        pcoord_ds = data_manager.get_iter_group(1)['pcoord']
+        reassigned = (self.mapper.assign(pcoord_ds[:,0]), self.mapper.assign(pcoord_ds[:,1]))
+        try:
+            cached = data_manager.get_iter_assignments(1, hashval)
+        except KeyError:
+            cached = None
+        return cached, reassigned
+
+    def test_exact_storage_cached(self):
+        cached, reassigned = self.store_and_reassign({})
+        assert cached is not None
+        assert (cached[0] == reassigned[0]).all() and (cached[1] == reassigned[1]).all()
+
+    def test_lossy_storage_not_cached(self):
+        cached, reassigned = self.store_and_reassign({'scaleoffset': 4})
+        # reassignment of stored data differs from that of data held in memory...
+        assert (reassigned[0] != self.mapper.assign(self.pcoords[:,0])).any()
+        # ...so no assignments may be cached for consumers to use in its place
+        assert cached is None
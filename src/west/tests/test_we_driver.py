@@ -64,7 +64,16 @@ class TestWEDriver:
         assert len(self.we_driver.final_binning[0]) == 1
         assert len(self.we_driver.final_binning[1]) == 1
         assert (self.we_driver.flux_matrix == numpy.array([[0.0, 0.5], [0.5,0.0]])).all()
-        
+
+    def test_segment_assignments(self):
+        segments = [self.segment(0.0, 1.5, weight=0.5),
+                    self.segment(1.5, 0.5, weight=0.5)]
+        self.we_driver.new_iteration()
+        self.we_driver.assign(segments)
+        initial_assignments, final_assignments = self.we_driver.get_segment_assignments(len(segments))
+        assert (initial_assignments == [0,1]).all()
+        assert (final_assignments == [1,0]).all()
+
     def test_passthrough(self):
         segments = ([self.segment(0.0, 1.5, weight=0.125) for _i in xrange(4)]
                    +[self.segment(1.5, 0.5, weight=0.125) for _i in xrange(4)])
@@ -231,6 +240,28 @@ class TestWEDriver:
         assert segments[0].endpoint_type == Segment.SEG_ENDPOINT_RECYCLED
 
         
+    def test_rebin_next(self):
+        segments = [self.segment(0.0, 0.5, weight=0.5),
+                    self.segment(0.0, 1.5, weight=0.5)]
+        self.we_driver.new_iteration()
+        self.we_driver.assign(segments)
+        self.we_driver.construct_next()
+        assert len(self.we_driver.next_iter_binning[0]) == 4
+        assert len(self.we_driver.next_iter_binning[1]) == 4
+
+        # all walkers now fall into one bin, so half of them are merged away
+        self.we_driver.rebin_next(RectilinearBinMapper([[0.0, 2.0, 3.0]]))
+        assert len(self.we_driver.next_iter_binning[0]) == 4
+        assert len(self.we_driver.next_iter_binning[1]) == 0
+        assert abs(sum(seg.weight for seg in self.we_driver.next_iter_segments) - 1.0) < 4*EPS
+
+        continuing = {segment.parent_id for segment in self.we_driver.next_iter_segments}
+        for segment in segments:
+            if segment.seg_id in continuing:
+                assert segment.endpoint_type == Segment.SEG_ENDPOINT_CONTINUES
+            else:
+                assert segment.endpoint_type == Segment.SEG_ENDPOINT_MERGED
+
     def test_multiple_merge(self):
         
         # This weight and count combination is known to trigger a split to 51
@@ -25,6 +25,7 @@ import random
 from itertools import izip
 
 import westpa
+from westpa.binning.assign import index_dtype, UNKNOWN_INDEX
 from west import Segment
 
 class ConsistencyError(RuntimeError):
@@ -162,6 +163,24 @@ class WEDriver:
             for walker in _bin:
                 yield ibin
                 
+    def get_segment_assignments(self, n_segs):
+        '''Return a tuple ``(initial_assignments, final_assignments)`` of arrays, indexed by seg_id,
+        of the bins into which the initial and final points of the ``n_segs`` segments of the
+        current iteration were assigned by ``assign()``. Segments not yet assigned are marked with
+        ``UNKNOWN_INDEX``.'''
+        
+        initial_assignments = numpy.empty((n_segs,), dtype=index_dtype)
+        final_assignments = numpy.empty((n_segs,), dtype=index_dtype)
+        initial_assignments.fill(UNKNOWN_INDEX)
+        final_assignments.fill(UNKNOWN_INDEX)
+        
+        for (assignments, binning) in ((initial_assignments, self.initial_binning),
+                                       (final_assignments, self.final_binning)):
+            for ibin, _bin in enumerate(binning):
+                for segment in _bin:
+                    assignments[segment.seg_id] = ibin
+        return (initial_assignments, final_assignments)
+    
     @property
     def recycling_segments(self):
         '''Segments designated for recycling'''
@@ -549,6 +568,16 @@ class WEDriver:
         '''Run recycle/split/merge. Do not call this function directly; instead, use
         populate_initial(), rebin_current(), or construct_next().'''
         self._recycle_walkers()
+        self._split_and_merge()
+        
+        self.new_weights = self.new_weights or []
+        
+        log.debug('used initial states: {!r}'.format(self.used_initial_states))
+        log.debug('available initial states: {!r}'.format(self.avail_initial_states))
+
+    def _split_and_merge(self):
+        '''Split and merge walkers in each bin of ``next_iter_binning``, then adjust counts if
+        requested.'''
         
         # sanity check
         self._check_pre()
@@ -565,11 +594,6 @@ class WEDriver:
                 self._adjust_count(ibin)
             
         self._check_post()
-        
-        self.new_weights = self.new_weights or []
-        
-        log.debug('used initial states: {!r}'.format(self.used_initial_states))
-        log.debug('available initial states: {!r}'.format(self.avail_initial_states))
 
             
     def populate_initial(self, initial_states, weights, system=None):
@@ -667,6 +691,62 @@ class WEDriver:
                 
         self._run_we()
                                     
+    def rebin_next(self, bin_mapper=None, bin_target_counts=None):
+        '''Reassign the walkers already constructed for the next iteration (by construct_next(),
+        populate_initial(), or rebin_current()) to the bins of ``bin_mapper``, then split and merge
+        them to the per-bin target counts ``bin_target_counts``. If ``bin_mapper`` is omitted,
+        the current mapper is used, as when it has been updated in place (for instance, by
+        ``update_from_samples()``); target counts are obtained from the system if omitted.
+        
+        Unlike rebin_current(), this reuses the existing walkers rather than reconstructing them
+        from the current iteration, and requires only one call to the mapper's ``assign()``, so
+        that bins may cheaply be adapted every iteration. Recycling has already taken place, so
+        target states (which are remapped to the new bins) must not contain any walkers.'''
+        
+        if self.next_iter_binning is None:
+            raise RuntimeError('cannot rebin next iteration segments before running WE')
+        
+        if bin_mapper is not None:
+            self.bin_mapper = bin_mapper
+        nbins = self.bin_mapper.nbins
+        
+        if bin_target_counts is None:
+            bin_target_counts = self.system.bin_target_counts
+        bin_target_counts = numpy.array(bin_target_counts).copy()
+        if len(bin_target_counts) != nbins:
+            raise ValueError('number of target counts ({:d}) does not match number of bins ({:d})'
+                             .format(len(bin_target_counts), nbins))
+        self.bin_target_counts = bin_target_counts
+        
+        target_states = self.target_states.values() if self.target_states else []
+        self.target_states = {}
+        if target_states:
+            tstate_assignments = self.bin_mapper.assign([tstate.pcoord for tstate in target_states])
+            for (tstate, tstate_assignment) in izip(target_states, tstate_assignments):
+                self.target_states[tstate_assignment] = tstate
+                self.bin_target_counts[tstate_assignment] = 0
+        
+        segments = list(self.next_iter_segments)
+        self.next_iter_binning = self.bin_mapper.construct_bins()
+        if segments:
+            pcoords = numpy.empty((len(segments), self.system.pcoord_ndim), dtype=self.system.pcoord_dtype)
+            for (iseg, segment) in enumerate(segments):
+                pcoords[iseg] = segment.pcoord[0,:]
+            assignments = self.bin_mapper.assign(pcoords)
+            for (segment, ibin) in izip(segments, assignments):
+                self.next_iter_binning[ibin].add(segment)
+            del pcoords, assignments
+        del segments
+        
+        self._split_and_merge()
+        
+        # Splitting and merging may have changed which parents continue, and which are merged
+        continuing = {segment.parent_id for segment in self.next_iter_segments}
+        for (seg_id, segment) in self._parent_map.iteritems():
+            if segment.endpoint_type in (Segment.SEG_ENDPOINT_CONTINUES, Segment.SEG_ENDPOINT_MERGED):
+                segment.endpoint_type = (Segment.SEG_ENDPOINT_CONTINUES if seg_id in continuing 
+                                         else Segment.SEG_ENDPOINT_MERGED)
+                
     def construct_next(self):
         '''Construct walkers for the next iteration, by running weighted ensemble recycling
         and bin/split/merge on the segments previously assigned to bins using ``assign``.
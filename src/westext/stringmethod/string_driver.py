@@ -26,7 +26,7 @@ import westpa, west
 from westpa import extloader
 from westpa.yamlcfg import check_bool, ConfigItemMissing
 from westext.stringmethod import WESTStringMethod, DefaultStringMethod
-from westpa.binning import VoronoiBinMapper
+from westpa.binning import VoronoiBinMapper, get_mapper_hash
 
 
 class StringDriver(object):
@@ -203,13 +203,20 @@ class StringDriver(object):
         start_iter = max(n_iter - min(self.windowsize, n_iter), 2)
         stop_iter = n_iter + 1
 
+        # Final-point assignments cached by the simulation can be reused if they were
+        # made with the current bin mapper
+        bin_hash = get_mapper_hash(self.system.bin_mapper)
+
         for n in xrange(start_iter, stop_iter):
             with self.data_manager.lock:
                 iter_group = self.data_manager.get_iter_group(n)
                 seg_index = iter_group['seg_index'][...]
 
                 pcoords = iter_group['pcoord'][:,-1,:]  # Only read final point
-                bin_indices = self.system.bin_mapper.assign(pcoords)
+                try:
+                    bin_indices = self.data_manager.get_iter_assignments(n, bin_hash)[1]
+                except KeyError:
+                    bin_indices = self.system.bin_mapper.assign(pcoords)
                 weights = seg_index['weight']
 
                 pcoord_w = pcoords * weights[:,np.newaxis]
@@ -26,7 +26,8 @@ from itertools import izip, imap
 
 import westpa, west
 from westpa.yamlcfg import check_bool
-from westpa.kinetics import RateAverager
+from westpa.kinetics import RateAverager, CachedRateAverager
+from westpa.binning import get_mapper_hash
 from westext.weed.ProbAdjustEquil import probAdjustEquil
 
 EPS = numpy.finfo(numpy.float64).eps
@@ -71,6 +72,15 @@ class WEEDDriver:
         self.rate_calc_queue_size = plugin_config.get('rate_calc_queue_size', 1)
         self.rate_calc_n_blocks = plugin_config.get('rate_calc_n_blocks', 1)
 
+        # Optionally keep the flux matrices and populations of the averaging window in memory (and in
+        # the WEST HDF5 file) between reweightings, rather than re-reading the window each time. This
+        # takes window size * nbins**2 * 8 bytes, so it is enabled only on request.
+        self.cache_rates = check_bool(plugin_config.get('cache_rates', False))
+        if self.cache_rates:
+            log.info('caching flux matrices and populations of the averaging window')
+        self.rate_averager = None
+        self.first_iter = None
+
         if self.do_reweight:
             sim_manager.register_callback(sim_manager.prepare_new_iteration,self.prepare_new_iteration, self.priority)
 
@@ -86,14 +96,35 @@ class WEEDDriver:
         else: # self.windowtype == 'fixed':
             eff_windowsize = min(n_iter, self.windowsize or 0)
 
-        averager = RateAverager(mapper, self.system, self.data_manager, self.work_manager)
+        if self.cache_rates:
+            averager = self.get_cached_averager(mapper)
+        else:
+            averager = RateAverager(mapper, self.system, self.data_manager, self.work_manager)
         averager.calculate(max(1, n_iter-eff_windowsize), n_iter+1, self.rate_calc_n_blocks, self.rate_calc_queue_size)
+        if self.cache_rates:
+            with self.data_manager.lock:
+                averager.save_state(self.data_manager.we_h5file.require_group('weed/rate_cache'))
         self.eff_windowsize = eff_windowsize
 
         return averager
 
+    def get_cached_averager(self, mapper):
+        '''Return the persistent rate averager for the given mapper, restoring its state from the WEST
+        HDF5 file when first created. Iterations at or after the first run by this process may have been
+        truncated and re-run since the state was saved, and so are not restored.'''
+
+        averager = self.rate_averager
+        if averager is None or averager.bin_hash is None or averager.bin_hash != get_mapper_hash(mapper):
+            averager = self.rate_averager = CachedRateAverager(mapper, self.system, self.data_manager,
+                                                               self.work_manager)
+            with self.data_manager.lock:
+                averager.load_state(self.data_manager.we_h5file.require_group('weed/rate_cache'), self.first_iter)
+        return averager
+
     def prepare_new_iteration(self):
         n_iter = self.sim_manager.n_iter
+        if self.first_iter is None:
+            self.first_iter = n_iter
         we_driver = self.sim_manager.we_driver
         
         if we_driver.target_states and self.do_reweight: